@@ -0,0 +1,30 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Bounded pool for blocking work (SQLite, numpy, sync SDK calls) so it never runs on the event loop.
+BLOCKING_POOL_SIZE = int(os.environ.get("BLOCKING_POOL_SIZE", 16))
+
+_executor = None
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="memoria-blocking")
+    return _executor
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking callable on the shared thread pool and awaits its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+def shutdown_executor(wait: bool = True):
+    global _executor
+    if _executor is not None:
+        logging.info("Shutting down blocking thread pool")
+        _executor.shutdown(wait=wait)
+        _executor = None
@@ -0,0 +1,64 @@
+"""
+Recall-vs-latency benchmark for the IVF approximate index against exact search.
+
+Vectors are synthetic 768-dim embeddings. The "clustered" set draws them around nested
+topic centres, which is closer to real fragment embeddings; the "unclustered" set is
+isotropic noise and is the worst case for any partitioning index.
+
+Usage: python bench_ann.py [n_vectors ...]
+"""
+import sys
+import time
+
+import numpy as np
+
+from vector_index import EmbeddingIndex, IVFIndex
+
+DIM = 768
+TOP_K = 5
+QUERIES = 200
+
+def synthetic_embeddings(n, seed=0):
+    # Broad themes (childhood, career, ...) with many overlapping sub-topics under each
+    rng = np.random.default_rng(seed)
+    themes = rng.standard_normal((50, DIM)).astype(np.float32)
+    topics = themes[rng.integers(0, 50, max(n // 20, 1))] + rng.standard_normal((max(n // 20, 1), DIM)).astype(np.float32)
+    picks = rng.integers(0, len(topics), n)
+    return topics[picks] + 1.2 * rng.standard_normal((n, DIM)).astype(np.float32)
+
+def unclustered_embeddings(n, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+
+def _time_queries(index, queries):
+    results, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        results.append([fid for fid, _ in index.search(q, TOP_K)])
+        latencies.append(time.perf_counter() - start)
+    return results, np.array(latencies) * 1000
+
+def run(n, generator, label):
+    # Queries are held-out points from the same distribution as the indexed fragments
+    data = generator(n + QUERIES)
+    vectors, queries = data[:n], data[n:]
+    items = list(enumerate(vectors))
+
+    exact = EmbeddingIndex()
+    exact.build(items)
+    truth, exact_ms = _time_queries(exact, queries)
+    print(f"\n{label} N={n}: exact  p50={np.percentile(exact_ms, 50):6.2f}ms  p95={np.percentile(exact_ms, 95):6.2f}ms  recall@{TOP_K}=1.000")
+
+    start = time.perf_counter()
+    ivf = IVFIndex(min_train_size=1)
+    ivf.build(items)
+    print(f"        ivf build ({ivf.nlist} lists): {time.perf_counter() - start:.1f}s")
+    for nprobe in (1, 4, 10, 20):
+        ivf.nprobe = nprobe
+        found, ivf_ms = _time_queries(ivf, queries)
+        recall = np.mean([len(set(f) & set(t)) / TOP_K for f, t in zip(found, truth)])
+        print(f"        ivf nprobe={nprobe:<3} p50={np.percentile(ivf_ms, 50):6.2f}ms  p95={np.percentile(ivf_ms, 95):6.2f}ms  recall@{TOP_K}={recall:.3f}")
+
+if __name__ == "__main__":
+    for size in [int(arg) for arg in sys.argv[1:]] or [10000, 50000]:
+        run(size, synthetic_embeddings, "clustered")
+        run(size, unclustered_embeddings, "unclustered")
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark for database.py: one-connection-per-call (the old behaviour)
+versus the pooled, WAL-mode connections used now.
+
+Usage: python bench_database.py [iterations]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import database
+
+def _naive_save_fragment(path, i):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO fragments (session_id, category, content, context, embedding, audio_url, image_url, is_verified)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+    """, ("bench", "Childhood", f"Memory {i}", "ctx", None, None, None))
+    conn.commit()
+    conn.close()
+
+def _naive_verify_fragment(path, i):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE fragments SET is_verified = 1 WHERE id = ?", (i,))
+    conn.commit()
+    conn.close()
+
+def _naive_get_active_seeds(path, i):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, content FROM memory_seeds WHERE is_used = 0")
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+def _measure(label, fn, iterations):
+    start = time.perf_counter()
+    for i in range(1, iterations + 1):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    ops = iterations / elapsed
+    print(f"  {label:<22} {ops:>10.0f} ops/sec")
+    return ops
+
+def run(iterations=2000):
+    with tempfile.TemporaryDirectory() as tmp:
+        naive_path = os.path.join(tmp, "naive.db")
+        pooled_path = os.path.join(tmp, "pooled.db")
+
+        # Baseline: fresh connection per call on a rollback-journal database
+        database.DB_PATH = naive_path
+        database.init_db()
+        database.close_connections()
+        with sqlite3.connect(naive_path) as conn:
+            conn.execute("PRAGMA journal_mode=DELETE")
+        print("Before (connect per call, rollback journal):")
+        before = [
+            _measure("save_fragment", lambda i: _naive_save_fragment(naive_path, i), iterations),
+            _measure("verify_fragment", lambda i: _naive_verify_fragment(naive_path, i), iterations),
+            _measure("get_active_seeds", lambda i: _naive_get_active_seeds(naive_path, i), iterations),
+        ]
+
+        # Pooled connection with WAL and tuned pragmas
+        database.DB_PATH = pooled_path
+        database.init_db()
+        print("After (pooled connection, WAL):")
+        after = [
+            _measure("save_fragment", lambda i: database.save_fragment("bench", "Childhood", f"Memory {i}", "ctx"), iterations),
+            _measure("verify_fragment", lambda i: database.verify_fragment(i), iterations),
+            _measure("get_active_seeds", lambda i: database.get_active_seeds(), iterations),
+        ]
+        database.close_connections()
+
+        for name, b, a in zip(["save_fragment", "verify_fragment", "get_active_seeds"], before, after):
+            print(f"  {name:<22} {a / b:>9.1f}x")
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
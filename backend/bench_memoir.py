@@ -0,0 +1,75 @@
+"""
+Peak memory and wall time of memoir PDF generation at archive scale.
+
+"materialized" is the previous path: every fragment loaded into a list and full-size
+illustrations embedded. "streaming" lays out straight from a database cursor with
+downscaled, cached illustrations. Each run happens in a fresh subprocess so ru_maxrss
+is that run's peak.
+
+Usage: python bench_memoir.py [n_fragments ...]
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+CATEGORIES = ["Childhood", "Family", "Career", "Travel", "Places", "Friends", "Hobbies", "Wisdom"]
+
+def seed(db_path, image_dir, n):
+    import numpy as np
+    from PIL import Image
+    import database
+
+    database.DB_PATH = db_path
+    database.init_db()
+    rng = np.random.default_rng(0)
+    rows = [(CATEGORIES[i % len(CATEGORIES)], f"Memory {i}: " + "we walked along the harbour and talked about the old days. " * 4, f"Session {i // 40}", None) for i in range(n)]
+    for start in range(0, n, 1000):
+        ids = database.save_fragments("bench", rows[start:start + 1000])
+        with database._cursor() as cursor:
+            cursor.executemany("UPDATE fragments SET is_verified = 1 WHERE id = ?", [(fid,) for fid in ids])
+    # Imagen returns 1024x1024 PNGs; noise keeps them at realistic compressed sizes
+    images = {}
+    for cat in CATEGORIES:
+        path = os.path.join(image_dir, f"{cat}.png")
+        if not os.path.exists(path):
+            Image.fromarray(rng.integers(0, 255, (1024, 1024, 3), dtype=np.uint8)).save(path)
+        images[cat] = path
+    return images
+
+def run(mode, db_path, image_dir, out_dir):
+    import database
+    from memoir_generator import MemoirGenerator
+
+    database.DB_PATH = db_path
+    images = {cat: os.path.join(image_dir, f"{cat}.png") for cat in CATEGORIES}
+    gen = MemoirGenerator(out_dir)
+    start = time.perf_counter()
+    if mode == "materialized":
+        gen.prepare_image = lambda path: path
+        fragments = database.get_all_fragments(verified_only=True)
+        path = gen.generate("Bench User", fragments, images=images)
+    else:
+        path = gen.generate("Bench User", database.iter_fragments(verified_only=True), images=images, grouped=True)
+    elapsed = time.perf_counter() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{elapsed:.2f} {peak_mb:.0f} {os.path.getsize(path) / 1e6:.1f}")
+
+def main(sizes):
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            db_path = os.path.join(tmp, f"bench_{n}.db")
+            seed(db_path, tmp, n)
+            print(f"\nN={n} fragments, {len(CATEGORIES)} illustrations")
+            for mode in ("materialized", "streaming"):
+                out = subprocess.run([sys.executable, __file__, "--run", mode, db_path, tmp, os.path.join(tmp, mode)],
+                                     capture_output=True, text=True, check=True).stdout.split()
+                print(f"  {mode:<13} wall={out[0]}s  peak_rss={out[1]}MB  pdf={out[2]}MB")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--run"]:
+        run(*sys.argv[2:6])
+    else:
+        main([int(arg) for arg in sys.argv[1:]] or [1000, 10000])
@@ -0,0 +1,48 @@
+"""
+Per-request cost of getting a ready-to-call chat model.
+
+"per-request" is the previous path: a GenerativeModel built for each turn with that turn's
+system instruction, which creates its own prediction client and gRPC channel on first use.
+"registry" binds the instruction to the pooled model and reuses its client. Runs offline
+with anonymous credentials, so the TLS handshake and the first round trip on each new
+channel (tens of milliseconds against Vertex AI) are not included; real savings are larger.
+
+Usage: python bench_model_registry.py [n_requests]
+"""
+import asyncio
+import sys
+import time
+
+import vertexai
+from google.auth.credentials import AnonymousCredentials
+from vertexai.generative_models import GenerativeModel
+
+import config
+import model_registry
+
+SYSTEM = "You are Memoria, a deeply empathetic and patient AI biographer. Memories: {i}"
+
+async def per_request(n):
+    for i in range(n):
+        model = GenerativeModel(config.CHAT_MODEL, system_instruction=[SYSTEM.format(i=i)])
+        model._prediction_async_client
+        model._prepare_request(contents="Hello")
+
+async def registry(n):
+    pool = model_registry.get_model_registry()
+    for i in range(n):
+        model = pool.bind(config.CHAT_MODEL, [SYSTEM.format(i=i)])
+        model._prediction_async_client
+        model._prepare_request(contents="Hello")
+
+def main(n):
+    vertexai.init(project="bench-project", location=config.LOCATION, credentials=AnonymousCredentials())
+    for name, fn in (("per-request", per_request), ("registry", registry)):
+        start = time.perf_counter()
+        asyncio.run(fn(n))
+        elapsed = time.perf_counter() - start
+        print(f"{name:<12} {elapsed / n * 1e3:8.3f} ms/request  ({n} requests)")
+    print(model_registry.get_model_registry().stats())
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,47 @@
+"""
+Storage size and recall impact of quantized fragment embeddings.
+
+Compares float32 against float16, int8 and Matryoshka-style truncation using the synthetic
+768-dim embeddings from bench_ann. Recall is measured against exact float32 search. Only storage shrinks: the resident
+index dequantizes every row to float32, so its memory and search time are unchanged.
+The synthetic vectors spread information evenly over all dimensions, so the truncated rows
+are a worst case; real text-embedding-004 vectors front-load it.
+
+Usage: python bench_quantization.py [n_vectors]
+"""
+import sys
+import time
+
+import numpy as np
+
+import quantization
+from bench_ann import QUERIES, TOP_K, synthetic_embeddings
+from vector_index import EmbeddingIndex
+
+VARIANTS = [("float32", 0), ("float16", 0), ("int8", 0), ("float16", 256), ("int8", 256), ("int8", 128)]
+
+def search_all(index, queries, dim):
+    return [[fid for fid, _ in index.search(quantization.truncate(q, dim), TOP_K)] for q in queries]
+
+def run(n):
+    data = synthetic_embeddings(n + QUERIES)
+    vectors, queries = data[:n], data[n:]
+    exact = EmbeddingIndex()
+    exact.build(list(enumerate(vectors)))
+    truth = search_all(exact, queries, 0)
+    print(f"N={n}, {QUERIES} queries, recall@{TOP_K} against float32")
+
+    for dtype, dim in VARIANTS:
+        start = time.perf_counter()
+        stored = [quantization.quantize(v, dtype, dim) for v in vectors]
+        encode_s = time.perf_counter() - start
+        size = sum(len(blob) for _, _, _, blob in stored)
+        index = EmbeddingIndex()
+        index.build([(i, quantization.dequantize(*row)) for i, row in enumerate(stored)])
+        found = search_all(index, queries, dim)
+        recall = np.mean([len(set(f) & set(t)) / TOP_K for f, t in zip(found, truth)])
+        print(f"  {dtype:<8} dim={dim or 768:<4} {size / n:7.0f} B/vector ({vectors.nbytes / size:4.1f}x smaller)  "
+              f"recall={recall:.3f}  encode={encode_s * 1e6 / n:5.1f}us/vector")
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,98 @@
+"""
+Latency of the local sentiment classifier, and how often it agrees with the LLM it replaced.
+
+"local" is the lexicon classifier (what /chat/completions uses), "llm" one FAST_MODEL call
+per turn. Agreement is measured against the hand labels below and, when GOOGLE_CLOUD_PROJECT
+is set, against the LLM's own answers; without it the LLM column is skipped. The LLM
+figures decide SENTIMENT_LLM_FALLBACK: its round trip has to fit SENTIMENT_FALLBACK_TIMEOUT
+and it has to beat the lexicon on the unsure turns.
+
+Usage: python bench_sentiment.py [repeats]
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+import config
+import sentiment_service
+
+# Interview turns in the style the biographer hears, with the label a reader would give
+TURNS = [
+    ("My husband passed away three years ago and the house is so quiet now.", "sad"),
+    ("I still miss my mother every single day.", "sad"),
+    ("We lost our first baby, it broke my heart.", "sad"),
+    ("During the war we were always hungry and afraid.", "sad"),
+    ("After the divorce I was very lonely for a long time.", "sad"),
+    ("My brother died in a car accident when he was only nineteen.", "sad"),
+    ("I cried for days when they sold the farm.", "sad"),
+    ("The doctors said it was cancer, and that was that.", "sad"),
+    ("I wasn't happy at that school, the teachers were strict.", "sad"),
+    ("Nobody came to visit me in the hospital.", "sad"),
+    ("It was a beautiful funeral, everyone sang.", "sad"),
+    ("I regret not telling him I loved him.", "sad"),
+    ("Our wedding day was the happiest day of my life.", "positive"),
+    ("We had wonderful summers at the lake with the children.", "positive"),
+    ("I was so proud when my daughter graduated.", "positive"),
+    ("We laughed so much that night, I'll never forget it.", "positive"),
+    ("I fell in love with him at a dance in 1958.", "positive"),
+    ("Those were the best years, we travelled everywhere.", "positive"),
+    ("I loved working in the garden, it gave me such joy.", "positive"),
+    ("It was hard work but we were happy.", "positive"),
+    ("My grandchildren are my greatest blessing.", "positive"),
+    ("The trip to Italy was an amazing adventure.", "positive"),
+    ("I worked at the shipyard from 1955 until I retired.", "neutral"),
+    ("We lived on Nørregade, the third house from the corner.", "neutral"),
+    ("My father was a carpenter and my mother kept the shop.", "neutral"),
+    ("We moved to Odense in the spring of 1962.", "neutral"),
+    ("I had two brothers and a sister.", "neutral"),
+    ("The school was about two kilometres from our house.", "neutral"),
+    ("We usually ate dinner at six.", "neutral"),
+    ("He drove a blue Volkswagen for twenty years.", "neutral"),
+    ("I studied bookkeeping at evening classes.", "neutral"),
+    ("Yes, that was in Aarhus.", "neutral"),
+]
+
+def timed(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for text, _ in TURNS:
+            fn(text)
+    return (time.perf_counter() - start) / (repeats * len(TURNS))
+
+def agreement(labels, reference):
+    return sum(a == b for a, b in zip(labels, reference)) / len(reference)
+
+async def llm_run():
+    service = sentiment_service.SentimentService()
+    labels, latencies = [], []
+    for text, _ in TURNS:
+        start = time.perf_counter()
+        labels.append(await service.llm_label(text))
+        latencies.append(time.perf_counter() - start)
+    return labels, latencies
+
+def main(repeats):
+    hand = [label for _, label in TURNS]
+    local = [sentiment_service.classify(text)[0] for text, _ in TURNS]
+    per_turn = timed(sentiment_service.classify, repeats)
+    confident = sum(sentiment_service.classify(text)[1] >= sentiment_service.SENTIMENT_MIN_CONFIDENCE for text, _ in TURNS)
+    print(f"local    {per_turn * 1e6:8.1f} us/turn  agreement with hand labels {agreement(local, hand):.0%}  "
+          f"confident on {confident}/{len(TURNS)} turns")
+
+    if not config.PROJECT_ID:
+        print("llm      skipped (GOOGLE_CLOUD_PROJECT not set)")
+        return
+    import vertexai
+    vertexai.init(project=config.PROJECT_ID, location=config.LOCATION)
+    llm, latencies = asyncio.run(llm_run())
+    unsure = [i for i, (text, _) in enumerate(TURNS) if sentiment_service.classify(text)[1] < sentiment_service.SENTIMENT_MIN_CONFIDENCE]
+    print(f"llm      {statistics.mean(latencies) * 1e3:8.1f} ms/turn  (p50 {statistics.median(latencies) * 1e3:.1f} ms, "
+          f"max {max(latencies) * 1e3:.1f} ms)  agreement with hand labels {agreement(llm, hand):.0%}")
+    print(f"agreement with llm: local {agreement(local, llm):.0%}; "
+          f"{sum(t <= sentiment_service.SENTIMENT_FALLBACK_TIMEOUT for t in latencies)}/{len(latencies)} calls within SENTIMENT_FALLBACK_TIMEOUT")
+    if unsure:
+        print(f"agreement with llm on the {len(unsure)} unsure turns: {agreement([local[i] for i in unsure], [llm[i] for i in unsure]):.0%}")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
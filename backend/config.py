@@ -0,0 +1,18 @@
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# Google Cloud
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
+LOCATION = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
+
+# Model IDs. Every Vertex AI model the backend calls is named here.
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gemini-2.0-flash-exp")  # Only model available in this project
+# Memory extraction runs on the chat model
+EXTRACTION_MODEL = os.getenv("EXTRACTION_MODEL", CHAT_MODEL)
+# Short, cheap calls: per-turn sentiment and narrative synthesis
+FAST_MODEL = os.getenv("FAST_MODEL", "gemini-1.5-flash")
+VISION_MODEL = os.getenv("VISION_MODEL", "gemini-1.5-flash")
+IMAGEN_MODEL = os.getenv("IMAGEN_MODEL", "imagen-3.0-generate-001")  # Latest Imagen 3 model
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-004")
@@ -0,0 +1,231 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from vertexai.generative_models import Content
+
+import model_registry
+import prompt_budget
+import session_cache
+from async_utils import run_blocking
+
+# "vertex" uses Vertex AI context caching, "local" an in-process stand-in with the same
+# behaviour (no billing effect; for offline runs and tests), "off" disables it. Off by
+# default: with a cached prefix the per-turn context moves into the user message, which
+# changes the prompts the chat model sees
+CONTEXT_CACHE_BACKEND = os.environ.get("CONTEXT_CACHE_BACKEND", "off").lower()
+# Vertex AI only caches prefixes of at least this many tokens (32k for Gemini 1.5 models)
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("CONTEXT_CACHE_MIN_TOKENS", 32768))
+# Cached content is immutable; once this many tokens have piled up after the cached prefix,
+# the prefix is rebuilt to include them
+CONTEXT_CACHE_REBUILD_TOKENS = int(os.environ.get("CONTEXT_CACHE_REBUILD_TOKENS", 8192))
+CONTEXT_CACHE_TTL = float(os.environ.get("CONTEXT_CACHE_TTL", 1800))
+# After a failed create, prefixes for that model and instruction aren't attempted again for
+# this long, doubling with each further failure up to CONTEXT_CACHE_MAX_BACKOFF; a model or
+# region without context caching would otherwise pay for a failing call on every miss
+CONTEXT_CACHE_BACKOFF = float(os.environ.get("CONTEXT_CACHE_BACKOFF", 60))
+CONTEXT_CACHE_MAX_BACKOFF = float(os.environ.get("CONTEXT_CACHE_MAX_BACKOFF", 3600))
+
+TURN_CONTEXT_TEMPLATE = "[Context for this turn, not said by the user:{context}]\n\n{message}"
+
+def contents_tokens(contents: List[Content]) -> int:
+    return sum(prompt_budget.estimate_tokens(part.text) for content in contents for part in content.parts)
+
+def contents_digest(contents: List[Content]) -> str:
+    return hashlib.sha256(json.dumps([[content.role, [part.text for part in content.parts]] for content in contents]).encode("utf-8")).hexdigest()
+
+class CachedPrefix:
+    """
+    A session's registered prefix: the stable system instruction plus the first n_contents
+    history entries, stored under handle by the backend.
+    """
+    def __init__(self, handle, model_name: str, instruction_digest: str, n_contents: int, contents_digest: str, tokens: int):
+        self.handle = handle
+        self.model_name = model_name
+        self.instruction_digest = instruction_digest
+        self.n_contents = n_contents
+        self.contents_digest = contents_digest
+        self.tokens = tokens
+        self.expires_at = time.time() + CONTEXT_CACHE_TTL
+
+    def covers(self, model_name: str, instruction_digest: str, history: List[Content]) -> bool:
+        return (
+            self.model_name == model_name
+            and self.instruction_digest == instruction_digest
+            and time.time() < self.expires_at - 60  # don't start a turn on a prefix about to expire
+            and len(history) >= self.n_contents
+            and contents_digest(history[:self.n_contents]) == self.contents_digest
+        )
+
+class VertexContextBackend:
+    def create(self, model_name: str, system_instruction: str, contents: List[Content]):
+        from vertexai.caching import CachedContent
+        return CachedContent.create(
+            model_name=model_name,
+            system_instruction=system_instruction,
+            contents=contents,
+            ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL),
+        )
+
+    def model_and_history(self, prefix: CachedPrefix, suffix: List[Content]):
+        return model_registry.get_model_registry().with_cached_content(prefix.model_name, prefix.handle), suffix
+
+    def delete(self, handle):
+        handle.delete()
+
+class LocalContextBackend:
+    """
+    Offline stand-in for Vertex AI context caching: keeps the prefix in memory and sends it
+    in full with each request, so the session logic can run and be tested without the API.
+    """
+    def create(self, model_name: str, system_instruction: str, contents: List[Content]):
+        return (system_instruction, list(contents))
+
+    def model_and_history(self, prefix: CachedPrefix, suffix: List[Content]):
+        system_instruction, contents = prefix.handle
+        return model_registry.get_model_registry().bind(prefix.model_name, [system_instruction]), contents + suffix
+
+    def delete(self, handle):
+        pass
+
+class ContextCache:
+    """
+    Registers each session's stable prompt prefix (persona instruction and earlier turns)
+    once and reuses it by handle on later turns, so long interviews stop re-sending it.
+    Per-turn context (retrieved memories, seeds, sentiment) travels with the user's message
+    instead. The prefix is rebuilt when the instruction changes or enough uncached turns
+    pile up after it.
+    """
+    def __init__(self, backend, min_tokens: int = CONTEXT_CACHE_MIN_TOKENS, rebuild_tokens: int = CONTEXT_CACHE_REBUILD_TOKENS):
+        self.backend = backend
+        self.min_tokens = min_tokens
+        self.rebuild_tokens = rebuild_tokens
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.failed = 0
+        self.deleted = 0
+        self.tokens_reused = 0
+        self._building = set()
+        self._failures: Dict[Tuple[str, str], Tuple[int, float]] = {}  # (model, digest) -> (failures, retry_at)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    async def prepare(self, context, model_name: str, stable_instruction: str, turn_context: str, history: List[Content], message: str) -> Tuple[object, List[Content], str]:
+        """
+        Returns (model, history, message) for one chat turn. With a usable cached prefix the
+        history is only what follows it and the turn context is prepended to the message;
+        otherwise the model gets the full system instruction, as without caching. Building a
+        missing or stale prefix happens in the background, for the following turns.
+        """
+        digest = hashlib.sha256(stable_instruction.encode("utf-8")).hexdigest()
+        prefix: Optional[CachedPrefix] = getattr(context, "context_cache", None)
+        if prefix is not None and prefix.covers(model_name, digest, history):
+            suffix = history[prefix.n_contents:]
+            if contents_tokens(suffix) > self.rebuild_tokens:
+                self._build(context, model_name, stable_instruction, digest, history)
+            with self._lock:
+                self.hits += 1
+                self.tokens_reused += prefix.tokens
+            model, history = self.backend.model_and_history(prefix, suffix)
+            if turn_context:
+                message = TURN_CONTEXT_TEMPLATE.format(context=turn_context, message=message)
+            return model, history, message
+
+        with self._lock:
+            self.misses += 1
+        if prompt_budget.estimate_tokens(stable_instruction) + contents_tokens(history) >= self.min_tokens:
+            self._build(context, model_name, stable_instruction, digest, history)
+        return model_registry.get_model_registry().bind(model_name, [stable_instruction + turn_context]), history, message
+
+    def _build(self, context, model_name: str, stable_instruction: str, digest: str, history: List[Content]):
+        with self._lock:
+            failure = self._failures.get((model_name, digest))
+            if context.session_id in self._building or (failure and time.time() < failure[1]):
+                return
+            self._building.add(context.session_id)
+        context.context_cache_task = asyncio.create_task(self._create(context, model_name, stable_instruction, digest, list(history)))
+
+    async def _create(self, context, model_name: str, stable_instruction: str, digest: str, history: List[Content]):
+        try:
+            try:
+                handle = await run_blocking(self.backend.create, model_name, stable_instruction, history)
+            except Exception as e:
+                with self._lock:
+                    failures = self._failures.get((model_name, digest), (0, 0.0))[0] + 1
+                    backoff = min(CONTEXT_CACHE_BACKOFF * 2 ** (failures - 1), CONTEXT_CACHE_MAX_BACKOFF)
+                    self._failures[(model_name, digest)] = (failures, time.time() + backoff)
+                    self.failed += 1
+                logging.error(f"Context cache for session {context.session_id} failed, not retrying {model_name} for {backoff:.0f}s: {e}")
+                return
+            with self._lock:
+                self._failures.pop((model_name, digest), None)
+                self.created += 1
+            if getattr(context, "evicted", False):
+                # The session left the cache while the prefix was being created
+                await self._delete(handle)
+                return
+            old = getattr(context, "context_cache", None)
+            context.context_cache = CachedPrefix(handle, model_name, digest, len(history), contents_digest(history),
+                                                 prompt_budget.estimate_tokens(stable_instruction) + contents_tokens(history))
+            if old is not None:
+                await self._delete(old.handle)
+        except Exception as e:
+            logging.error(f"Context cache for session {context.session_id} failed: {e}")
+        finally:
+            with self._lock:
+                self._building.discard(context.session_id)
+
+    async def _delete(self, handle):
+        try:
+            await run_blocking(self.backend.delete, handle)
+            with self._lock:
+                self.deleted += 1
+        except Exception as e:
+            logging.error(f"Failed to delete context cache: {e}")
+
+    def release(self, context):
+        """
+        Session eviction listener: deletes the session's prefix instead of leaving it to expire.
+        """
+        prefix = getattr(context, "context_cache", None)
+        if prefix is None:
+            return
+        context.context_cache = None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self._delete(prefix.handle))
+            return
+        task = loop.create_task(self._delete(prefix.handle))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def stats(self) -> dict:
+        turns = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / turns, 4) if turns else 0.0,
+            "created": self.created,
+            "failed": self.failed,
+            "deleted": self.deleted,
+            "tokens_reused": self.tokens_reused,
+        }
+
+_context_cache_instance = None
+
+def get_context_cache() -> Optional[ContextCache]:
+    global _context_cache_instance
+    if _context_cache_instance is None and CONTEXT_CACHE_BACKEND in ("vertex", "local"):
+        backend = VertexContextBackend() if CONTEXT_CACHE_BACKEND == "vertex" else LocalContextBackend()
+        _context_cache_instance = ContextCache(backend)
+        session_cache.get_session_cache().add_eviction_listener(_context_cache_instance.release)
+    return _context_cache_instance
@@ -1,187 +1,947 @@
 import sqlite3
 import os
+import re
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
 
+import quantization
+
 # Check if running in Cloud Run
 if os.environ.get("K_SERVICE"):
     DB_PATH = "/tmp/memoria.db"
 else:
     DB_PATH = os.path.join(os.path.dirname(__file__), "memoria.db")
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
+# Connection tuning. Connections are kept open per thread and reused across calls.
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", 16384))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_STATEMENT_CACHE = 256
+
+# Set by init_db once the fragments_fts table is in place
+FTS_AVAILABLE = False
+FTS_STOPWORDS = {
+    "the", "and", "or", "of", "to", "in", "on", "at", "for", "with", "about", "from", "was", "were",
+    "is", "are", "it", "that", "this", "my", "me", "we", "our", "you", "your", "he", "she", "they",
+    "his", "her", "their", "do", "did", "have", "had", "tell", "what", "when", "who", "how", "an",
+}
+
+_local = threading.local()
+_connections = set()
+_connections_lock = threading.Lock()
+
+def _configure_connection(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA busy_timeout=5000")
+
+def get_connection():
+    """
+    Returns this thread's connection to DB_PATH, opening and tuning it on first use.
+    sqlite3 keeps a per-connection cache of prepared statements, so reusing the
+    connection also reuses the compiled SQL of every query below.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.path == DB_PATH and conn in _connections:
+        return conn
+    if conn is not None:
+        # Either DB_PATH changed or close_connections() ran on another thread
+        _close(conn)
+    conn = sqlite3.connect(DB_PATH, cached_statements=SQLITE_STATEMENT_CACHE, check_same_thread=False)
+    _configure_connection(conn)
+    _local.conn, _local.path = conn, DB_PATH
+    with _connections_lock:
+        _connections.add(conn)
+    return conn
+
+def _close(conn):
+    with _connections_lock:
+        _connections.discard(conn)
+    try:
+        conn.close()
+    except sqlite3.Error as e:
+        logging.warning(f"Failed to close database connection: {e}")
+
+def close_connections():
+    """
+    Closes every pooled connection, e.g. on shutdown or after switching DB_PATH in tests.
+    """
+    with _connections_lock:
+        connections = list(_connections)
+    for conn in connections:
+        _close(conn)
+    _local.conn = None
+
+@contextmanager
+def _cursor():
+    """
+    Yields a cursor on the pooled connection and commits on success, rolling back on error.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
-    
-    # Tables for sessions, fragments, and summaries
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sessions (
-            id TEXT PRIMARY KEY,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS fragments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT,
-            category TEXT,
-            content TEXT,
-            context TEXT,
-            audio_url TEXT,
-            image_url TEXT,
-            embedding BLOB,
-            is_verified BOOLEAN DEFAULT 0,
-            FOREIGN KEY (session_id) REFERENCES sessions(id)
-        )
-    """)
-    
+    try:
+        yield cursor
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# What listeners learn about a changed fragment row, so they don't have to query it back:
+# is_verified as stored, embedding the stored (dequantized) vector or None if it has none,
+# deleted True once the row is gone.
+FragmentChange = namedtuple("FragmentChange", "fragment_id is_verified embedding deleted", defaults=(None, False))
+
+# Callbacks invoked with a list of FragmentChange after each write that changes fragments.
+_fragment_listeners = []
+
+def add_fragment_listener(callback):
+    """
+    Registers callback(changes) to be called once per write that inserts, updates or
+    deletes fragments, with one FragmentChange per affected fragment.
+    """
+    if callback not in _fragment_listeners:
+        _fragment_listeners.append(callback)
+
+def remove_fragment_listener(callback):
+    if callback in _fragment_listeners:
+        _fragment_listeners.remove(callback)
+
+def _notify_fragments_changed(changes):
+    if not changes:
+        return
+    for callback in list(_fragment_listeners):
+        try:
+            callback(changes)
+        except Exception as e:
+            logging.error(f"Fragment listener failed for fragments {[c.fragment_id for c in changes]}: {e}")
+
+# Callbacks invoked with no arguments whenever memory seeds change.
+_seed_listeners = []
+
+def add_seed_listener(callback):
+    if callback not in _seed_listeners:
+        _seed_listeners.append(callback)
+
+def remove_seed_listener(callback):
+    if callback in _seed_listeners:
+        _seed_listeners.remove(callback)
+
+def _notify_seeds_changed():
+    for callback in list(_seed_listeners):
+        try:
+            callback()
+        except Exception as e:
+            logging.error(f"Seed listener failed: {e}")
+
+def content_hash(content):
+    """
+    Hash of a fragment's normalized content, used to detect re-extracted duplicates.
+    """
+    normalized = re.sub(r"\s+", " ", (content or "").strip().lower())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+def init_db():
+    with _cursor() as cursor:
+        # Tables for sessions, fragments, and summaries
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS fragments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                category TEXT,
+                content TEXT,
+                context TEXT,
+                audio_url TEXT,
+                image_url TEXT,
+                embedding BLOB,
+                is_verified BOOLEAN DEFAULT 0,
+                FOREIGN KEY (session_id) REFERENCES sessions(id)
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS summaries (
+                session_id TEXT PRIMARY KEY,
+                content TEXT,
+                FOREIGN KEY (session_id) REFERENCES sessions(id)
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS synthesized_narrative (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Rows with a chapter are per-chapter versions (see synthesis_service.py); the
+        # stitched biography is stored with chapter NULL
+        cursor.execute("PRAGMA table_info(synthesized_narrative)")
+        narrative_columns = [col[1] for col in cursor.fetchall()]
+        if "chapter" not in narrative_columns:
+            cursor.execute("ALTER TABLE synthesized_narrative ADD COLUMN chapter TEXT")
+        if "fragments_hash" not in narrative_columns:
+            cursor.execute("ALTER TABLE synthesized_narrative ADD COLUMN fragments_hash TEXT")
+        # JSON [[title, text], ...] of a stitched biography, so layouts can style the chapter titles
+        if "chapters" not in narrative_columns:
+            cursor.execute("ALTER TABLE synthesized_narrative ADD COLUMN chapters TEXT")
+        if "version" not in narrative_columns:
+            cursor.execute("ALTER TABLE synthesized_narrative ADD COLUMN version INTEGER DEFAULT 1")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_narrative_chapter ON synthesized_narrative (chapter, fragments_hash)")
+        # Partial chapter text checkpointed while it streams, so an interrupted synthesis resumes
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS narrative_drafts (
+                chapter TEXT,
+                fragments_hash TEXT,
+                content TEXT,
+                updated_at REAL,
+                PRIMARY KEY (chapter, fragments_hash)
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS memory_seeds (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT,
+                is_used BOOLEAN DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                embedding BLOB,
+                created_at REAL
+            )
+        """)
+
+        # Embeddings live outside the fragments row, quantized (see quantization.py)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS fragment_embeddings (
+                fragment_id INTEGER PRIMARY KEY,
+                model TEXT,
+                dim INTEGER,
+                dtype TEXT,
+                scale REAL,
+                vector BLOB,
+                FOREIGN KEY (fragment_id) REFERENCES fragments(id)
+            )
+        """)
+
+        # Vision descriptions keyed by perceptual hash (see vision_service.py)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS vision_descriptions (
+                model TEXT,
+                dhash INTEGER,
+                description TEXT,
+                created_at REAL,
+                PRIMARY KEY (model, dhash)
+            )
+        """)
+
+        # Turns the local sentiment classifier was unsure about, kept for labelling (see sentiment_service.py)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sentiment_samples (
+                text TEXT PRIMARY KEY,
+                label TEXT,
+                confidence REAL,
+                created_at REAL
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                id TEXT PRIMARY KEY,
+                kind TEXT,
+                filename TEXT,
+                size INTEGER,
+                received INTEGER DEFAULT 0,
+                meta TEXT,
+                created_at REAL,
+                updated_at REAL
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT,
+                dedupe_key TEXT,
+                payload TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                created_at REAL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)")
+        cursor.execute("PRAGMA table_info(jobs)")
+        job_columns = [col[1] for col in cursor.fetchall()]
+        if "stage" not in job_columns:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN stage TEXT")
+        if "result" not in job_columns:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN result TEXT")
+
+        # Migration: Add columns if they don't exist
+        cursor.execute("PRAGMA table_info(fragments)")
+        columns = [col[1] for col in cursor.fetchall()]
+        if "embedding" not in columns:
+            cursor.execute("ALTER TABLE fragments ADD COLUMN embedding BLOB")
+        if "is_verified" not in columns:
+            cursor.execute("ALTER TABLE fragments ADD COLUMN is_verified BOOLEAN DEFAULT 0")
+        if "audio_url" not in columns:
+            cursor.execute("ALTER TABLE fragments ADD COLUMN audio_url TEXT")
+        if "image_url" not in columns:
+            cursor.execute("ALTER TABLE fragments ADD COLUMN image_url TEXT")
+        if "content_hash" not in columns:
+            cursor.execute("ALTER TABLE fragments ADD COLUMN content_hash TEXT")
+            cursor.execute("SELECT id, content FROM fragments")
+            cursor.executemany("UPDATE fragments SET content_hash = ? WHERE id = ?", [(content_hash(content), fid) for fid, content in cursor.fetchall()])
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fragments_content_hash ON fragments (content_hash)")
+        # Listing filters on is_verified (and session/category); keyset pages walk (is_verified, id)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fragments_verified ON fragments (is_verified, session_id, category)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fragments_verified_id ON fragments (is_verified, id)")
+
+        # Migration: move inline float32 embeddings into fragment_embeddings
+        cursor.execute("SELECT id, embedding FROM fragments WHERE embedding IS NOT NULL")
+        inline = cursor.fetchall()
+        if inline:
+            _store_embeddings(cursor, inline)
+            cursor.execute("UPDATE fragments SET embedding = NULL WHERE embedding IS NOT NULL")
+            logging.info(f"Moved {len(inline)} inline embeddings to fragment_embeddings")
+
+        cursor.execute("PRAGMA table_info(sessions)")
+        session_columns = [col[1] for col in cursor.fetchall()]
+        if "extracted_turns" not in session_columns:
+            cursor.execute("ALTER TABLE sessions ADD COLUMN extracted_turns INTEGER DEFAULT 0")
+        if "era" not in session_columns:
+            cursor.execute("ALTER TABLE sessions ADD COLUMN era TEXT")
+
+        _init_fts(cursor)
+
+def _init_fts(cursor):
+    """
+    Full-text index over fragment content/context, kept in sync by triggers.
+    Skipped (lexical search returns nothing) if this SQLite build lacks FTS5.
+    """
+    global FTS_AVAILABLE
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'fragments_fts'")
+    exists = cursor.fetchone() is not None
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS fragments_fts USING fts5(
+                content, context, content='fragments', content_rowid='id',
+                tokenize='porter unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logging.error(f"FTS5 unavailable, lexical retrieval disabled: {e}")
+        FTS_AVAILABLE = False
+        return
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS summaries (
-            session_id TEXT PRIMARY KEY,
-            content TEXT,
-            FOREIGN KEY (session_id) REFERENCES sessions(id)
-        )
+        CREATE TRIGGER IF NOT EXISTS fragments_fts_insert AFTER INSERT ON fragments BEGIN
+            INSERT INTO fragments_fts (rowid, content, context) VALUES (new.id, new.content, new.context);
+        END
     """)
-
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS synthesized_narrative (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            content TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        CREATE TRIGGER IF NOT EXISTS fragments_fts_delete AFTER DELETE ON fragments BEGIN
+            INSERT INTO fragments_fts (fragments_fts, rowid, content, context) VALUES ('delete', old.id, old.content, old.context);
+        END
     """)
-    
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS memory_seeds (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            content TEXT,
-            is_used BOOLEAN DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        CREATE TRIGGER IF NOT EXISTS fragments_fts_update AFTER UPDATE OF content, context ON fragments BEGIN
+            INSERT INTO fragments_fts (fragments_fts, rowid, content, context) VALUES ('delete', old.id, old.content, old.context);
+            INSERT INTO fragments_fts (rowid, content, context) VALUES (new.id, new.content, new.context);
+        END
     """)
-    
-    # Migration: Add columns if they don't exist
-    cursor.execute("PRAGMA table_info(fragments)")
-    columns = [col[1] for col in cursor.fetchall()]
-    if "embedding" not in columns:
-        cursor.execute("ALTER TABLE fragments ADD COLUMN embedding BLOB")
-    if "is_verified" not in columns:
-        cursor.execute("ALTER TABLE fragments ADD COLUMN is_verified BOOLEAN DEFAULT 0")
-    if "audio_url" not in columns:
-        cursor.execute("ALTER TABLE fragments ADD COLUMN audio_url TEXT")
-    if "image_url" not in columns:
-        cursor.execute("ALTER TABLE fragments ADD COLUMN image_url TEXT")
-    
-    conn.commit()
-    conn.close()
+    if not exists:
+        cursor.execute("INSERT INTO fragments_fts (fragments_fts) VALUES ('rebuild')")
+    FTS_AVAILABLE = True
 
 def save_session(session_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO sessions (id) VALUES (?)", (session_id,))
-    conn.commit()
-    conn.close()
+    with _cursor() as cursor:
+        cursor.execute("INSERT OR IGNORE INTO sessions (id) VALUES (?)", (session_id,))
 
 def save_fragment(session_id, category, content, context="", embedding=None, audio_url=None, image_url=None):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO fragments (session_id, category, content, context, embedding, audio_url, image_url, is_verified) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, 0)
-    """, (session_id, category, content, context, embedding, audio_url, image_url))
-    conn.commit()
-    conn.close()
+    with _cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO fragments (session_id, category, content, context, audio_url, image_url, is_verified, content_hash) 
+            VALUES (?, ?, ?, ?, ?, ?, 0, ?)
+        """, (session_id, category, content, context, audio_url, image_url, content_hash(content)))
+        fragment_id = cursor.lastrowid
+        vectors = _store_embeddings(cursor, [(fragment_id, embedding)])
+    _notify_fragments_changed([FragmentChange(fragment_id, 0, vectors.get(fragment_id))])
+    return fragment_id
+
+def _store_embeddings(cursor, rows):
+    """
+    Quantizes and upserts (fragment_id, embedding) pairs; embedding is a float32 blob or a
+    list of floats. Rows without an embedding are skipped. Returns {fragment_id: vector}
+    with the vectors as they will read back, for the change notification.
+    """
+    records = [(fid, quantization.EMBEDDING_MODEL, *quantization.quantize(emb)) for fid, emb in rows if emb is not None]
+    if records:
+        cursor.executemany("""
+            INSERT OR REPLACE INTO fragment_embeddings (fragment_id, model, dtype, dim, scale, vector)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, records)
+    return {fid: quantization.dequantize(*record) for fid, _, *record in records}
+
+def _insert_fragments(cursor, session_id, fragments):
+    cursor.executemany("""
+        INSERT INTO fragments (session_id, category, content, context, is_verified, content_hash)
+        VALUES (?, ?, ?, ?, 0, ?)
+    """, [(session_id, category, content, context, content_hash(content)) for category, content, context, _ in fragments])
+    # SQLite has a single writer, so ids inside this transaction are contiguous
+    cursor.execute("SELECT last_insert_rowid()")
+    last_id = cursor.fetchone()[0]
+    fragment_ids = list(range(last_id - len(fragments) + 1, last_id + 1))
+    vectors = _store_embeddings(cursor, [(fid, frag[3]) for fid, frag in zip(fragment_ids, fragments)])
+    return fragment_ids, [FragmentChange(fid, 0, vectors.get(fid)) for fid in fragment_ids]
+
+def save_fragments(session_id, fragments):
+    """
+    Inserts many fragments in a single transaction.
+    fragments: List of (category, content, context, embedding)
+    Returns the new fragment ids in insertion order.
+    """
+    if not fragments:
+        return []
+    with _cursor() as cursor:
+        fragment_ids, changes = _insert_fragments(cursor, session_id, fragments)
+    _notify_fragments_changed(changes)
+    return fragment_ids
+
+def get_existing_content_hashes(hashes):
+    """
+    Returns the subset of the given content hashes that are already stored.
+    """
+    if not hashes:
+        return set()
+    hashes = list(hashes)
+    with _cursor() as cursor:
+        placeholders = ",".join("?" * len(hashes))
+        cursor.execute(f"SELECT DISTINCT content_hash FROM fragments WHERE content_hash IN ({placeholders})", hashes)
+        return {row[0] for row in cursor.fetchall()}
+
+def get_extraction_state(session_id):
+    """
+    Returns (extracted_turns, rolling_summary) for a session.
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT extracted_turns FROM sessions WHERE id = ?", (session_id,))
+        row = cursor.fetchone()
+        cursor.execute("SELECT content FROM summaries WHERE session_id = ?", (session_id,))
+        summary = cursor.fetchone()
+    return (row[0] or 0) if row else 0, summary[0] if summary else ""
+
+def save_extraction_result(session_id, fragments, summary, extracted_turns, era=None, restarted=False):
+    """
+    Atomically stores newly extracted fragments (skipping ones already stored), the
+    session's rolling summary, detected era and extraction watermark. Returns the new fragment ids.
+    fragments: List of (category, content, context, embedding)
+    The watermark only moves forward: a job that finishes after a newer one covered its
+    turns stores nothing. restarted resets it for a conversation that started over.
+    """
+    with _cursor() as cursor:
+        # The insert opens the write transaction, so the watermark read below can't go stale
+        cursor.execute("INSERT OR IGNORE INTO sessions (id) VALUES (?)", (session_id,))
+        cursor.execute("SELECT COALESCE(extracted_turns, 0) FROM sessions WHERE id = ?", (session_id,))
+        previous = cursor.fetchone()[0]
+        if not restarted and extracted_turns <= previous:
+            return []
+        if restarted:
+            cursor.execute("UPDATE sessions SET extracted_turns = ?, era = COALESCE(?, era) WHERE id = ?", (extracted_turns, era, session_id))
+        else:
+            cursor.execute("UPDATE sessions SET extracted_turns = MAX(COALESCE(extracted_turns, 0), ?), era = COALESCE(?, era) WHERE id = ?", (extracted_turns, era, session_id))
+        if summary:
+            cursor.execute("INSERT OR REPLACE INTO summaries (session_id, content) VALUES (?, ?)", (session_id, summary))
+        new_fragments, seen = [], set()
+        if fragments:
+            hashes = [content_hash(content) for _, content, _, _ in fragments]
+            placeholders = ",".join("?" * len(hashes))
+            cursor.execute(f"SELECT content_hash FROM fragments WHERE content_hash IN ({placeholders})", hashes)
+            seen = {row[0] for row in cursor.fetchall()}
+            for frag, frag_hash in zip(fragments, hashes):
+                if frag_hash not in seen:
+                    seen.add(frag_hash)
+                    new_fragments.append(frag)
+        fragment_ids, changes = _insert_fragments(cursor, session_id, new_fragments) if new_fragments else ([], [])
+    _notify_fragments_changed(changes)
+    return fragment_ids
 
 def save_summary(session_id, content):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT OR REPLACE INTO summaries (session_id, content) 
-        VALUES (?, ?)
-    """, (session_id, content))
-    conn.commit()
-    conn.close()
-
-def get_all_fragments(verified_only=True):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    if verified_only:
-        cursor.execute("SELECT category, content, context, embedding, id, audio_url, image_url FROM fragments WHERE is_verified = 1")
+    with _cursor() as cursor:
+        cursor.execute("""
+            INSERT OR REPLACE INTO summaries (session_id, content) 
+            VALUES (?, ?)
+        """, (session_id, content))
+
+def get_all_fragments(verified_only=True, include_embedding=False):
+    """
+    Returns every fragment as (category, content, context, embedding, id, ...). The embedding
+    is only read when include_embedding is set (as a dequantized float32 blob); otherwise its
+    slot is None.
+    """
+    columns = "f.id, f.audio_url, f.image_url" if verified_only else "f.id, f.is_verified, f.audio_url, f.image_url"
+    query = f"SELECT f.category, f.content, f.context, {columns}"
+    if include_embedding:
+        query += ", e.dtype, e.dim, e.scale, e.vector FROM fragments f LEFT JOIN fragment_embeddings e ON e.fragment_id = f.id"
     else:
-        cursor.execute("SELECT category, content, context, embedding, id, is_verified, audio_url, image_url FROM fragments")
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+        query += " FROM fragments f"
+    if verified_only:
+        query += " WHERE f.is_verified = 1"
+    with _cursor() as cursor:
+        cursor.execute(query)
+        rows = cursor.fetchall()
+    if not include_embedding:
+        return [row[:3] + (None,) + row[3:] for row in rows]
+    result = []
+    for row in rows:
+        vector = quantization.dequantize(*row[-4:])
+        result.append(row[:3] + (vector.tobytes() if vector is not None else None,) + row[3:-4])
+    return result
 
-def get_pending_fragments():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, category, content, context, audio_url, image_url FROM fragments WHERE is_verified = 0")
-    rows = cursor.fetchall()
-    conn.close()
+def iter_fragments(verified_only=True, batch_size=500):
+    """
+    Yields (category, content, context, None, id, audio_url, image_url) rows like
+    get_all_fragments, without materializing them. Rows arrive grouped by category, in
+    the order each category first appeared, so a consumer can emit chapters as it goes.
+    """
+    where = "WHERE is_verified = 1" if verified_only else ""
+    with _cursor() as cursor:
+        cursor.execute(f"""
+            SELECT f.category, f.content, f.context, NULL, f.id, f.audio_url, f.image_url
+            FROM fragments f
+            JOIN (SELECT category, MIN(id) AS first_id FROM fragments {where} GROUP BY category) c
+                ON c.category IS f.category
+            {where.replace("is_verified", "f.is_verified")}
+            ORDER BY c.first_id, f.id
+        """)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+def list_fragments(verified=True, limit=None, after=None):
+    """
+    Returns a page of (id, category, content, context, audio_url, image_url, is_verified) rows
+    ordered by id, without embeddings. verified=None lists every fragment. Pass the last id of
+    the previous page as `after` to continue; each page is an index range scan.
+    """
+    clauses, params = [], []
+    if verified is not None:
+        clauses.append("is_verified = ?")
+        params.append(1 if verified else 0)
+    if after is not None:
+        clauses.append("id > ?")
+        params.append(after)
+    query = "SELECT id, category, content, context, audio_url, image_url, is_verified FROM fragments"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY id"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    with _cursor() as cursor:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
     return rows
 
+def get_pending_fragments(limit=None, after=None):
+    return [row[:6] for row in list_fragments(verified=False, limit=limit, after=after)]
+
+def get_latest_era():
+    """
+    Returns the era detected in the most recently extracted session, or None.
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT era FROM sessions WHERE era IS NOT NULL ORDER BY created_at DESC, rowid DESC LIMIT 1")
+        row = cursor.fetchone()
+    return row[0] if row else None
+
 def verify_fragment(fragment_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE fragments SET is_verified = 1 WHERE id = ?", (fragment_id,))
-    conn.commit()
-    conn.close()
+    with _cursor() as cursor:
+        cursor.execute("UPDATE fragments SET is_verified = 1 WHERE id = ?", (fragment_id,))
+        if cursor.rowcount == 0:
+            return
+        # Newly verified fragments enter the vector index, which needs their embedding
+        cursor.execute("SELECT dtype, dim, scale, vector FROM fragment_embeddings WHERE fragment_id = ?", (fragment_id,))
+        row = cursor.fetchone()
+    _notify_fragments_changed([FragmentChange(fragment_id, 1, quantization.dequantize(*row) if row else None)])
 
 def update_fragment(fragment_id, content, category=None):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    if category:
-        cursor.execute("UPDATE fragments SET content = ?, category = ? WHERE id = ?", (content, category, fragment_id))
-    else:
-        cursor.execute("UPDATE fragments SET content = ? WHERE id = ?", (content, fragment_id))
-    conn.commit()
-    conn.close()
+    """
+    Edits a fragment. Its embedding is computed from "category: content", so if either
+    changes the stored embedding is dropped and the RAG backfill embeds the new text.
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT content, category FROM fragments WHERE id = ?", (fragment_id,))
+        old = cursor.fetchone()
+        if old is None:
+            return
+        if category:
+            cursor.execute("UPDATE fragments SET content = ?, category = ?, content_hash = ? WHERE id = ?", (content, category, content_hash(content), fragment_id))
+        else:
+            cursor.execute("UPDATE fragments SET content = ?, content_hash = ? WHERE id = ?", (content, content_hash(content), fragment_id))
+        if (content, category or old[1]) != tuple(old):
+            cursor.execute("DELETE FROM fragment_embeddings WHERE fragment_id = ?", (fragment_id,))
+        cursor.execute("""
+            SELECT f.is_verified, e.dtype, e.dim, e.scale, e.vector
+            FROM fragments f LEFT JOIN fragment_embeddings e ON e.fragment_id = f.id
+            WHERE f.id = ?
+        """, (fragment_id,))
+        row = cursor.fetchone()
+    _notify_fragments_changed([FragmentChange(fragment_id, row[0], quantization.dequantize(*row[1:]))])
 
 def delete_fragment(fragment_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM fragments WHERE id = ?", (fragment_id,))
-    conn.commit()
-    conn.close()
+    with _cursor() as cursor:
+        cursor.execute("DELETE FROM fragments WHERE id = ? RETURNING is_verified", (fragment_id,))
+        row = cursor.fetchone()
+        cursor.execute("DELETE FROM fragment_embeddings WHERE fragment_id = ?", (fragment_id,))
+    if row:
+        _notify_fragments_changed([FragmentChange(fragment_id, row[0], None, deleted=True)])
+
+def update_fragment_embedding(fragment_id, embedding):
+    with _cursor() as cursor:
+        vectors = _store_embeddings(cursor, [(fragment_id, embedding)])
+        cursor.execute("SELECT is_verified FROM fragments WHERE id = ?", (fragment_id,))
+        row = cursor.fetchone()
+    if row:
+        _notify_fragments_changed([FragmentChange(fragment_id, row[0], vectors.get(fragment_id))])
+
+def get_fragment_embeddings(verified_only=True):
+    """
+    Returns (id, category, content, embedding) rows used to build the in-memory vector index.
+    embedding is a dequantized float32 array, or None if the fragment has not been embedded.
+    """
+    query = """
+        SELECT f.id, f.category, f.content, e.dtype, e.dim, e.scale, e.vector
+        FROM fragments f LEFT JOIN fragment_embeddings e ON e.fragment_id = f.id
+    """
+    with _cursor() as cursor:
+        cursor.execute(query + (" WHERE f.is_verified = 1" if verified_only else ""))
+        rows = cursor.fetchall()
+    return [(fid, cat, content, quantization.dequantize(dtype, dim, scale, blob)) for fid, cat, content, dtype, dim, scale, blob in rows]
+
+def get_fragment_embedding(fragment_id):
+    """
+    Returns (is_verified, embedding) for a single fragment, or None if it no longer exists.
+    """
+    with _cursor() as cursor:
+        cursor.execute("""
+            SELECT f.is_verified, e.dtype, e.dim, e.scale, e.vector
+            FROM fragments f LEFT JOIN fragment_embeddings e ON e.fragment_id = f.id
+            WHERE f.id = ?
+        """, (fragment_id,))
+        row = cursor.fetchone()
+    return (row[0], quantization.dequantize(*row[1:])) if row else None
+
+def fts_query(text, max_terms=16):
+    """
+    Turns free text into an FTS5 query that ORs its quoted terms, so user input can never
+    be parsed as FTS syntax.
+    """
+    terms = []
+    for word in re.findall(r"\w+", (text or "").lower()):
+        if len(word) > 1 and word not in FTS_STOPWORDS and word not in terms:
+            terms.append(word)
+    return " OR ".join(f'"{word}"' for word in terms[:max_terms])
+
+def search_fragments_text(text, limit=20, verified_only=True):
+    """
+    Returns ids of fragments matching text, best BM25 match first.
+    """
+    query = fts_query(text)
+    if not query or not FTS_AVAILABLE:
+        return []
+    sql = """
+        SELECT f.id FROM fragments_fts JOIN fragments f ON f.id = fragments_fts.rowid
+        WHERE fragments_fts MATCH ?
+    """
+    if verified_only:
+        sql += " AND f.is_verified = 1"
+    sql += " ORDER BY bm25(fragments_fts) LIMIT ?"
+    with _cursor() as cursor:
+        cursor.execute(sql, (query, limit))
+        rows = cursor.fetchall()
+    return [row[0] for row in rows]
+
+def get_fragments_by_ids(fragment_ids):
+    """
+    Returns (id, category, content, context) rows for the given ids, in the order requested.
+    """
+    if not fragment_ids:
+        return []
+    with _cursor() as cursor:
+        placeholders = ",".join("?" * len(fragment_ids))
+        cursor.execute(f"SELECT id, category, content, context FROM fragments WHERE id IN ({placeholders})", list(fragment_ids))
+        rows = {row[0]: row for row in cursor.fetchall()}
+    return [rows[fid] for fid in fragment_ids if fid in rows]
 
 def update_fragment_image(fragment_id, image_url):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE fragments SET image_url = ? WHERE id = ?", (image_url, fragment_id))
-    conn.commit()
-    conn.close()
+    with _cursor() as cursor:
+        cursor.execute("UPDATE fragments SET image_url = ? WHERE id = ?", (image_url, fragment_id))
 
 def save_seed(content):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO memory_seeds (content) VALUES (?)", (content,))
-    conn.commit()
-    conn.close()
+    with _cursor() as cursor:
+        cursor.execute("INSERT INTO memory_seeds (content) VALUES (?)", (content,))
+    _notify_seeds_changed()
 
 def get_active_seeds():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, content FROM memory_seeds WHERE is_used = 0")
-    rows = cursor.fetchall()
-    conn.close()
+    with _cursor() as cursor:
+        cursor.execute("SELECT id, content FROM memory_seeds WHERE is_used = 0")
+        rows = cursor.fetchall()
     return rows
 
-def save_synthesized_narrative(content):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO synthesized_narrative (content) VALUES (?)", (content,))
-    conn.commit()
-    conn.close()
+def save_synthesized_narrative(content, chapter=None, fragments_hash=None, chapters=None):
+    """
+    Stores a new version of the biography (chapter None) or of one chapter. Returns the version.
+    chapters: the biography's (title, text) pairs, stored alongside its plain text
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM synthesized_narrative WHERE chapter IS ?", (chapter,))
+        version = cursor.fetchone()[0] + 1
+        cursor.execute("INSERT INTO synthesized_narrative (content, chapter, fragments_hash, version, chapters) VALUES (?, ?, ?, ?, ?)",
+                       (content, chapter, fragments_hash, version, json.dumps(chapters) if chapters else None))
+    return version
 
 def get_latest_synthesized_narrative():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT content FROM synthesized_narrative ORDER BY created_at DESC LIMIT 1")
-    row = cursor.fetchone()
-    conn.close()
+    with _cursor() as cursor:
+        cursor.execute("SELECT content FROM synthesized_narrative WHERE chapter IS NULL ORDER BY id DESC LIMIT 1")
+        row = cursor.fetchone()
     return row[0] if row else None
 
+def get_latest_synthesized_chapters():
+    """
+    Returns (content, chapters) of the latest biography, chapters as [(title, text)] or None
+    for versions stored without them; (None, None) if there is none.
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT content, chapters FROM synthesized_narrative WHERE chapter IS NULL ORDER BY id DESC LIMIT 1")
+        row = cursor.fetchone()
+    if not row:
+        return None, None
+    return row[0], [tuple(chapter) for chapter in json.loads(row[1])] if row[1] else None
+
+def get_chapter_narrative(chapter, fragments_hash):
+    """
+    Returns (content, version) of the latest version of a chapter written from exactly the
+    fragment set with this hash, or None.
+    """
+    with _cursor() as cursor:
+        cursor.execute("""
+            SELECT content, version FROM synthesized_narrative
+            WHERE chapter = ? AND fragments_hash = ?
+            ORDER BY id DESC LIMIT 1
+        """, (chapter, fragments_hash))
+        return cursor.fetchone()
+
+def save_narrative_draft(chapter, fragments_hash, content):
+    with _cursor() as cursor:
+        cursor.execute("INSERT OR REPLACE INTO narrative_drafts (chapter, fragments_hash, content, updated_at) VALUES (?, ?, ?, ?)",
+                       (chapter, fragments_hash, content, time.time()))
+
+def get_narrative_draft(chapter, fragments_hash):
+    with _cursor() as cursor:
+        cursor.execute("SELECT content FROM narrative_drafts WHERE chapter = ? AND fragments_hash = ?", (chapter, fragments_hash))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def delete_narrative_drafts(chapter):
+    """
+    Drops every draft of a chapter, including ones for fragment sets that have since changed.
+    """
+    with _cursor() as cursor:
+        cursor.execute("DELETE FROM narrative_drafts WHERE chapter = ?", (chapter,))
+
+def get_cached_embedding(key, not_before):
+    """
+    Returns (created_at, embedding) for a cache entry newer than not_before, or None.
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT created_at, embedding FROM embedding_cache WHERE key = ? AND created_at >= ?", (key, not_before))
+        row = cursor.fetchone()
+    return row
+
+def save_cached_embeddings(rows):
+    """
+    rows: List of (key, model, embedding_blob, created_at)
+    """
+    with _cursor() as cursor:
+        cursor.executemany("INSERT OR REPLACE INTO embedding_cache (key, model, embedding, created_at) VALUES (?, ?, ?, ?)", rows)
+
+def prune_embedding_cache(older_than):
+    with _cursor() as cursor:
+        cursor.execute("DELETE FROM embedding_cache WHERE created_at < ?", (older_than,))
+
+def _signed64(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def find_vision_description(model, dhash, max_distance=0):
+    """
+    Returns the cached description whose perceptual hash is closest to dhash, if it is
+    within max_distance bits, or None.
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT description FROM vision_descriptions WHERE model = ? AND dhash = ?", (model, _signed64(dhash)))
+        row = cursor.fetchone()
+        if row or not max_distance:
+            return row[0] if row else None
+        cursor.execute("SELECT dhash, description FROM vision_descriptions WHERE model = ?", (model,))
+        best = None
+        for stored, description in cursor:
+            distance = bin((stored & 0xFFFFFFFFFFFFFFFF) ^ dhash).count("1")
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, description)
+    return best[1] if best else None
+
+def save_vision_description(model, dhash, description):
+    with _cursor() as cursor:
+        cursor.execute("INSERT OR REPLACE INTO vision_descriptions (model, dhash, description, created_at) VALUES (?, ?, ?, ?)",
+                       (model, _signed64(dhash), description, time.time()))
+
+def save_sentiment_sample(text, label, confidence):
+    with _cursor() as cursor:
+        cursor.execute("INSERT OR IGNORE INTO sentiment_samples (text, label, confidence, created_at) VALUES (?, ?, ?, ?)",
+                       (text, label, confidence, time.time()))
+
+def prune_sentiment_samples(older_than):
+    with _cursor() as cursor:
+        cursor.execute("DELETE FROM sentiment_samples WHERE created_at < ?", (older_than,))
+
+def list_sentiment_samples(limit=None):
+    """
+    Returns (text, label, confidence) for recorded low-confidence turns, oldest first.
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT text, label, confidence FROM sentiment_samples ORDER BY created_at" + (" LIMIT ?" if limit else ""),
+                       (limit,) if limit else ())
+        return cursor.fetchall()
+
+def enqueue_job(kind, payload, dedupe_key=None):
+    """
+    Persists a pending job. If a pending job with the same dedupe_key exists, its payload
+    is replaced instead. Returns (job_id, created) where created is False when coalesced.
+    """
+    now = time.time()
+    with _cursor() as cursor:
+        if dedupe_key:
+            # One statement, so a worker can't start the job between finding it and updating it
+            cursor.execute("UPDATE jobs SET payload = ? WHERE dedupe_key = ? AND status = 'pending' RETURNING id", (payload, dedupe_key))
+            rows = cursor.fetchall()
+            if rows:
+                return rows[0][0], False
+        cursor.execute("""
+            INSERT INTO jobs (kind, dedupe_key, payload, status, created_at)
+            VALUES (?, ?, ?, 'pending', ?)
+        """, (kind, dedupe_key, payload, now))
+        return cursor.lastrowid, True
+
+def start_job(job_id):
+    """
+    Marks a pending job as running. Returns (kind, payload, created_at, attempts) or None if it is not pending.
+    """
+    with _cursor() as cursor:
+        cursor.execute("""
+            UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1
+            WHERE id = ? AND status = 'pending'
+        """, (time.time(), job_id))
+        if cursor.rowcount == 0:
+            return None
+        cursor.execute("SELECT kind, payload, created_at, attempts FROM jobs WHERE id = ?", (job_id,))
+        return cursor.fetchone()
+
+def finish_job(job_id, status, error=None, result=None):
+    with _cursor() as cursor:
+        cursor.execute("UPDATE jobs SET status = ?, error = ?, result = ?, finished_at = ? WHERE id = ?", (status, error, result, time.time(), job_id))
+
+def set_job_stage(job_id, stage):
+    with _cursor() as cursor:
+        cursor.execute("UPDATE jobs SET stage = ? WHERE id = ?", (stage, job_id))
+
+def retry_job(job_id, error):
+    with _cursor() as cursor:
+        cursor.execute("UPDATE jobs SET status = 'pending', error = ? WHERE id = ?", (error, job_id))
+
+def get_job(job_id):
+    """
+    Returns (id, kind, status, attempts, error, created_at, started_at, finished_at, stage, result) or None.
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT id, kind, status, attempts, error, created_at, started_at, finished_at, stage, result FROM jobs WHERE id = ?", (job_id,))
+        return cursor.fetchone()
+
+def recover_jobs():
+    """
+    Returns (id, kind) of jobs to resume after a restart. Jobs interrupted while running are reset to pending.
+    """
+    with _cursor() as cursor:
+        cursor.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+        cursor.execute("SELECT id, kind FROM jobs WHERE status = 'pending' ORDER BY id")
+        return [tuple(row) for row in cursor.fetchall()]
+
+def prune_jobs(older_than):
+    with _cursor() as cursor:
+        cursor.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (older_than,))
+
+def create_upload_session(upload_id, kind, filename, size, meta):
+    now = time.time()
+    with _cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO upload_sessions (id, kind, filename, size, received, meta, created_at, updated_at)
+            VALUES (?, ?, ?, ?, 0, ?, ?, ?)
+        """, (upload_id, kind, filename, size, meta, now, now))
+
+def get_upload_session(upload_id):
+    """
+    Returns (id, kind, filename, size, received, meta) or None.
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT id, kind, filename, size, received, meta FROM upload_sessions WHERE id = ?", (upload_id,))
+        return cursor.fetchone()
+
+def set_upload_received(upload_id, received):
+    with _cursor() as cursor:
+        cursor.execute("UPDATE upload_sessions SET received = ?, updated_at = ? WHERE id = ?", (received, time.time(), upload_id))
+
+def delete_upload_session(upload_id):
+    with _cursor() as cursor:
+        cursor.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+
+def expire_upload_sessions(older_than):
+    """
+    Deletes sessions idle since before older_than and returns their ids.
+    """
+    with _cursor() as cursor:
+        cursor.execute("SELECT id FROM upload_sessions WHERE updated_at < ?", (older_than,))
+        expired = [row[0] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM upload_sessions WHERE updated_at < ?", (older_than,))
+    return expired
+
 if __name__ == "__main__":
     init_db()
     print("Database initialized at", DB_PATH)
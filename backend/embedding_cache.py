@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+import database
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 2048))
+EMBEDDING_CACHE_TTL = float(os.environ.get("EMBEDDING_CACHE_TTL", 24 * 3600))
+EMBEDDING_CACHE_PERSIST = os.environ.get("EMBEDDING_CACHE_PERSIST", "0") == "1"
+
+def normalize_text(text: str) -> str:
+    """
+    Canonical form used for cache keys, so retries that differ only in case,
+    spacing or trailing punctuation map to the same entry.
+    """
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    return text.strip(" .,!?;:\"'")
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of embeddings with a time-to-live, optionally backed by the
+    embedding_cache table in memoria.db so entries survive restarts.
+    """
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_SIZE, ttl_seconds: float = EMBEDDING_CACHE_TTL, persist: bool = EMBEDDING_CACHE_PERSIST):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist = persist
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()  # key -> (stored_at, float32 vector)
+        self._lock = threading.Lock()
+        if persist:
+            try:
+                database.prune_embedding_cache(time.time() - ttl_seconds)
+            except Exception as e:
+                logging.error(f"Failed to prune embedding cache: {e}")
+
+    @staticmethod
+    def make_key(text: str, model_name: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _get_memory(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, vector = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector.tolist()
+
+    def _put_memory(self, key: str, vector: np.ndarray, stored_at: float):
+        with self._lock:
+            self._entries[key] = (stored_at, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[List[float]]:
+        """
+        Returns the cached vector for key from memory, then disk if enabled, or None.
+        Called from the blocking thread pool, so the counters change under the lock.
+        """
+        vector = self._get_memory(key)
+        if vector is not None:
+            return vector
+        if self.persist:
+            row = database.get_cached_embedding(key, time.time() - self.ttl_seconds)
+            if row:
+                stored_at, blob = row
+                vector = np.frombuffer(blob, dtype=np.float32)
+                self._put_memory(key, vector, stored_at)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                return vector.tolist()
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put_many(self, model_name: str, items: List[tuple]):
+        """
+        Stores (key, vector) pairs in memory and, if enabled, on disk.
+        """
+        now = time.time()
+        items = [(key, np.asarray(vector, dtype=np.float32)) for key, vector in items]
+        for key, vector in items:
+            self._put_memory(key, vector, now)
+        if self.persist and items:
+            rows = [(key, model_name, vector.tobytes(), now) for key, vector in items]
+            try:
+                database.save_cached_embeddings(rows)
+            except Exception as e:
+                logging.error(f"Failed to persist embedding cache entries: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, disk_hits, misses, size = self.hits, self.disk_hits, self.misses, len(self._entries)
+        lookups = hits + misses
+        return {
+            "size": size,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "persistent": self.persist,
+            "hits": hits,
+            "disk_hits": disk_hits,
+            "misses": misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
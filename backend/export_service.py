@@ -0,0 +1,174 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+import database
+import imagen_service
+import memoir_generator
+import photo_service
+from async_utils import run_blocking
+
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "exports")
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get("EXPORT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+EXPORT_MAX_AGE = float(os.environ.get("EXPORT_MAX_AGE", 7 * 24 * 3600))
+EXPORT_STAGES = ("fetch", "illustrate", "layout", "write")
+# Export jobs run on their own job queue workers so they don't hold up memory extraction
+EXPORT_CONCURRENCY = int(os.environ.get("EXPORT_CONCURRENCY", 1))
+
+# Start times of the exports being built; their downscaled images must survive eviction
+_running_exports: Dict[str, float] = {}
+_running_lock = threading.Lock()
+
+class NothingToExport(Exception):
+    pass
+
+def illustration_prompts(categories) -> Dict[str, str]:
+    return {cat: f"An illustration representing the theme of {cat} in a life story." for cat in sorted(set(categories))}
+
+def hashing_rows(rows: Iterable, digest):
+    """
+    Passes fragment rows through while feeding them into digest, so the fragment set can be
+    fingerprinted in the same pass that consumes it.
+    """
+    for row in rows:
+        cat, content, ctx, _, fid, audio_url, image_url = row
+        digest.update(json.dumps([fid, cat, content, ctx, image_url]).encode("utf-8"))
+        yield row
+
+def export_fingerprint(user_name: str, fragments_digest: str, narrative: Optional[str], image_keys: Dict[str, str]) -> str:
+    """
+    Hash of everything that ends up in the PDF: the verified fragment set, the narrative and
+    the content-addressed keys of the illustrations.
+    """
+    material = json.dumps([user_name, fragments_digest, narrative or "", sorted(image_keys.items())])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def export_path(fingerprint: str) -> str:
+    return os.path.join(EXPORT_DIR, f"memoir-{fingerprint[:32]}.pdf")
+
+def evict_exports(keep: Optional[str] = None, max_bytes: int = EXPORT_CACHE_MAX_BYTES, max_age: float = EXPORT_MAX_AGE) -> int:
+    """
+    Deletes exports older than max_age, then the least recently used ones until the
+    directory fits in max_bytes. Returns the number of files removed. Downscaled images
+    used since the oldest running export started are kept, as that export may still
+    lay them out.
+    """
+    with _running_lock:
+        in_use_since = min(_running_exports.values(), default=None)
+    entries = []
+    # Downscaled illustrations prepared by MemoirGenerator share the budget
+    for directory in (EXPORT_DIR, os.path.join(EXPORT_DIR, ".images")):
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.endswith((".pdf", ".jpg")) and entry.path != keep:
+                stat = entry.stat()
+                if in_use_since is not None and entry.name.endswith(".jpg") and stat.st_mtime >= in_use_since:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    keep_size = os.path.getsize(keep) if keep and os.path.exists(keep) else 0
+    total = keep_size + sum(size for _, size, _ in entries)
+    cutoff = time.time() - max_age
+    removed = 0
+    for mtime, size, path in sorted(entries):
+        if mtime >= cutoff and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+async def _noop(stage: str):
+    pass
+
+def _fingerprint(user_name: str, fragments_digest: str, categories, narrative: Optional[str]):
+    imagen = imagen_service.get_imagen_service()
+    prompts = illustration_prompts(categories) if imagen else {}
+    image_keys = {cat: imagen.cache_key(prompt) for cat, prompt in prompts.items()}
+    return prompts, export_fingerprint(user_name, fragments_digest, narrative, image_keys)
+
+def _resolve(user_name: str):
+    """
+    Streams over the verified fragments once to fingerprint them and work out where their
+    PDF lives. Returns (narrative, prompts, fingerprint, path, fragments_digest); narrative
+    is the biography's (title, text) chapters, or its plain text if stored without them.
+    """
+    digest, categories = hashlib.sha256(), set()
+    for row in hashing_rows(database.iter_fragments(verified_only=True), digest):
+        categories.add(row[0])
+    text, chapters = database.get_latest_synthesized_chapters()
+    if not categories and not text:
+        raise NothingToExport("No memories to export.")
+    prompts, fingerprint = _fingerprint(user_name, digest.hexdigest(), categories, text)
+    return chapters or text, prompts, fingerprint, export_path(fingerprint), digest.hexdigest()
+
+def _layout(user_name: str, images: dict, narrative):
+    """
+    Lays out the memoir straight from a database cursor. Returns (pdf, fragments_digest)
+    for the rows actually laid out.
+    """
+    digest = hashlib.sha256()
+    rows = hashing_rows(database.iter_fragments(verified_only=True), digest)
+    gen = memoir_generator.MemoirGenerator(EXPORT_DIR)
+    pdf = gen.layout(user_name, rows, images=images, narrative=narrative, grouped=True, photo_resolver=photo_service.resolve_image_url)
+    return pdf, digest.hexdigest()
+
+def cached_export(user_name: str) -> Optional[dict]:
+    """
+    Returns the build_export result if the PDF for the current data already exists, else None.
+    """
+    _, _, fingerprint, path, _ = _resolve(user_name)
+    if not os.path.exists(path):
+        return None
+    os.utime(path)
+    return {"path": path, "fingerprint": fingerprint, "cached": True, "illustrations": {}}
+
+async def build_export(user_name: str, report: Callable[[str], Awaitable[None]] = _noop) -> dict:
+    """
+    Produces the memoir PDF for the current data, reusing the cached file when nothing
+    changed since the last export. report(stage) is awaited as each stage starts.
+    Returns {"path", "fingerprint", "cached", "illustrations"}.
+    """
+    token = uuid.uuid4().hex
+    with _running_lock:
+        _running_exports[token] = time.time()
+    try:
+        return await _build_export(user_name, report)
+    finally:
+        with _running_lock:
+            del _running_exports[token]
+
+async def _build_export(user_name: str, report: Callable[[str], Awaitable[None]]) -> dict:
+    await report("fetch")
+    narrative, prompts, fingerprint, path, fragments_digest = await run_blocking(_resolve, user_name)
+    if os.path.exists(path):
+        os.utime(path)
+        return {"path": path, "fingerprint": fingerprint, "cached": True, "illustrations": {}}
+
+    await report("illustrate")
+    images, illustration_stats = {}, {}
+    if prompts:
+        images, illustration_stats = await imagen_service.get_imagen_service().illustrate(prompts)
+
+    await report("layout")
+    pdf, laid_out_digest = await run_blocking(_layout, user_name, images, narrative)
+
+    await report("write")
+    if illustration_stats.get("failed") or laid_out_digest != fragments_digest:
+        # Missing illustrations, or fragments changed mid-export: don't cache under the fingerprint
+        path = os.path.join(EXPORT_DIR, f"memoir-{fingerprint[:32]}-partial-{uuid.uuid4().hex[:8]}.pdf")
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    await run_blocking(pdf.output, tmp_path)
+    os.replace(tmp_path, path)
+    removed = await run_blocking(evict_exports, path)
+    if removed:
+        logging.info(f"Evicted {removed} old exports")
+    return {"path": path, "fingerprint": fingerprint, "cached": False, "illustrations": illustration_stats}
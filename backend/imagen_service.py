@@ -1,27 +1,112 @@
 from vertexai.vision_models import ImageGenerationModel, ImageGenerationResponse
+import asyncio
+import hashlib
 import os
 import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+import config
+from async_utils import run_blocking
+
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "temp_images")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Parallel Imagen requests per instance; keeps exports inside the project's quota
+IMAGEN_CONCURRENCY = int(os.environ.get("IMAGEN_CONCURRENCY", 4))
+
+# Style guidance for a "Memoir" feel; part of the cache key, so changing it regenerates images
+STYLE_TEMPLATE = "A beautiful, high-quality illustration in a nostalgic, cinematic style: {prompt}. Soft lighting, detailed textures, emotional atmosphere."
+GENERATION_PARAMS = {"number_of_images": 1, "aspect_ratio": "1:1", "guidance_scale": 21.0}
+
+class IllustrationCache:
+    """
+    Content-addressed store of generated images on disk. Files are named by cache key;
+    a hit refreshes the file's mtime, and eviction removes least recently used files
+    until the directory fits in max_bytes.
+    """
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def evict(self) -> int:
+        """
+        Deletes least recently used images until the cache fits. Returns the number removed.
+        """
+        entries = []
+        if not os.path.isdir(self.directory):
+            return 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".png"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        with self._lock:
+            self.evictions += removed
+        return removed
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "max_bytes": self.max_bytes,
+        }
 
 class ImagenService:
     def __init__(self, project_id: str, location: str = "us-central1"):
         self.project_id = project_id
         self.location = location
-        self.model_name = "imagen-3.0-generate-001" # Latest Imagen 3 model
+        self.model_name = config.IMAGEN_MODEL
         self.model = ImageGenerationModel.from_pretrained(self.model_name)
+        self.cache = IllustrationCache()
+        self._semaphore = None
+        self._semaphore_loop = None
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def cache_key(self, prompt: str) -> str:
+        params = ",".join(f"{k}={v}" for k, v in sorted(GENERATION_PARAMS.items()))
+        material = "\0".join([self.model_name, STYLE_TEMPLATE, params, prompt])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
 
     def generate_image(self, prompt: str, output_path: str) -> bool:
         """
         Generates an image based on the prompt and saves it to output_path.
         """
         try:
-            # Add style guidance for a "Memoir" feel
-            enhanced_prompt = f"A beautiful, high-quality illustration in a nostalgic, cinematic style: {prompt}. Soft lighting, detailed textures, emotional atmosphere."
-            
             response: ImageGenerationResponse = self.model.generate_images(
-                prompt=enhanced_prompt,
-                number_of_images=1,
-                aspect_ratio="1:1",
-                guidance_scale=21.0
+                prompt=STYLE_TEMPLATE.format(prompt=prompt),
+                **GENERATION_PARAMS
             )
 
             if response.images:
@@ -35,13 +120,79 @@ class ImagenService:
             logging.error(f"Imagen generation failed: {e}")
             return False
 
+    def _generate_cached(self, key: str, prompt: str) -> Optional[str]:
+        # Write under a temporary name so readers never see a partial file
+        os.makedirs(self.cache.directory, exist_ok=True)
+        path = self.cache.path_for(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        if not self.generate_image(prompt, tmp_path):
+            return None
+        os.replace(tmp_path, path)
+        return path
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(IMAGEN_CONCURRENCY)
+            self._semaphore_loop = loop
+            self._pending = {}
+        return self._semaphore
+
+    async def _illustrate_one(self, key: str, prompt: str) -> Optional[str]:
+        semaphore = self._get_semaphore()
+        pending = self._pending.get(key)
+        if pending is not None:
+            # Another export is already generating this exact image
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            async with semaphore:
+                path = await run_blocking(self._generate_cached, key, prompt)
+            future.set_result(path)
+            return path
+        except Exception as e:
+            future.set_result(None)
+            logging.error(f"Illustration failed: {e}")
+            return None
+        finally:
+            self._pending.pop(key, None)
+
+    async def illustrate(self, prompts: Dict[str, str]) -> Tuple[Dict[str, str], dict]:
+        """
+        Generates one image per name concurrently (at most IMAGEN_CONCURRENCY at a time),
+        serving repeats from the content-addressed cache. Returns ({name: path}, stats).
+        """
+        keys = {name: self.cache_key(prompt) for name, prompt in prompts.items()}
+        images, missing = {}, {}
+        for name, key in keys.items():
+            path = await run_blocking(self.cache.get, key)
+            if path:
+                images[name] = path
+            else:
+                missing[name] = key
+        results = await asyncio.gather(*(self._illustrate_one(key, prompts[name]) for name, key in missing.items()))
+        for name, path in zip(missing, results):
+            if path:
+                images[name] = path
+        if missing:
+            await run_blocking(self.cache.evict)
+        generated = sum(1 for path in results if path)
+        stats = {
+            "requested": len(prompts),
+            "cached": len(prompts) - len(missing),
+            "generated": generated,
+            "failed": len(missing) - generated,
+        }
+        return images, stats
+
 _imagen_instance = None
 
 def get_imagen_service() -> ImagenService:
     global _imagen_instance
     if _imagen_instance is None:
-        project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
-        location = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
+        project_id = config.PROJECT_ID
+        location = config.LOCATION
         if project_id:
             _imagen_instance = ImagenService(project_id, location)
         else:
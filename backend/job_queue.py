@@ -0,0 +1,238 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+import weakref
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import database
+from async_utils import run_blocking
+
+JOB_QUEUE_CONCURRENCY = int(os.environ.get("JOB_QUEUE_CONCURRENCY", 2))
+JOB_QUEUE_MAX_DEPTH = int(os.environ.get("JOB_QUEUE_MAX_DEPTH", 200))
+JOB_DRAIN_TIMEOUT = float(os.environ.get("JOB_DRAIN_TIMEOUT", 30))
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+
+# Id of the job the current handler is running for; used by report_stage
+current_job_id: contextvars.ContextVar = contextvars.ContextVar("current_job_id", default=None)
+
+async def report_stage(stage: str):
+    """
+    Records the current stage of the running job so clients polling it can show progress.
+    Does nothing outside a job handler.
+    """
+    job_id = current_job_id.get()
+    if job_id is not None:
+        await run_blocking(database.set_job_stage, job_id, stage)
+
+class JobQueue:
+    """
+    Background worker queue backed by the jobs table in memoria.db.
+
+    Jobs are persisted before they are queued, so work that is pending or interrupted
+    at shutdown resumes on the next start. A fixed number of workers bounds concurrency,
+    jobs sharing a dedupe_key coalesce while pending, and submissions beyond max_depth
+    are shed rather than piling up. A kind registered with its own concurrency gets a
+    separate lane of workers, so long jobs of that kind neither wait behind nor block
+    the others. A kind registered with exclusive_by runs at most one job at a time per
+    value of that payload field.
+    """
+    def __init__(self, concurrency: int = JOB_QUEUE_CONCURRENCY, max_depth: int = JOB_QUEUE_MAX_DEPTH):
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self._handlers: Dict[str, Callable[[dict], Awaitable[Any]]] = {}
+        self._max_attempts: Dict[str, int] = {}
+        self._lane_concurrency: Dict[str, int] = {}
+        self._exclusive_by: Dict[str, str] = {}
+        # (kind, value) -> lock held while a job for that value runs; dropped once unused
+        self._exclusive_locks = weakref.WeakValueDictionary()
+        # Queue per lane; None is the shared lane of kinds without their own concurrency
+        self._queues: Dict[Optional[str], asyncio.Queue] = {}
+        self._workers = []
+        self._accepting = False
+        self.in_flight = 0
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        self._wait_times = deque(maxlen=500)
+        self._run_times = deque(maxlen=500)
+
+    def register(self, kind: str, handler: Callable[[dict], Awaitable[Any]], max_attempts: int = 1,
+                 concurrency: Optional[int] = None, exclusive_by: Optional[str] = None):
+        """
+        Registers the handler for a job kind. With concurrency set, jobs of this kind run on
+        their own workers instead of the shared ones. With exclusive_by set, a job waits while
+        another job of this kind with the same value in that payload field is running.
+        Must be called before start().
+        """
+        self._handlers[kind] = handler
+        self._max_attempts[kind] = max_attempts
+        if concurrency:
+            self._lane_concurrency[kind] = concurrency
+        if exclusive_by:
+            self._exclusive_by[kind] = exclusive_by
+
+    def _exclusive_lock(self, kind: str, payload: dict) -> Optional[asyncio.Lock]:
+        field = self._exclusive_by.get(kind)
+        if field is None or payload.get(field) is None:
+            return None
+        key = (kind, payload[field])
+        lock = self._exclusive_locks.get(key)
+        if lock is None:
+            lock = self._exclusive_locks[key] = asyncio.Lock()
+        return lock
+
+    def _lane(self, kind: str) -> asyncio.Queue:
+        return self._queues[kind if kind in self._lane_concurrency else None]
+
+    @property
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def start(self):
+        """
+        Resumes persisted jobs and starts the workers.
+        """
+        if self._workers:
+            return
+        lanes = {None: self.concurrency, **self._lane_concurrency}
+        self._queues = {lane: asyncio.Queue() for lane in lanes}
+        await run_blocking(database.prune_jobs, time.time() - JOB_RETENTION_SECONDS)
+        resumed = await run_blocking(database.recover_jobs)
+        for job_id, kind in resumed:
+            self._lane(kind).put_nowait(job_id)
+        if resumed:
+            logging.info(f"Resuming {len(resumed)} pending background jobs")
+        self._accepting = True
+        self._workers = [
+            asyncio.create_task(self._worker(f"{lane or 'shared'}-{i}", self._queues[lane]))
+            for lane, count in lanes.items() for i in range(count)
+        ]
+
+    async def submit(self, kind: str, payload: dict, dedupe_key: Optional[str] = None) -> Optional[int]:
+        """
+        Persists and queues a job. Returns its id, or None if the queue is full or shutting down.
+        """
+        if not self._accepting:
+            logging.warning(f"Job queue is not accepting work; dropping {kind} job")
+            self.dropped += 1
+            return None
+        if self.depth + self.in_flight >= self.max_depth:
+            logging.warning(f"Job queue is full ({self.max_depth}); dropping {kind} job")
+            self.dropped += 1
+            return None
+        job_id, created = await run_blocking(database.enqueue_job, kind, json.dumps(payload), dedupe_key)
+        if created:
+            self.submitted += 1
+            self._lane(kind).put_nowait(job_id)
+        else:
+            # A pending job with the same key already sits in the queue and will pick up this payload
+            self.coalesced += 1
+        return job_id
+
+    async def _worker(self, name: str, queue: asyncio.Queue):
+        while True:
+            job_id = await queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                logging.error(f"Job worker {name} crashed on job {job_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def _run(self, job_id: int):
+        job = await run_blocking(database.start_job, job_id)
+        if job is None:
+            return
+        kind, payload, created_at, attempts = job
+        handler = self._handlers.get(kind)
+        if handler is None:
+            await run_blocking(database.finish_job, job_id, "failed", f"No handler for job kind '{kind}'")
+            self.failed += 1
+            return
+
+        started = time.time()
+        self._wait_times.append(started - created_at)
+        self.in_flight += 1
+        token = current_job_id.set(job_id)
+        try:
+            payload = json.loads(payload)
+            lock = self._exclusive_lock(kind, payload)
+            if lock is None:
+                result = await handler(payload)
+            else:
+                async with lock:
+                    result = await handler(payload)
+        except Exception as e:
+            logging.error(f"Job {job_id} ({kind}) failed on attempt {attempts}: {e}")
+            if attempts < self._max_attempts.get(kind, 1):
+                await run_blocking(database.retry_job, job_id, str(e))
+                if self._workers:
+                    # Retries still run during a drain; if it times out they resume on restart
+                    self._lane(kind).put_nowait(job_id)
+            else:
+                await run_blocking(database.finish_job, job_id, "failed", str(e))
+                self.failed += 1
+            return
+        finally:
+            current_job_id.reset(token)
+            self.in_flight -= 1
+            self._run_times.append(time.time() - started)
+        # A handler may return a JSON-serializable result for clients polling the job
+        await run_blocking(database.finish_job, job_id, "done", None, json.dumps(result) if result is not None else None)
+        self.completed += 1
+
+    async def drain(self, timeout: float = JOB_DRAIN_TIMEOUT):
+        """
+        Stops accepting work and waits up to timeout seconds for queued jobs to finish.
+        Anything left is cancelled and stays in the database for the next start.
+        """
+        self._accepting = False
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues.values())), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Job queue drain timed out with {self.depth} queued and {self.in_flight} running; they will resume on restart")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    @staticmethod
+    def _summarize(samples) -> dict:
+        if not samples:
+            return {"avg_ms": 0.0, "p95_ms": 0.0}
+        ordered = sorted(samples)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return {"avg_ms": round(sum(ordered) / len(ordered) * 1000, 1), "p95_ms": round(p95 * 1000, 1)}
+
+    def metrics(self) -> dict:
+        return {
+            "depth": self.depth,
+            "in_flight": self.in_flight,
+            "concurrency": self.concurrency,
+            "lanes": {kind: {"depth": self._queues[kind].qsize() if kind in self._queues else 0, "concurrency": count}
+                      for kind, count in self._lane_concurrency.items()},
+            "max_depth": self.max_depth,
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_latency": self._summarize(self._wait_times),
+            "run_latency": self._summarize(self._run_times),
+        }
+
+_queue_instance = None
+
+def get_job_queue() -> JobQueue:
+    global _queue_instance
+    if _queue_instance is None:
+        _queue_instance = JobQueue()
+    return _queue_instance
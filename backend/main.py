@@ -1,38 +1,64 @@
 
 import os
 import logging
+from contextlib import asynccontextmanager
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Request, File, UploadFile
+from fastapi import FastAPI, HTTPException, Request, Response, File, UploadFile
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from PIL import UnidentifiedImageError
 import vertexai
-from vertexai.generative_models import GenerativeModel, ChatSession, Content, Part
+from vertexai.generative_models import ChatSession, Content, Part
 
 # Load environment variables
 from dotenv import load_dotenv
 load_dotenv()
+import config
+import model_registry
 
-# Configuration
-PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
-LOCATION = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
-MODEL_NAME = "gemini-2.0-flash-exp"  # Only model available in this project
+# Configuration (model IDs live in config.py)
+PROJECT_ID = config.PROJECT_ID
+LOCATION = config.LOCATION
+
+# Per-turn deadlines (seconds) for the context steps that run before the reply.
+# A step that misses its deadline is skipped and the prompt is built without it.
+SEEDS_TIMEOUT = float(os.getenv("SEEDS_TIMEOUT", 0.5))
+MEMORY_TIMEOUT = float(os.getenv("MEMORY_TIMEOUT", 1.5))
+SENTIMENT_TIMEOUT = float(os.getenv("SENTIMENT_TIMEOUT", 0.3))
+
+# Fragments retrieved per turn for the memory section; the token budget decides how many are used
+MEMORY_CANDIDATES = int(os.getenv("MEMORY_CANDIDATES", 12))
+MEMORY_HEADER = "\n\nRelevant memories from past conversations:\n"
+SEEDS_HEADER = "\n\nFamily members suggested these topics to cover:\n"
+
+# Upper bound for ?limit= on the paginated fragment listings
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 500))
 
 # Initialize Vertex AI
 if PROJECT_ID:
     print(f"DEBUG: Initializing Vertex AI with PROJECT_ID: {PROJECT_ID}")
     vertexai.init(project=PROJECT_ID, location=LOCATION)
-    model = GenerativeModel(MODEL_NAME)
+    model = model_registry.get_model_registry().get(config.CHAT_MODEL)
 else:
     print("DEBUG: GOOGLE_CLOUD_PROJECT not set.")
     logging.warning("GOOGLE_CLOUD_PROJECT not set. Vertex AI will not work.")
     model = None
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_blocking(database.prune_sentiment_samples, time.time() - sentiment_service.SENTIMENT_SAMPLE_RETENTION)
+    await job_queue.get_job_queue().start()
+    yield
+    # Drain background jobs, let in-flight blocking work finish, then release pooled resources
+    await job_queue.get_job_queue().drain()
+    async_utils.shutdown_executor()
+    database.close_connections()
+
+app = FastAPI(lifespan=lifespan)
 
 # Ensure uploads directories exist
 os.makedirs("uploads/images", exist_ok=True)
 os.makedirs("uploads/audio", exist_ok=True)
-os.makedirs("temp_images", exist_ok=True)
 
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
@@ -48,13 +74,27 @@ class ChatCompletionRequest(BaseModel):
     messages: List[Message]
     temperature: Optional[float] = 0.7
     stream: Optional[bool] = False
+    # Set by the ElevenLabs SDK from startSession({customLlmExtraBody}); carries the session id
+    elevenlabs_extra_body: Optional[dict] = None
 
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
+import io
 import json
 import database
 import rag_service
-import memoir_generator
 import imagen_service
+import export_service
+import photo_service
+import prompt_budget
+import upload_service
+import vision_service
+import async_utils
+import context_cache
+import job_queue
+import session_cache
+import sentiment_service
+import synthesis_service
+from async_utils import run_blocking
 import asyncio
 
 # Initialize DB on startup
@@ -62,151 +102,284 @@ database.init_db()
 
 async def extract_memories(session_id: str, messages: List[Message]):
     """
-    Background task to extract memory fragments from conversation.
+    Background job to extract memory fragments from conversation.
+    Only turns after the session's extraction watermark are sent, together with a
+    rolling summary of earlier turns, so the prompt stays flat as the conversation grows.
+    Errors propagate so the job queue can record and retry them.
     """
-    if not model or len(messages) < 2:
+    if not model:
+        return
+
+    turns = [m for m in messages if m.role != "system"]
+    extracted_turns, summary = await run_blocking(database.get_extraction_state, session_id)
+    restarted = extracted_turns > len(turns)
+    if restarted:
+        # The client restarted the conversation under the same session
+        extracted_turns, summary = 0, ""
+    new_turns = turns[extracted_turns:]
+    if len(new_turns) < 2:
         return
 
     # Create a prompt for extraction
-    history_text = "\n".join([f"{m.role}: {m.content}" for m in messages])
+    history_text = "\n".join([f"{m.role}: {m.content}" for m in new_turns])
     prompt = f"""
-    Analyze the following conversation history from an AI biographer interview.
-    1. Extract key "Memory Fragments" (People, Places, Dates, Significant Events).
+    Analyze the following new turns from an AI biographer interview.
+    1. Extract key "Memory Fragments" (People, Places, Dates, Significant Events) mentioned in the new turns only.
     2. Identify the "Predominant Era" discussed (modern, vintage (70s-90s), or sepia (pre-70s)).
+    3. Update the summary of the conversation so far to include the new turns, in at most 120 words.
     
     Return a JSON object with:
-    - "fragments": list of {category, content, context}
+    - "fragments": list of {{category, content, context}}
     - "era": "modern", "vintage", or "sepia"
+    - "summary": the updated summary
     
-    Conversation:
+    Summary of earlier turns:
+    {summary or "(none yet)"}
+    
+    New turns:
     {history_text}
     
     JSON Output:
     """
     
+    extraction_model = model_registry.get_model_registry().get(config.EXTRACTION_MODEL)
+    response = await extraction_model.generate_content_async(prompt)
+    text = response.text.replace("```json", "").replace("```", "").strip()
+    data = json.loads(text)
+    
+    fragments = data.get("fragments", [])
+    era = data.get("era", "modern")
+    
+    # Drop fragments that are already stored (or repeated within this batch) before embedding them
+    rows, batch_hashes = [], set()
+    candidates = [(frag.get("category", "General"), frag.get("content", ""), frag.get("context", "")) for frag in fragments]
+    stored_hashes = await run_blocking(database.get_existing_content_hashes, {database.content_hash(c) for _, c, _ in candidates})
+    for category, content, context in candidates:
+        frag_hash = database.content_hash(content)
+        if content and frag_hash not in stored_hashes and frag_hash not in batch_hashes:
+            batch_hashes.add(frag_hash)
+            rows.append((category, content, context))
+
+    embeddings = []
+    rag = rag_service.get_rag_service()
+    if rag and rows:
+        # One embedding request for the whole extraction
+        embeddings = await rag.get_embeddings_async([f"{category}: {content}" for category, content, _ in rows])
+    if len(embeddings) != len(rows):
+        embeddings = [None] * len(rows)
+    
+    # One transaction for the fragments, rolling summary and watermark
+    await run_blocking(database.save_extraction_result, session_id, [
+        (category, content, context, rag.serialize_embedding(emb) if emb is not None else None)
+        for (category, content, context), emb in zip(rows, embeddings)
+    ], data.get("summary") or summary, len(turns), era, restarted)
+    
+    logging.info(f"Detected Era: {era} for session {session_id}; stored {len(rows)} of {len(fragments)} extracted fragments")
+    # In a real app, we'd have a way to push this to the frontend (WebSockets)
+
+async def run_extraction_job(payload: dict):
+    messages = [Message(**m) for m in payload["messages"]]
+    await extract_memories(payload["session_id"], messages)
+
+async def schedule_extraction(session_id: str, messages: List[Message], coalesce: bool = True):
+    """
+    Queues memory extraction. Pending extractions for the same session coalesce,
+    since the newest conversation snapshot supersedes older ones. Sessions known only by
+    a fingerprint don't coalesce, as two conversations may share it.
+    """
+    await job_queue.get_job_queue().submit(
+        "extract_memories",
+        {"session_id": session_id, "messages": [m.model_dump() for m in messages]},
+        dedupe_key=f"extract:{session_id}" if coalesce else None,
+    )
+
+# One extraction per session at a time: concurrent ones would read the same watermark and extract the same turns twice
+job_queue.get_job_queue().register("extract_memories", run_extraction_job, max_attempts=2, exclusive_by="session_id")
+
+async def with_deadline(coro, timeout: float, label: str, default=None):
+    """
+    Awaits coro for at most timeout seconds, returning default if it is too slow or fails.
+    """
     try:
-        extraction_model = GenerativeModel(MODEL_NAME)  # Use same model as chat
-        response = extraction_model.generate_content(prompt)
-        text = response.text.replace("```json", "").replace("```", "").strip()
-        data = json.loads(text)
-        
-        fragments = data.get("fragments", [])
-        era = data.get("era", "modern")
-        
-        rag = rag_service.get_rag_service()
-        for frag in fragments:
-            # ... (same as before)
-            content = frag.get("content", "")
-            category = frag.get("category", "General")
-            context = frag.get("context", "")
-            
-            embedding = None
-            if rag:
-                embeddings = rag.get_embeddings([f"{category}: {content}"])
-                if embeddings:
-                    embedding = rag.serialize_embedding(embeddings[0])
-            
-            database.save_fragment(session_id, category, content, context, embedding)
-        
-        # Save era to summary/session metadata if needed, but for now we'll just log
-        logging.info(f"Detected Era: {era} for session {session_id}")
-        # In a real app, we'd have a way to push this to the frontend (WebSockets)
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        logging.warning(f"{label} missed its {timeout:.2f}s deadline; skipping")
     except Exception as e:
-        logging.error(f"Failed to extract memories: {e}")
+        logging.error(f"{label} failed: {e}")
+    return default
+
+async def memory_candidates(user_query: str):
+    """
+    Returns (header, candidates) for the memory section: up to MEMORY_CANDIDATES fragments
+    with relevance and recency scores, for prompt_budget.pack to choose from.
+    """
+    rag = rag_service.get_rag_service()
+    if rag and user_query:
+        # We search the resident index of verified fragments for better context stability
+        relevant = await rag.retrieve_relevant_async(user_query, top_k=MEMORY_CANDIDATES)
+        relevance = prompt_budget.rank_relevance(len(relevant))
+        return MEMORY_HEADER, [(f"[{cat}]: {content} ({ctx})", relevance[i], 0.0) for i, (cat, content, ctx) in enumerate(relevant)]
+
+    # Without the embedding service, full-text matches are still relevant memories
+    if user_query:
+        matches = await run_blocking(database.search_fragments_text, user_query, MEMORY_CANDIDATES)
+        if matches:
+            rows = await run_blocking(database.get_fragments_by_ids, matches)
+            relevance = prompt_budget.rank_relevance(len(rows))
+            recency = prompt_budget.recency([row[0] for row in rows])
+            return MEMORY_HEADER, [(f"[{cat}]: {content} ({ctx})", relevance[i], recency[fid]) for i, (fid, cat, content, ctx) in enumerate(rows)]
+
+    # Fallback if RAG is unavailable or query is empty - take most recent or generic
+    existing_fragments = await run_blocking(database.list_fragments, True, MEMORY_CANDIDATES)
+    recency = prompt_budget.recency([row[0] for row in existing_fragments])
+    return "\n\nKnown memories about the user:\n", [(f"[{cat}]: {content} ({ctx})", 0.0, recency[fid]) for fid, cat, content, ctx, *rest in existing_fragments]
+
+async def build_memory_context(user_query: str) -> str:
+    header, candidates = await memory_candidates(user_query)
+    memory_context, _, dropped = prompt_budget.pack(header, candidates, prompt_budget.MEMORY_BUDGET_TOKENS)
+    if dropped:
+        logging.info(f"Memory context: {dropped} of {len(candidates)} candidates left out of the token budget")
+    return memory_context
+
+def build_seeds_context(user_query: str, active_seeds: list) -> str:
+    """
+    Packs the family's unused seeds into their token budget, preferring ones related to
+    the current question, then the newest.
+    """
+    recency = prompt_budget.recency([sid for sid, _ in active_seeds])
+    candidates = [(content, prompt_budget.lexical_relevance(user_query, content), recency[sid]) for sid, content in active_seeds]
+    seeds_context, _, _ = prompt_budget.pack(SEEDS_HEADER, candidates, prompt_budget.SEEDS_BUDGET_TOKENS)
+    return seeds_context
+
+async def detect_sentiment(user_query: str) -> str:
+    """
+    Lightweight sentiment check (for Phase 5). Returns an extra instruction for emotional turns.
+    Classified locally; only unsure turns may go to the model (SENTIMENT_LLM_FALLBACK).
+    """
+    if not user_query:
+        return ""
+    sentiment, _ = await sentiment_service.get_sentiment_service().detect(user_query)
+    if sentiment == "sad":
+        return "\n\nCRITICAL: The user seems emotional. Use an extremely gentle, slow, and comforting tone. Acknowledge their feelings warmly before continuing."
+    return ""
+
+async def gather_turn_context(session_id: str, user_query: str, cacheable: bool = True):
+    """
+    Returns (session_context, memory_context, seeds_context, sentiment_instruction) for a turn.
+    Results cached for the session are reused; the missing steps run concurrently,
+    each under its own deadline. With cacheable unset the turn gets a throwaway context.
+    """
+    cache = session_cache.get_session_cache()
+    if cacheable:
+        context, is_new = cache.get(session_id)
+    else:
+        context, is_new = session_cache.SessionContext(session_id, cache.version), False
+    if is_new:
+        await run_blocking(database.save_session, session_id)
+    version = context.version
+    turn = context.get_turn(user_query) if user_query else None
+    cache.record_lookup(turn is not None)
+
+    async def cached(value):
+        return value
+
+    memory_context, active_seeds, sentiment_instruction = await asyncio.gather(
+        cached(turn[0]) if turn else with_deadline(build_memory_context(user_query), MEMORY_TIMEOUT, "Memory retrieval"),
+        cached(context.seeds) if context.seeds is not None else with_deadline(run_blocking(database.get_active_seeds), SEEDS_TIMEOUT, "Seed lookup"),
+        cached(turn[1]) if turn else with_deadline(detect_sentiment(user_query), SENTIMENT_TIMEOUT, "Sentiment analysis"),
+    )
+
+    # Cache only steps that finished, and only if no fragment or seed changed meanwhile
+    if context.version == version == cache.version:
+        if active_seeds is not None:
+            context.seeds = active_seeds
+        if user_query and turn is None and memory_context is not None and sentiment_instruction is not None:
+            context.put_turn(user_query, memory_context, sentiment_instruction)
+    seeds_context = build_seeds_context(user_query, active_seeds or [])
+    return context, memory_context or "", seeds_context, sentiment_instruction or ""
 
 @app.post("/chat/completions")
 async def chat_completions(request: Request, completion_request: ChatCompletionRequest):
     if not model:
         raise HTTPException(status_code=500, detail="Vertex AI not configured.")
+    # Extraction progress, summaries and cached context are per conversation
+    session_id, explicit = session_cache.resolve_session_id(
+        request.headers, completion_request.messages, completion_request.elevenlabs_extra_body)
+    cacheable = session_id is not None
+    if not cacheable:
+        # Nothing identifies the conversation: answer the turn without caching or extraction
+        session_id = f"req-{uuid.uuid4()}"
+        logging.warning("Chat request without a conversation id or user message; serving it uncached")
     
     try:
-        # 1. Fetch Relevant Memories for Context (RAG)
+        # 1. Gather memories (RAG), family seeds and sentiment, reusing the session's cached context
         user_query = completion_request.messages[-1].content if completion_request.messages else ""
-        rag = rag_service.get_rag_service()
-        existing_fragments = database.get_all_fragments()
-        
-        # 1b. Fetch Family Seeds
-        active_seeds = database.get_active_seeds()
-        seeds_context = ""
-        if active_seeds:
-            seeds_context = "\n\nFamily members suggested these topics to cover:\n"
-            for sid, content in active_seeds:
-                seeds_context += f"- {content}\n"
-        
-        memory_context = ""
-        # ... (rest of search logic)
-        if existing_fragments and rag and user_query:
-            # We search among verified fragments for better context stability
-            verified_only = [f for f in existing_fragments if len(f) > 4 and f[4] == 1] # Check is_verified if present
-            relevant = rag.retrieve_relevant(user_query, existing_fragments, top_k=5)
-            if relevant:
-                memory_context = "\n\nRelevant memories from past conversations:\n"
-                for cat, content, ctx in relevant:
-                    memory_context += f"- [{cat}]: {content} ({ctx})\n"
-        elif existing_fragments:
-            # Fallback if RAG fails or query is empty - take most recent or generic
-            memory_context = "\n\nKnown memories about the user:\n"
-            for cat, content, ctx, *rest in existing_fragments[:5]: # Just take first 5
-                memory_context += f"- [{cat}]: {content} ({ctx})\n"
-
-        # 1c. Sentiment Analysis (for Phase 5)
-        sentiment_instruction = ""
-        if user_query:
-            try:
-                # Lightweight sentiment check
-                sentiment_model = GenerativeModel("gemini-1.5-flash")
-                sent_resp = sentiment_model.generate_content(f"Analyze the sentiment of this text: '{user_query}'. Return only one word: 'positive', 'neutral', or 'sad/emotional'.")
-                sentiment = sent_resp.text.strip().lower()
-                if 'sad' in sentiment or 'emotional' in sentiment:
-                    sentiment_instruction = "\n\nCRITICAL: The user seems emotional. Use an extremely gentle, slow, and comforting tone. Acknowledge their feelings warmly before continuing."
-            except:
-                pass
+        context, memory_context, seeds_context, sentiment_instruction = await gather_turn_context(session_id, user_query, cacheable)
 
         # 2. Parse Messages & Setup Instructions
         base_system = "You are Memoria, a deeply empathetic and patient AI biographer. Your goal is to help elderly users record their life stories. Keep questions open-ended and use the context of past stories to show you remember them."
-        system_instruction = base_system + memory_context + seeds_context + sentiment_instruction
+        stable_instruction = base_system
+        turn_context = memory_context + seeds_context + sentiment_instruction
         
         history = []
         for msg in completion_request.messages:
             if msg.role == "system":
                 # We append our memory context to whatever system prompt ElevenLabs sends
-                system_instruction = msg.content + memory_context
+                stable_instruction = msg.content
+                turn_context = memory_context
             elif msg.role == "user":
                 history.append(Content(role="user", parts=[Part.from_text(msg.content)]))
             elif msg.role == "assistant":
                 history.append(Content(role="model", parts=[Part.from_text(msg.content)]))
 
+        system_instruction = stable_instruction + turn_context
+        context.system_instruction = system_instruction
+        prompt_budget.get_prompt_usage().record({
+            "system_instruction": prompt_budget.estimate_tokens(system_instruction),
+            "memories": prompt_budget.estimate_tokens(memory_context),
+            "seeds": prompt_budget.estimate_tokens(seeds_context),
+            "sentiment": prompt_budget.estimate_tokens(sentiment_instruction),
+            "history": sum(prompt_budget.estimate_tokens(m.content) for m in completion_request.messages if m.role != "system"),
+        })
+
         # 3. Configure Gemini
-        current_model = GenerativeModel(MODEL_NAME, system_instruction=[system_instruction])
-        chat = current_model.start_chat(history=history[:-1] if history else [])
+        chat_history = history[:-1] if history else []
         last_message = history[-1].parts[0].text if history and history[-1].role == 'user' else "Hello, I am ready to share my story."
+        prefix_cache = context_cache.get_context_cache() if cacheable else None
+        if prefix_cache:
+            # Long interviews reuse the registered instruction + earlier turns instead of re-sending them
+            current_model, chat_history, last_message = await prefix_cache.prepare(
+                context, config.CHAT_MODEL, stable_instruction, turn_context, chat_history, last_message)
+        else:
+            current_model = model_registry.get_model_registry().bind(config.CHAT_MODEL, [system_instruction])
+        chat = current_model.start_chat(history=chat_history)
 
         # 4. Generate & Stream/Return
-        session_id = str(uuid.uuid4()) # For now, a new ID per request if not tracked
-        
         if completion_request.stream:
             async def generate_chunks():
-                response = chat.send_message(last_message, stream=True)
+                response = await chat.send_message_async(last_message, stream=True)
                 full_content = ""
                 chunk_id = f"chatcmpl-{uuid.uuid4()}"
                 
-                for chunk in response:
+                async for chunk in response:
                     if chunk.text:
                         full_content += chunk.text
                         yield f"data: {json.dumps({'id': chunk_id, 'object': 'chat.completion.chunk', 'choices': [{'index': 0, 'delta': {'content': chunk.text}, 'finish_reason': None}]})}\n\n"
                 
                 # After stream completes, trigger extraction
-                asyncio.create_task(extract_memories(session_id, completion_request.messages + [Message(role="assistant", content=full_content)]))
+                if cacheable:
+                    await schedule_extraction(session_id, completion_request.messages + [Message(role="assistant", content=full_content)], explicit)
                 yield "data: [DONE]\n\n"
             
             return StreamingResponse(generate_chunks(), media_type="text/event-stream")
 
         else:
-            response = chat.send_message(last_message)
+            response = await chat.send_message_async(last_message)
             response_text = response.text
             
             # Trigger background extraction
-            asyncio.create_task(extract_memories(session_id, completion_request.messages + [Message(role="assistant", content=response_text)]))
+            if cacheable:
+                await schedule_extraction(session_id, completion_request.messages + [Message(role="assistant", content=response_text)], explicit)
 
             return {
                 "id": f"chatcmpl-{uuid.uuid4()}",
@@ -225,87 +398,154 @@ async def chat_completions(request: Request, completion_request: ChatCompletionR
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/vision-context")
-async def vision_context(request: Request):
+async def vision_context(request: Request, response: Response, session_id: str = "manual-upload"):
     """
     Analyzes an uploaded image and adds it to the conversation context.
+    The photo is sent as multipart form data (field "file") or as the raw request body.
+    Deprecated: a JSON body with a base64 "image", kept for older clients until they update.
     """
-    if not model:
+    vision = vision_service.get_vision_service()
+    if not vision:
         raise HTTPException(status_code=500, detail="Vertex AI not configured.")
-    
-    data = await request.json()
-    image_base64 = data.get("image") # base64 string
-    session_id = data.get("session_id", "manual-upload")
-    
-    if not image_base64:
-        raise HTTPException(status_code=400, detail="No image provided.")
 
-    import base64
-    image_data = base64.b64decode(image_base64)
-    
-    # Analyze with Gemini Vision
-    vision_prompt = "You are an AI biographer assistant. Analyze this photo and describe what you see in a way that helps an interviewer ask meaningful questions. Focus on people, fashion (to guess the era), and activities."
-    
+    content_type = request.headers.get("content-type", "")
+    tmp_path = None
     try:
-        vision_model = GenerativeModel("gemini-1.5-flash") # Vision capable
-        img_part = Part.from_data(data=image_data, mime_type="image/jpeg")
-        response = vision_model.generate_content([vision_prompt, img_part])
-        
-        description = response.text
-        # Save as a special 'Visual' fragment
-        database.save_fragment(session_id, "Visual Memory", description, "User uploaded a photo")
-        
-        return {"description": description}
+        if content_type.startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None or isinstance(upload, str):
+                raise HTTPException(status_code=400, detail="No image provided.")
+            if upload.size and upload.size > upload_service.MAX_UPLOAD_BYTES["photo"]:
+                raise upload_service.UploadTooLarge(upload_service.MAX_UPLOAD_BYTES["photo"])
+            session_id = form.get("session_id") or session_id
+            source = upload.file
+        elif content_type.startswith("application/json"):
+            import base64
+            logging.warning("Deprecated base64 JSON upload to /vision-context; send multipart form data instead")
+            response.headers["Deprecation"] = "true"
+            data = await request.json()
+            if not data.get("image"):
+                raise HTTPException(status_code=400, detail="No image provided.")
+            session_id = data.get("session_id", session_id)
+            source = io.BytesIO(base64.b64decode(data["image"]))
+        else:
+            tmp_path, _ = await upload_service.receive_stream(request.stream(), "photo")
+            source = tmp_path
+        description, cached = await vision.describe(source)
+    except upload_service.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnidentifiedImageError:
+        raise HTTPException(status_code=400, detail="Not a supported image.")
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Vision analysis failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    # Save as a special 'Visual' fragment
+    await run_blocking(database.save_fragment, session_id, "Visual Memory", description, "User uploaded a photo")
+    return {"description": description, "cached": cached}
 
 @app.post("/upload-photo")
 async def upload_photo(fragment_id: int, file: UploadFile = File(...)):
     """
-    Saves a photo and links it to a fragment.
+    Saves a photo and links it to a fragment. Photos are stored by content hash, so
+    re-uploads are deduplicated; resized variants are prepared in the background.
+    The file is streamed to disk in chunks and rejected once it passes the size limit.
     """
-    file_id = str(uuid.uuid4())
-    ext = file.filename.split('.')[-1] if '.' in file.filename else 'jpg'
-    filename = f"fragment_{fragment_id}_{file_id}.{ext}"
-    file_path = os.path.join("uploads", "images", filename)
-    
-    with open(file_path, "wb") as buffer:
-        buffer.write(await file.read())
+    try:
+        tmp_path, digest = await upload_service.receive_partial(file, "photo")
+    except upload_service.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return await _attach_photo(fragment_id, tmp_path, digest, file.filename)
+
+async def _attach_photo(fragment_id: int, tmp_path: str, digest: str, filename: Optional[str]) -> dict:
+    photo_id, path, created = await run_blocking(photo_service.adopt_original, tmp_path, digest, filename)
+    if created or not os.path.exists(photo_service.variant_path(photo_id, "thumb")):
+        await job_queue.get_job_queue().submit("photo_variants", {"photo_id": photo_id}, dedupe_key=f"photo:{photo_id}")
     
-    image_url = f"http://localhost:8000/uploads/images/{filename}"
-    database.update_fragment_image(fragment_id, image_url)
+    image_url = f"http://localhost:8000/uploads/images/{os.path.basename(path)}"
+    await run_blocking(database.update_fragment_image, fragment_id, image_url)
     
-    return {"image_url": image_url}
+    return {"image_url": image_url, "photo_id": photo_id, "thumbnail_url": _photo_url(photo_id, photo_service.VARIANTS["thumb"])}
 
-@app.get("/memories")
-async def get_memories(verified: bool = True):
+async def run_photo_variants_job(payload: dict):
+    await run_blocking(photo_service.generate_variants, payload["photo_id"])
+
+job_queue.get_job_queue().register("photo_variants", run_photo_variants_job, max_attempts=2)
+
+def _photo_url(photo_id: Optional[str], width: int) -> Optional[str]:
+    return f"http://localhost:8000/photos/{photo_id}?w={width}" if photo_id else None
+
+@app.get("/photos/{photo_id}")
+async def get_photo(photo_id: str, w: int = 0):
     """
-    Returns extracted memory fragments.
+    Serves the smallest prepared variant of an uploaded photo that is at least w pixels on
+    its long edge (the original if none is, or variants are still being prepared).
     """
-    fragments = database.get_all_fragments(verified_only=verified)
-    # Simple heuristic for era if not persisted: check for dates or keywords
+    path = await run_blocking(photo_service.pick_variant, photo_id, w)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Photo not found.")
+    # Content-addressed, so a given URL only ever gets better (a variant replacing the original)
+    return FileResponse(path, headers={"Cache-Control": "public, max-age=86400"})
+
+def _page_size(limit: Optional[int]) -> Optional[int]:
+    if limit is None:
+        return None
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    return min(limit, MAX_PAGE_SIZE)
+
+def _next_cursor(rows, limit: Optional[int]) -> Optional[int]:
+    # A full page means there may be more; the cursor is the last id seen
+    return rows[-1][0] if limit is not None and len(rows) == limit else None
+
+def _fragment_json(f) -> dict:
+    thumbnail_url = _photo_url(photo_service.photo_id_from_url(f[5]), photo_service.VARIANTS["thumb"])
+    return {"id": f[0], "category": f[1], "content": f[2], "context": f[3], "audio_url": f[4], "image_url": f[5], "thumbnail_url": thumbnail_url}
+
+def _guess_era(fragments) -> str:
+    # Simple heuristic for era if none has been persisted yet: check for dates or keywords
     era = "modern"
     for frag in fragments:
-        content = frag[1].lower()
+        content = (frag[2] or "").lower()
         if any(w in content for w in ["young", "childhood", "grandparents", "1940", "1950", "1960"]):
-            era = "sepia"
-            break
+            return "sepia"
         elif any(w in content for w in ["1970", "1980", "1990", "college"]):
             era = "vintage"
-            
+    return era
+
+@app.get("/memories")
+async def get_memories(verified: bool = True, limit: Optional[int] = None, after: Optional[int] = None):
+    """
+    Returns extracted memory fragments. Pass limit (and the returned next_cursor as after) to page through them.
+    """
+    limit = _page_size(limit)
+    fragments = await run_blocking(database.list_fragments, verified=True if verified else None, limit=limit, after=after)
+    era = await run_blocking(database.get_latest_era) or _guess_era(fragments)
     return {
-        "fragments": [{"id": f[4], "category": f[0], "content": f[1], "context": f[2], "audio_url": f[5], "image_url": f[6]} for f in fragments],
-        "era": era
+        "fragments": [_fragment_json(f) for f in fragments],
+        "era": era,
+        "next_cursor": _next_cursor(fragments, limit)
     }
 
 @app.get("/fragments/pending")
-async def get_pending():
-    fragments = database.get_pending_fragments()
-    return [{"id": f[0], "category": f[1], "content": f[2], "context": f[3], "audio_url": f[4], "image_url": f[5]} for f in fragments]
+async def get_pending(response: Response, limit: Optional[int] = None, after: Optional[int] = None):
+    limit = _page_size(limit)
+    fragments = await run_blocking(database.get_pending_fragments, limit=limit, after=after)
+    # The body stays a plain list for existing clients; the cursor travels in a header
+    next_cursor = _next_cursor(fragments, limit)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return [_fragment_json(f) for f in fragments]
 
 @app.post("/fragments/{fragment_id}/verify")
 async def verify_frag(fragment_id: int):
-    database.verify_fragment(fragment_id)
+    await run_blocking(database.verify_fragment, fragment_id)
     return {"status": "Verified"}
 
 @app.patch("/fragments/{fragment_id}")
@@ -315,105 +555,253 @@ async def patch_fragment(fragment_id: int, request: Request):
     category = data.get("category")
     if not content:
         raise HTTPException(status_code=400, detail="Content required")
-    database.update_fragment(fragment_id, content, category)
+    await run_blocking(database.update_fragment, fragment_id, content, category)
     return {"status": "Updated"}
 
 @app.delete("/fragments/{fragment_id}")
 async def delete_frag(fragment_id: int):
-    database.delete_fragment(fragment_id)
+    await run_blocking(database.delete_fragment, fragment_id)
     return {"status": "Deleted"}
 
+def _export_file(result: dict, user_name: str) -> FileResponse:
+    headers = {f"X-Illustrations-{name.capitalize()}": str(count) for name, count in result["illustrations"].items()}
+    headers["X-Export-Cached"] = "1" if result["cached"] else "0"
+    return FileResponse(
+        result["path"],
+        media_type='application/pdf',
+        filename=f"Memoir_{user_name.replace(' ', '_')}_{result['fingerprint'][:8]}.pdf",
+        headers=headers
+    )
+
 @app.get("/export")
 async def export_memoir(user_name: str = "User"):
     """
     Generates and returns a PDF memoir. Uses synthesized narrative if available.
+    Unchanged data is served from the export cache; see POST /exports for the job-based flow.
     """
-    fragments = database.get_all_fragments(verified_only=True)
-    narrative = database.get_latest_synthesized_narrative()
-    
-    if not fragments and not narrative:
-        raise HTTPException(status_code=400, detail="No memories to export.")
-    
-    # Generate illustrations for each category
-    images = {}
-    imagen = imagen_service.get_imagen_service()
-    if imagen and fragments:
-        categories = set(f[0] for f in fragments)
-        img_dir = "temp_images"
-        if not os.path.exists(img_dir):
-            os.makedirs(img_dir)
-            
-        for cat in categories:
-            img_path = os.path.join(img_dir, f"{cat.replace(' ', '_')}.png")
-            if not os.path.exists(img_path):
-                prompt = f"An illustration representing the theme of {cat} in a life story."
-                imagen.generate_image(prompt, img_path)
-            images[cat] = img_path
-
-    gen = memoir_generator.MemoirGenerator()
     try:
-        # If narrative exists, we'll pass it to the generator
-        filepath = gen.generate(user_name, fragments, images=images, narrative=narrative)
-        return FileResponse(
-            filepath, 
-            media_type='application/pdf', 
-            filename=os.path.basename(filepath)
-        )
+        result = await export_service.build_export(user_name)
+        return _export_file(result, user_name)
+    except export_service.NothingToExport as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logging.error(f"Export failed: {e}")
         raise HTTPException(status_code=500, detail="Failed to generate PDF.")
 
+async def run_export_job(payload: dict):
+    result = await export_service.build_export(payload["user_name"], job_queue.report_stage)
+    return dict(result, user_name=payload["user_name"])
+
+job_queue.get_job_queue().register("export", run_export_job, concurrency=export_service.EXPORT_CONCURRENCY)
+
+def _export_status(job) -> dict:
+    job_id, kind, status, attempts, error, created_at, started_at, finished_at, stage, result = job
+    body = {"job_id": job_id, "status": status, "stage": stage, "stages": list(export_service.EXPORT_STAGES), "error": error}
+    if status == "done":
+        body["stage"] = "done"
+        body.update({k: v for k, v in json.loads(result).items() if k in ("fingerprint", "cached", "illustrations")})
+        body["download_url"] = f"/exports/{job_id}/download"
+    return body
+
+@app.post("/exports", status_code=202)
+async def start_export(user_name: str = "User"):
+    """
+    Starts building the memoir PDF in the background and returns a job id to poll.
+    If the PDF for the current data is already cached, the job is finished on return.
+    """
+    try:
+        cached = await run_blocking(export_service.cached_export, user_name)
+    except export_service.NothingToExport as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    payload = json.dumps({"user_name": user_name})
+    if cached:
+        job_id, _ = await run_blocking(database.enqueue_job, "export", payload)
+        await run_blocking(database.finish_job, job_id, "done", None, json.dumps(dict(cached, user_name=user_name)))
+    else:
+        job_id = await job_queue.get_job_queue().submit("export", {"user_name": user_name}, dedupe_key=f"export:{user_name}")
+        if job_id is None:
+            raise HTTPException(status_code=503, detail="Export queue is full, try again shortly.")
+    return _export_status(await run_blocking(database.get_job, job_id))
+
+@app.get("/exports/{job_id}")
+async def get_export(job_id: int):
+    job = await run_blocking(database.get_job, job_id)
+    if job is None or job[1] != "export":
+        raise HTTPException(status_code=404, detail="Export not found.")
+    return _export_status(job)
+
+@app.get("/exports/{job_id}/download")
+async def download_export(job_id: int):
+    job = await run_blocking(database.get_job, job_id)
+    if job is None or job[1] != "export":
+        raise HTTPException(status_code=404, detail="Export not found.")
+    if job[2] != "done":
+        raise HTTPException(status_code=409, detail=f"Export is {job[2]}.")
+    result = json.loads(job[9])
+    if not os.path.exists(result["path"]):
+        raise HTTPException(status_code=410, detail="Export has expired; start a new one.")
+    return _export_file(result, result["user_name"])
+
 @app.post("/upload-audio")
-async def upload_audio(file: UploadFile = File(...), session_id: str = "default"):
+async def upload_audio(file: UploadFile = File(...)):
     """
-    Saves an audio snippet and returns the local URL.
+    Saves an audio snippet and returns the local URL. The file is streamed to disk in
+    chunks and stored by content hash, so a retried upload reuses the existing file.
     """
-    file_id = str(uuid.uuid4())
-    filename = f"{session_id}_{file_id}.webm"
-    file_path = os.path.join("uploads", "audio", filename)
-    
-    with open(file_path, "wb") as buffer:
-        buffer.write(await file.read())
-    
-    return {"audio_url": f"http://localhost:8000/uploads/audio/{filename}"}
+    try:
+        path, _, _ = await upload_service.receive_file(file, "audio", AUDIO_DIR, _audio_extension(file.filename))
+    except upload_service.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return {"audio_url": f"http://localhost:8000/uploads/audio/{os.path.basename(path)}"}
+
+AUDIO_DIR = os.path.join("uploads", "audio")
+AUDIO_EXTENSIONS = {"webm", "ogg", "mp3", "m4a", "wav"}
+
+def _audio_extension(filename: Optional[str]) -> str:
+    ext = filename.rsplit(".", 1)[-1].lower() if filename and "." in filename else "webm"
+    return ext if ext in AUDIO_EXTENSIONS else "webm"
+
+class UploadSessionRequest(BaseModel):
+    kind: str
+    size: int
+    filename: Optional[str] = None
+    fragment_id: Optional[int] = None
+
+def _upload_status(upload_id: str, received: int, size: int, kind: str) -> dict:
+    return {"upload_id": upload_id, "offset": received, "size": size,
+            "chunk_size": upload_service.UPLOAD_CHUNK_SIZE, "max_bytes": upload_service.MAX_UPLOAD_BYTES[kind]}
+
+@app.post("/upload-sessions", status_code=201)
+async def create_upload_session(req: UploadSessionRequest):
+    """
+    Starts a resumable upload. The client then PATCHes the bytes to /upload-sessions/{id}
+    with ?offset=N, in one request or several; after a dropped connection it GETs the
+    session to learn the offset to continue from.
+    """
+    if req.kind == "photo" and req.fragment_id is None:
+        raise HTTPException(status_code=400, detail="fragment_id required for photo uploads.")
+    if req.size <= 0:
+        raise HTTPException(status_code=400, detail="size must be positive")
+    meta = {"fragment_id": req.fragment_id}
+    try:
+        upload_id = await upload_service.get_resumable_uploads().create(req.kind, req.filename, req.size, meta)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except upload_service.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return _upload_status(upload_id, 0, req.size, req.kind)
+
+@app.get("/upload-sessions/{upload_id}")
+async def get_upload_session(upload_id: str):
+    session = await run_blocking(database.get_upload_session, upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found.")
+    _, kind, _, size, received, _ = session
+    return _upload_status(upload_id, received, size, kind)
+
+@app.patch("/upload-sessions/{upload_id}")
+async def append_upload(upload_id: str, offset: int, request: Request):
+    """
+    Appends the raw request body at offset. Returns the new offset, or once the last byte
+    has arrived, the same response as /upload-photo or /upload-audio.
+    """
+    uploads = upload_service.get_resumable_uploads()
+    try:
+        session, digest = await uploads.append(upload_id, offset, request.stream())
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload not found.")
+    except upload_service.OffsetMismatch as e:
+        return JSONResponse(status_code=409, content={"detail": str(e), "offset": e.offset})
+    except upload_service.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    _, kind, filename, size, received, meta = session
+    if digest is None:
+        return _upload_status(upload_id, received, size, kind)
+
+    meta = json.loads(meta)
+    tmp_path = upload_service.partial_path(upload_id)
+    if kind == "photo":
+        result = await _attach_photo(meta["fragment_id"], tmp_path, digest, filename)
+    else:
+        path, _ = await run_blocking(upload_service.adopt, tmp_path, digest, AUDIO_DIR, _audio_extension(filename))
+        result = {"audio_url": f"http://localhost:8000/uploads/audio/{os.path.basename(path)}"}
+    await uploads.finish(upload_id)
+    return result
 
 @app.post("/synthesize")
 async def synthesize_biography():
     """
     Uses Gemini to synthesize all verified fragments into a cohesive narrative.
+    Chapters are written per category and cached; only those whose fragments changed
+    since the last call are rewritten.
     """
-    fragments = database.get_all_fragments(verified_only=True)
-    if not fragments:
-        raise HTTPException(status_code=400, detail="No verified memories to synthesize.")
-    
-    # Prepare fragments for the prompt
-    fragments_text = "\n".join([f"- [{f[0]}]: {f[1]}" for f in fragments])
-    
-    prompt = f"""
-    You are a professional biographer. Your task is to take the following scattered memory fragments from an elderly user's life and weave them into a single, cohesive, and beautiful narrative biography.
-    
-    Guidelines:
-    - Use a warm, respectful, and slightly literary tone.
-    - Group related fragments into thematic paragraphs (e.g., Childhood, Career, Love).
-    - Ensure logical flow and transitions between different stages of life.
-    - Focus on the emotional weight of the stories.
-    
-    Memory Fragments:
-    {fragments_text}
-    
-    Narrative Biography:
-    """
-    
+    if not model:
+        raise HTTPException(status_code=500, detail="Vertex AI not configured.")
     try:
-        synth_model = GenerativeModel("gemini-1.5-flash")
-        response = synth_model.generate_content(prompt)
-        content = response.text
-        
-        database.save_synthesized_narrative(content)
-        return {"narrative": content}
+        result = await synthesis_service.get_synthesizer().synthesize()
     except Exception as e:
         logging.error(f"Synthesis failed: {e}")
         raise HTTPException(status_code=500, detail="Failed to synthesize narrative.")
+    if result is None:
+        raise HTTPException(status_code=400, detail="No verified memories to synthesize.")
+    return result
+
+@app.get("/synthesize/stream")
+async def synthesize_stream(request: Request):
+    """
+    Server-sent events version of /synthesize. Chapters are sent in order as they are
+    written: "start" lists them, then each gets "chapter", its text as "delta" events and
+    "chapter_done"; "done" carries the /synthesize response. Chapters keep being written if
+    the client disconnects, and a reconnect with Last-Event-ID continues where it left off.
+    If the chapter's text no longer starts with what the client has (the server restarted
+    from an earlier checkpoint), "reset" tells it to drop that chapter's text, and the
+    chapter is sent again from the start.
+    """
+    if not model:
+        raise HTTPException(status_code=500, detail="Vertex AI not configured.")
+    synthesizer = synthesis_service.get_synthesizer()
+    drafts = await synthesizer.drafts()
+    if not drafts:
+        raise HTTPException(status_code=400, detail="No verified memories to synthesize.")
+
+    # Event ids are "<chapter digest prefix>:<characters of that chapter sent>:<their CRC32>"
+    resume_digest, resume_offset, resume_checksum = ((request.headers.get("last-event-id") or "").split(":") + ["", ""])[:3]
+    start = next((i for i, d in enumerate(drafts) if resume_digest and d.digest.startswith(resume_digest)), None)
+    try:
+        resume_checksum = int(resume_checksum, 16)
+    except ValueError:
+        resume_checksum = None
+
+    def event(name: str, data: dict, event_id: Optional[str] = None) -> str:
+        return (f"id: {event_id}\n" if event_id else "") + f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    async def generate_events():
+        yield event("start", {"chapters": [d.title for d in drafts], "resumed": start is not None})
+        for index, draft in enumerate(drafts):
+            if start is not None and index < start:
+                continue
+            offset = 0
+            key = draft.digest[:16]
+            if index == start and resume_offset.isdigit() and int(resume_offset) > 0:
+                offset = synthesis_service.resume_point(draft, int(resume_offset), resume_checksum)
+                if offset == 0:
+                    yield event("reset", {"index": index, "title": draft.title})
+            checksum = synthesis_service.stream_checksum(draft.text[:offset])
+            if offset == 0:
+                yield event("chapter", {"index": index, "title": draft.title, "cached": draft.cached}, f"{key}:0:{checksum:08x}")
+            try:
+                async for text in draft.follow(offset):
+                    offset += len(text)
+                    checksum = synthesis_service.stream_checksum(text, checksum)
+                    yield event("delta", {"index": index, "text": text}, f"{key}:{offset}:{checksum:08x}")
+            except Exception as e:
+                yield event("error", {"index": index, "title": draft.title, "detail": str(e)})
+                return
+            yield event("chapter_done", {"index": index, "version": draft.version}, f"{key}:{offset}:{checksum:08x}")
+        result = await synthesizer.finish(drafts)
+        yield event("done", result)
+
+    return StreamingResponse(generate_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.post("/seeds")
 async def add_seed(request: Request):
@@ -425,9 +813,35 @@ async def add_seed(request: Request):
     if not content:
         raise HTTPException(status_code=400, detail="Seed content required.")
     
-    database.save_seed(content)
+    await run_blocking(database.save_seed, content)
     return {"status": "Seed saved"}
 
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Returns runtime cache and background queue statistics.
+    """
+    metrics = {
+        "job_queue": job_queue.get_job_queue().metrics(),
+        "model_registry": model_registry.get_model_registry().stats(),
+        "prompt_tokens": prompt_budget.get_prompt_usage().stats(),
+        "sentiment": sentiment_service.get_sentiment_service().stats(),
+        "session_cache": session_cache.get_session_cache().stats(),
+    }
+    rag = rag_service.get_rag_service()
+    if rag:
+        metrics["embedding_cache"] = rag.cache.stats()
+    imagen = imagen_service.get_imagen_service()
+    if imagen:
+        metrics["illustration_cache"] = imagen.cache.stats()
+    vision = vision_service.get_vision_service()
+    if vision:
+        metrics["vision_cache"] = vision.stats()
+    prefix_cache = context_cache.get_context_cache()
+    if prefix_cache:
+        metrics["context_cache"] = prefix_cache.stats()
+    return metrics
+
 if __name__ == "__main__":
     import uvicorn
     # Use PORT env variable if available (Cloud Run), otherwise default to 8000 (Local)
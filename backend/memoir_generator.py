@@ -1,9 +1,18 @@
 from fpdf import FPDF
 from fpdf.enums import XPos, YPos
+from PIL import Image
 import datetime
-from typing import List, Tuple
+import hashlib
+import itertools
+import logging
+from typing import Callable, Iterable, List, Tuple, Union
 import os
 
+# Category images are drawn 120mm wide, fragment photos 80mm; 150 DPI is plenty for that and keeps PDFs small
+IMAGE_WIDTH_MM = 120
+PHOTO_WIDTH_MM = 80
+IMAGE_DPI = int(os.environ.get("MEMOIR_IMAGE_DPI", 150))
+
 class MemoirPDF(FPDF):
     def header(self):
         # Logo or Title
@@ -23,13 +32,91 @@ class MemoirGenerator:
         self.output_dir = output_dir
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
+        self.image_cache_dir = os.path.join(output_dir, ".images")
+        self._prepared = {}
+
+    @staticmethod
+    def pixels_for(width_mm: float) -> int:
+        return int(width_mm / 25.4 * IMAGE_DPI)
+
+    def prepare_image(self, path: str, width_mm: float = IMAGE_WIDTH_MM) -> str:
+        """
+        Returns a JPEG copy of path downscaled to the printed size, cached on disk by the
+        source file's identity so each illustration is decoded and resized only once.
+        """
+        stat = os.stat(path)
+        max_px = self.pixels_for(width_mm)
+        key = hashlib.sha1(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}:{max_px}".encode()).hexdigest()
+        if key in self._prepared:
+            return self._prepared[key]
+        prepared = os.path.join(self.image_cache_dir, f"{key}.jpg")
+        try:
+            # A reused copy is marked as recently used, which keeps it from export eviction
+            os.utime(prepared)
+        except FileNotFoundError:
+            os.makedirs(self.image_cache_dir, exist_ok=True)
+            with Image.open(path) as img:
+                img.thumbnail((max_px, max_px))
+                tmp_path = f"{prepared}.{os.getpid()}.tmp"
+                img.convert("RGB").save(tmp_path, "JPEG", quality=85, optimize=True)
+            os.replace(tmp_path, prepared)
+        self._prepared[key] = prepared
+        return prepared
+
+    @staticmethod
+    def _item(row) -> Tuple[str, str, str, str]:
+        """
+        Unpacks a fragment row into (category, content, context, image_url). Accepts plain
+        (category, content, context) tuples and the database's fragment rows, with or without
+        the is_verified column.
+        """
+        if len(row) == 3:
+            cat, content, ctx = row
+            return cat, content, ctx, None
+        if len(row) == 7:
+            cat, content, ctx, _, _, _, image_url = row
+        else:
+            cat, content, ctx, _, _, _, _, image_url = row
+        return cat, content, ctx, image_url
 
-    def generate(self, user_name: str, fragments: List[Tuple[str, str, str]], images: dict = None, narrative: str = None) -> str:
+    @classmethod
+    def _chapters(cls, fragments: Iterable, grouped: bool):
+        """
+        Yields (category, [(content, context, image_url), ...]) in order of each category's first fragment.
+        grouped=True means fragments already arrive grouped (e.g. database.iter_fragments), so
+        only one chapter is held in memory at a time.
+        """
+        items = map(cls._item, fragments)
+        if grouped:
+            for cat, rows in itertools.groupby(items, key=lambda f: f[0]):
+                yield cat, [(content, ctx, image_url) for _, content, ctx, image_url in rows]
+            return
+        categories = {}
+        for cat, content, ctx, image_url in items:
+            if cat not in categories:
+                categories[cat] = []
+            categories[cat].append((content, ctx, image_url))
+        yield from categories.items()
+
+    def generate(self, user_name: str, fragments: Iterable[Tuple[str, str, str]], images: dict = None, narrative: Union[str, List[Tuple[str, str]]] = None, filename: str = None, grouped: bool = False, photo_resolver: Callable = None) -> str:
         """
         Generates a styled PDF from fragments and/or a synthesized narrative.
-        fragments: List of (category, content, context)
+        fragments: Iterable of (category, content, context); see _chapters for grouped
         images: Dict mapping category names to file paths
-        narrative: Cohesive biography text
+        narrative: Cohesive biography text, or its (title, text) chapters to lay out under headings
+        filename: Output file name inside output_dir (defaults to a timestamped name)
+        photo_resolver: Maps (image_url, min_px) to a local file for fragment photos
+        """
+        pdf = self.layout(user_name, fragments, images=images, narrative=narrative, grouped=grouped, photo_resolver=photo_resolver)
+        if filename is None:
+            filename = f"Memoir_{user_name.replace(' ', '_')}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+        filepath = os.path.join(self.output_dir, filename)
+        pdf.output(filepath)
+        return filepath
+
+    def layout(self, user_name: str, fragments: Iterable[Tuple[str, str, str]], images: dict = None, narrative: Union[str, List[Tuple[str, str]]] = None, grouped: bool = False, photo_resolver: Callable = None) -> MemoirPDF:
+        """
+        Lays out the memoir in memory without writing it; see generate.
         """
         if images is None:
             images = {}
@@ -58,22 +145,21 @@ class MemoirGenerator:
             pdf.set_text_color(30, 41, 59)
             pdf.cell(0, 15, "The Collected Story", align='L', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
             pdf.ln(5)
-            pdf.set_font('Helvetica', '', 12)
-            pdf.set_text_color(15, 23, 42)
-            # Replace newlines with proper spacing for multi_cell
-            pdf.multi_cell(190, 8, narrative, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+            chapters = [(None, narrative)] if isinstance(narrative, str) else narrative
+            for title, text in chapters:
+                if title:
+                    pdf.ln(4)
+                    pdf.set_font('Helvetica', 'B', 14)
+                    pdf.set_text_color(37, 99, 235)
+                    pdf.multi_cell(190, 10, title, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+                pdf.set_font('Helvetica', '', 12)
+                pdf.set_text_color(15, 23, 42)
+                pdf.multi_cell(190, 8, text, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
         pdf.add_page()
         
-        # Group by Category (simplified)
-        categories = {}
-        for cat, content, ctx, *rest in fragments: # rest for compatibility with embedding blobs if passed
-            if cat not in categories:
-                categories[cat] = []
-            categories[cat].append((content, ctx))
-            
-        # Draw Content
-        for cat, items in categories.items():
+        # Draw Content, one category chapter at a time
+        for cat, items in self._chapters(fragments, grouped):
             pdf.ln(10)
             pdf.set_font('Helvetica', 'B', 16)
             pdf.set_text_color(30, 41, 59)
@@ -86,15 +172,23 @@ class MemoirGenerator:
             if cat in images and os.path.exists(images[cat]):
                 try:
                     # Centered image
-                    pdf.image(images[cat], x=45, w=120) 
+                    pdf.image(self.prepare_image(images[cat]), x=45, w=IMAGE_WIDTH_MM)
                     pdf.ln(10)
                 except Exception as e:
-                    print(f"Error adding image for {cat}: {e}")
+                    logging.error(f"Error adding image for {cat}: {e}")
             
-            for content, ctx in items:
+            for content, ctx, image_url in items:
                 pdf.set_font('Helvetica', 'B', 12)
                 pdf.set_text_color(15, 23, 42)
                 pdf.multi_cell(190, 8, content, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+                photo = photo_resolver(image_url, self.pixels_for(PHOTO_WIDTH_MM)) if photo_resolver and image_url else None
+                if photo:
+                    try:
+                        pdf.image(self.prepare_image(photo, PHOTO_WIDTH_MM), x=65, w=PHOTO_WIDTH_MM)
+                        pdf.ln(3)
+                    except Exception as e:
+                        logging.error(f"Error adding photo {image_url}: {e}")
                 
                 if ctx:
                     pdf.set_font('Helvetica', 'I', 10)
@@ -102,11 +196,7 @@ class MemoirGenerator:
                     pdf.multi_cell(190, 6, f"Context: {ctx}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
                 
                 pdf.ln(5)
-        
-        filename = f"Memoir_{user_name.replace(' ', '_')}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-        filepath = os.path.join(self.output_dir, filename)
-        pdf.output(filepath)
-        return filepath
+        return pdf
 
 # Test local generation
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+from vertexai.generative_models import GenerativeModel
+import json
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+class BoundModel(GenerativeModel):
+    """
+    A pooled model with its own system instruction or cached content. It copies the pooled
+    model's settings but takes its API clients (and so their gRPC channels) from it instead
+    of opening new ones, so creating one per request costs a dict copy.
+    """
+    def __init__(self, base: GenerativeModel, system_instruction=None, cached_content=None):
+        # GenerativeModel.__init__ would re-resolve the model name and validate the config
+        self.__dict__.update({k: v for k, v in base.__dict__.items() if k not in _CLIENT_ATTRIBUTES})
+        self._base = base
+        self._system_instruction = system_instruction
+        self._cached_content = cached_content
+
+    @property
+    def _prediction_client(self):
+        return self._base._prediction_client
+
+    @property
+    def _prediction_async_client(self):
+        return self._base._prediction_async_client
+
+    @property
+    def _llm_utility_client(self):
+        return self._base._llm_utility_client
+
+    @property
+    def _llm_utility_async_client(self):
+        return self._base._llm_utility_async_client
+
+_CLIENT_ATTRIBUTES = {"_prediction_client", "_prediction_async_client", "_llm_utility_client", "_llm_utility_async_client"}
+
+def _config_key(config) -> Optional[str]:
+    if config is None:
+        return None
+    if hasattr(config, "to_dict"):
+        config = config.to_dict()
+    return json.dumps(config, sort_keys=True, default=repr)
+
+class ModelRegistry:
+    """
+    Long-lived GenerativeModel instances, one per model name and configuration. Each keeps
+    its API clients for the life of the process; the SDK creates them lazily per instance,
+    so a model built per request paid for a fresh channel and TLS handshake on every call.
+    """
+    def __init__(self):
+        self._models: Dict[Tuple, GenerativeModel] = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def get(self, model_name: str, generation_config=None, safety_settings=None) -> GenerativeModel:
+        key = (model_name, _config_key(generation_config), _config_key(safety_settings))
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self.reused += 1
+                return model
+        model = GenerativeModel(model_name, generation_config=generation_config, safety_settings=safety_settings)
+        with self._lock:
+            # Another thread may have built the same model meanwhile; keep the first
+            pooled = self._models.setdefault(key, model)
+            if pooled is model:
+                self.created += 1
+                logging.info(f"Model registry: created {model_name}")
+        return pooled
+
+    def bind(self, model_name: str, system_instruction, generation_config=None, safety_settings=None) -> GenerativeModel:
+        """
+        Returns the pooled model for model_name with a per-call system instruction.
+        """
+        base = self.get(model_name, generation_config, safety_settings)
+        if not system_instruction:
+            return base
+        return BoundModel(base, system_instruction)
+
+    def with_cached_content(self, model_name: str, cached_content, generation_config=None, safety_settings=None) -> GenerativeModel:
+        """
+        Returns the pooled model for model_name with a Vertex AI context cache as the prefix
+        of every request (GenerativeModel.from_cached_content without a new client).
+        """
+        return BoundModel(self.get(model_name, generation_config, safety_settings), cached_content=cached_content)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"models": len(self._models), "created": self.created, "reused": self.reused}
+
+_registry_instance = None
+
+def get_model_registry() -> ModelRegistry:
+    global _registry_instance
+    if _registry_instance is None:
+        _registry_instance = ModelRegistry()
+    return _registry_instance
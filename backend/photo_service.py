@@ -0,0 +1,111 @@
+import logging
+import os
+import re
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+PHOTO_DIR = os.path.join("uploads", "images")
+VARIANT_DIR = os.path.join(PHOTO_DIR, "variants")
+# Long-edge sizes in pixels: grid thumbnails, full-screen viewing, and print (8in at 300 DPI)
+VARIANTS = {"thumb": 320, "screen": 1600, "print": 2400}
+VARIANT_QUALITY = 85
+ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "heic", "gif", "bmp", "tiff"}
+
+_PHOTO_ID = re.compile(r"^[0-9a-f]{32}$")
+
+def normalize_extension(filename: Optional[str]) -> str:
+    ext = filename.rsplit(".", 1)[-1].lower() if filename and "." in filename else "jpg"
+    return ext if ext in ALLOWED_EXTENSIONS else "jpg"
+
+def find_original(pid: str) -> Optional[str]:
+    if not _PHOTO_ID.match(pid or ""):
+        return None
+    for ext in ALLOWED_EXTENSIONS:
+        path = os.path.join(PHOTO_DIR, f"{pid}.{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+def photo_id_from_url(url: Optional[str]) -> Optional[str]:
+    """
+    Returns the photo id for content-addressed upload URLs, or None for other images.
+    """
+    if not url:
+        return None
+    pid = url.rsplit("/", 1)[-1].split(".", 1)[0]
+    return pid if _PHOTO_ID.match(pid) else None
+
+def adopt_original(tmp_path: str, digest: str, filename: Optional[str]) -> Tuple[str, str, bool]:
+    """
+    Stores a file already streamed to disk and hashed (see upload_service) under its
+    content hash. The temporary file is moved into place, or discarded if the same photo
+    was uploaded before. Returns (photo_id, path, created).
+    """
+    pid = digest[:32]
+    existing = find_original(pid)
+    if existing:
+        os.remove(tmp_path)
+        return pid, existing, False
+    os.makedirs(PHOTO_DIR, exist_ok=True)
+    path = os.path.join(PHOTO_DIR, f"{pid}.{normalize_extension(filename)}")
+    os.replace(tmp_path, path)
+    return pid, path, True
+
+def variant_path(pid: str, variant: str) -> str:
+    return os.path.join(VARIANT_DIR, f"{pid}_{variant}.jpg")
+
+def generate_variants(pid: str) -> Dict[str, str]:
+    """
+    Writes the resized JPEG variants of a photo that are smaller than the original.
+    Existing variants are kept. Returns {variant: path}.
+    """
+    original = find_original(pid)
+    if original is None:
+        raise FileNotFoundError(f"No uploaded photo {pid}")
+    os.makedirs(VARIANT_DIR, exist_ok=True)
+    written = {}
+    with Image.open(original) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        for variant, size in sorted(VARIANTS.items(), key=lambda item: item[1]):
+            path = variant_path(pid, variant)
+            if os.path.exists(path):
+                written[variant] = path
+                continue
+            if max(img.size) <= size:
+                break  # larger variants would only upscale; the original serves them
+            resized = img.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+            tmp_path = f"{path}.tmp"
+            resized.save(tmp_path, "JPEG", quality=VARIANT_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, path)
+            written[variant] = path
+    logging.info(f"Prepared {len(written)} variants for photo {pid}")
+    return written
+
+def pick_variant(pid: str, min_px: int = 0) -> Optional[str]:
+    """
+    Returns the smallest existing variant whose long edge is at least min_px, falling back
+    to the original when no variant is large enough (or none has been generated yet).
+    """
+    if not _PHOTO_ID.match(pid or ""):
+        return None
+    for variant, size in sorted(VARIANTS.items(), key=lambda item: item[1]):
+        if size >= min_px:
+            path = variant_path(pid, variant)
+            if os.path.exists(path):
+                return path
+    return find_original(pid)
+
+def resolve_image_url(url: Optional[str], min_px: int = 0) -> Optional[str]:
+    """
+    Maps a fragment's image_url to the smallest adequate local file, for the PDF generator.
+    """
+    pid = photo_id_from_url(url)
+    if pid:
+        return pick_variant(pid, min_px)
+    if url and "/uploads/" in url:
+        # Photos uploaded before content addressing: serve the original file as-is
+        path = os.path.normpath(os.path.join("uploads", url.split("/uploads/", 1)[1]))
+        return path if path.startswith("uploads" + os.sep) and os.path.exists(path) else None
+    return None
@@ -0,0 +1,137 @@
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+from embedding_cache import normalize_text
+
+# Token budgets for the context sections appended to the system instruction
+MEMORY_BUDGET_TOKENS = int(os.environ.get("MEMORY_BUDGET_TOKENS", 600))
+SEEDS_BUDGET_TOKENS = int(os.environ.get("SEEDS_BUDGET_TOKENS", 200))
+# Longer memories or seeds are cut to this many tokens so one item can't take a whole section
+ITEM_MAX_TOKENS = int(os.environ.get("ITEM_MAX_TOKENS", 120))
+# Ranking: weight of relevance against recency (both scaled to 0..1)
+RELEVANCE_WEIGHT = float(os.environ.get("RELEVANCE_WEIGHT", 0.7))
+# Items whose word sets overlap at least this much (Jaccard) count as duplicates
+DUPLICATE_SIMILARITY = float(os.environ.get("DUPLICATE_SIMILARITY", 0.8))
+
+_PIECES = re.compile(r"\w+|[^\w\s]")
+_WORDS = re.compile(r"\w+")
+_STOPWORDS = {"a", "an", "and", "are", "about", "at", "be", "did", "do", "for", "from", "i", "in", "is", "it",
+              "me", "my", "of", "on", "or", "tell", "that", "the", "to", "was", "we", "what", "when", "where",
+              "who", "with", "you", "your"}
+
+Candidate = Tuple[str, float, float]  # (text, relevance, recency)
+
+def estimate_tokens(text: str) -> int:
+    """
+    Local estimate of Gemini tokens: each word or punctuation mark is at least one token,
+    and long words count one token per six characters (common words are single pieces in
+    SentencePiece vocabularies, rarer ones split). Rough, but enough to budget with, and
+    free compared to a count_tokens round trip.
+    """
+    return sum((len(piece) + 5) // 6 for piece in _PIECES.findall(text or ""))
+
+def truncate(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    words, used = [], 1  # the ellipsis
+    for word in text.split():
+        cost = estimate_tokens(word)
+        if used + cost > max_tokens:
+            break
+        words.append(word)
+        used += cost
+    return " ".join(words) + "…"
+
+def content_words(text: str) -> set:
+    return {w for w in _WORDS.findall(normalize_text(text)) if w not in _STOPWORDS}
+
+def lexical_relevance(query: str, text: str) -> float:
+    """
+    Share of the query's content words that appear in text.
+    """
+    query_words = content_words(query)
+    if not query_words:
+        return 0.0
+    return len(query_words & content_words(text)) / len(query_words)
+
+def rank_relevance(n: int) -> List[float]:
+    """
+    Relevance for results that arrive already ranked: 1.0 for the first, falling linearly.
+    """
+    return [1.0 - i / n for i in range(n)]
+
+def recency(ids: Sequence[int]) -> Dict[int, float]:
+    """
+    Scales row ids (which grow with insertion time) to 0..1, newest 1.0.
+    """
+    ordered = sorted(set(ids))
+    if len(ordered) < 2:
+        return {i: 1.0 for i in ordered}
+    return {i: rank / (len(ordered) - 1) for rank, i in enumerate(ordered)}
+
+def _is_duplicate(words: set, kept: List[set]) -> bool:
+    for other in kept:
+        union = words | other
+        if union and len(words & other) / len(union) >= DUPLICATE_SIMILARITY:
+            return True
+    return False
+
+def pack(header: str, candidates: List[Candidate], budget_tokens: int, item_max_tokens: int = ITEM_MAX_TOKENS) -> Tuple[str, int, int]:
+    """
+    Builds a "header + one line per item" section from the best candidates that fit in
+    budget_tokens. Candidates are ranked by relevance and recency, near-duplicates of a
+    better candidate are dropped and long items are truncated.
+    Returns (section, tokens used, items dropped); section is "" if nothing fits.
+    """
+    ranked = sorted(candidates, key=lambda c: -(RELEVANCE_WEIGHT * c[1] + (1 - RELEVANCE_WEIGHT) * c[2]))
+    lines, kept_words = [], []
+    used = estimate_tokens(header)
+    for text, _, _ in ranked:
+        words = content_words(text) or {normalize_text(text)}
+        if _is_duplicate(words, kept_words):
+            continue
+        line = f"- {truncate(text, item_max_tokens)}\n"
+        cost = estimate_tokens(line)
+        if used + cost > budget_tokens:
+            continue  # a shorter, lower-ranked item may still fit
+        lines.append(line)
+        kept_words.append(words)
+        used += cost
+    if not lines:
+        return "", 0, len(candidates)
+    return header + "".join(lines), used, len(candidates) - len(lines)
+
+class PromptUsage:
+    """
+    Running totals of the estimated tokens each prompt section used, for /metrics.
+    """
+    def __init__(self):
+        self._sections: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, sections: Dict[str, int]):
+        with self._lock:
+            for name, tokens in sections.items():
+                entry = self._sections.setdefault(name, {"turns": 0, "tokens": 0, "max_tokens": 0})
+                entry["turns"] += 1
+                entry["tokens"] += tokens
+                entry["max_tokens"] = max(entry["max_tokens"], tokens)
+        logging.debug(f"Prompt tokens per section: {sections}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                name: {"turns": e["turns"], "avg_tokens": round(e["tokens"] / e["turns"], 1), "max_tokens": e["max_tokens"]}
+                for name, e in self._sections.items()
+            }
+
+_usage_instance = None
+
+def get_prompt_usage() -> PromptUsage:
+    global _usage_instance
+    if _usage_instance is None:
+        _usage_instance = PromptUsage()
+    return _usage_instance
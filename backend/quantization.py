@@ -0,0 +1,47 @@
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from config import EMBEDDING_MODEL
+# How fragment embeddings are stored: "int8" (per-vector scale), "float16" or "float32"
+EMBEDDING_STORAGE_DTYPE = os.environ.get("EMBEDDING_STORAGE_DTYPE", "int8").lower()
+# Matryoshka-style truncation: keep only the leading dimensions (0 keeps them all).
+# text-embedding-004 is trained to front-load information, so a prefix remains a usable embedding.
+EMBEDDING_DIM = int(os.environ.get("EMBEDDING_DIM", 0))
+
+_DTYPES = {"int8": np.int8, "float16": np.float16, "float32": np.float32}
+
+def as_vector(embedding) -> np.ndarray:
+    """
+    Accepts a float32 blob (as written by RAGService.serialize_embedding) or a sequence of floats.
+    """
+    if isinstance(embedding, (bytes, bytearray, memoryview)):
+        return np.frombuffer(embedding, dtype=np.float32)
+    return np.asarray(embedding, dtype=np.float32)
+
+def truncate(vector, dim: int = EMBEDDING_DIM) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector[:dim] if dim and len(vector) > dim else vector
+
+def quantize(vector, dtype: str = EMBEDDING_STORAGE_DTYPE, dim: int = EMBEDDING_DIM) -> Tuple[str, int, float, bytes]:
+    """
+    Returns (dtype, dim, scale, blob) for storage. int8 uses symmetric per-vector scaling.
+    """
+    if dtype not in _DTYPES:
+        raise ValueError(f"Unsupported embedding storage dtype: {dtype}")
+    vector = truncate(as_vector(vector), dim)
+    if dtype == "int8":
+        peak = float(np.max(np.abs(vector))) if len(vector) else 0.0
+        scale = peak / 127.0 if peak > 0 else 1.0
+        codes = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        return dtype, len(vector), scale, codes.tobytes()
+    return dtype, len(vector), 1.0, vector.astype(_DTYPES[dtype]).tobytes()
+
+def dequantize(dtype: str, dim: int, scale: float, blob: Optional[bytes]) -> Optional[np.ndarray]:
+    if blob is None:
+        return None
+    codes = np.frombuffer(blob, dtype=_DTYPES[dtype], count=dim)
+    if dtype == "int8":
+        return codes.astype(np.float32) * np.float32(scale)
+    return codes.astype(np.float32)
@@ -1,26 +1,115 @@
 import numpy as np
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import vertexai
 from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
+import asyncio
 import logging
 import os
+import threading
+import time
+
+import config
+import database
+import quantization
+from async_utils import run_blocking
+from embedding_cache import EmbeddingCache
+from vector_index import EmbeddingIndex, create_index, top_k_indices
+
+# Hybrid retrieval: BM25 (FTS5) and vector rankings are merged with reciprocal rank fusion
+RAG_HYBRID = os.environ.get("RAG_HYBRID", "1") != "0"
+RRF_K = 60
+HYBRID_CANDIDATES = 20
+# If the query embedding takes longer than this, answer from the lexical ranking alone
+RAG_EMBEDDING_TIMEOUT = float(os.environ.get("RAG_EMBEDDING_TIMEOUT", 1.0))
+# Verified fragments without an embedding are embedded before a retrieval, at most this many
+# per turn; after a failed attempt the backfill waits RAG_BACKFILL_RETRY seconds
+RAG_BACKFILL_BATCH = int(os.environ.get("RAG_BACKFILL_BATCH", 32))
+RAG_BACKFILL_RETRY = float(os.environ.get("RAG_BACKFILL_RETRY", 60))
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = RRF_K) -> List[int]:
+    """
+    Merges ranked id lists: each id scores sum(1 / (k + rank)) over the lists it appears in.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, fid in enumerate(ranking, start=1):
+            scores[fid] = scores.get(fid, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda fid: -scores[fid])
 
 class RAGService:
+    # Maximum number of texts text-embedding-004 accepts in one request
+    EMBEDDING_BATCH_SIZE = 250
+
     def __init__(self, project_id: str, location: str = "us-central1"):
         self.project_id = project_id
         self.location = location
-        self.model_name = "text-embedding-004"
+        self.model_name = config.EMBEDDING_MODEL
         # vertexai.init should be called in the main app
         self.embedding_model = TextEmbeddingModel.from_pretrained(self.model_name)
-        
+        # Repeated queries (e.g. retried turns) are answered from here instead of the API
+        self.cache = EmbeddingCache()
+        # Index over verified fragments, loaded lazily on first retrieval
+        self.index = create_index(path=os.path.join(os.path.dirname(database.DB_PATH), "memoria.ivf.npz"))
+        self._index_loaded = False
+        self._missing_ids = set()  # verified fragments that still need an embedding
+        self._backfill_retry_at = 0.0
+        self._backfill_lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        database.add_fragment_listener(self._on_fragments_changed)
+
+    def _batches(self, texts: List[str]) -> List[List[TextEmbeddingInput]]:
+        """
+        Splits texts into request-sized lists of embedding inputs.
+        """
+        inputs = [TextEmbeddingInput(text) for text in texts]
+        return [inputs[i:i + self.EMBEDDING_BATCH_SIZE] for i in range(0, len(inputs), self.EMBEDDING_BATCH_SIZE)]
+
+    def _lookup_cached(self, texts: List[str]) -> Tuple[List[str], List[Optional[List[float]]]]:
+        keys = [EmbeddingCache.make_key(text, self.model_name) for text in texts]
+        return keys, [self.cache.get(key) for key in keys]
+
+    def _store_embedded(self, keys: List[str], results: List, missing: List[int], embeddings) -> List[List[float]]:
+        vectors = [e.values for e in embeddings]
+        for i, vector in zip(missing, vectors):
+            results[i] = vector
+        self.cache.put_many(self.model_name, [(keys[i], vector) for i, vector in zip(missing, vectors)])
+        return results
+
     def get_embeddings(self, texts: List[str]) -> List[List[float]]:
         """
-        Generate embeddings for a list of strings.
+        Generate embeddings for a list of strings, serving repeats from the cache.
         """
         try:
-            inputs = [TextEmbeddingInput(text) for text in texts]
-            embeddings = self.embedding_model.get_embeddings(inputs)
-            return [e.values for e in embeddings]
+            keys, results = self._lookup_cached(texts)
+            missing = [i for i, vector in enumerate(results) if vector is None]
+            if not missing:
+                return results
+            embeddings = []
+            for batch in self._batches([texts[i] for i in missing]):
+                embeddings.extend(self.embedding_model.get_embeddings(batch))
+            return self._store_embedded(keys, results, missing, embeddings)
+        except Exception as e:
+            logging.error(f"Error generating embeddings: {e}")
+            return []
+
+    async def get_embeddings_async(self, texts: List[str]) -> List[List[float]]:
+        """
+        Generate embeddings for a list of strings without blocking the event loop.
+        """
+        try:
+            if self.cache.persist:
+                keys, results = await run_blocking(self._lookup_cached, texts)
+            else:
+                keys, results = self._lookup_cached(texts)
+            missing = [i for i, vector in enumerate(results) if vector is None]
+            if not missing:
+                return results
+            embeddings = []
+            for batch in self._batches([texts[i] for i in missing]):
+                embeddings.extend(await self.embedding_model.get_embeddings_async(batch))
+            if self.cache.persist:
+                return await run_blocking(self._store_embedded, keys, results, missing, embeddings)
+            return self._store_embedded(keys, results, missing, embeddings)
         except Exception as e:
             logging.error(f"Error generating embeddings: {e}")
             return []
@@ -42,33 +131,166 @@ class RAGService:
     def deserialize_embedding(self, blob: bytes) -> np.ndarray:
         return np.frombuffer(blob, dtype=np.float32)
 
-    def retrieve_relevant(self, query: str, stored_fragments: List[Tuple[str, str, str, bytes]], top_k: int = 5) -> List[Tuple[str, str, str]]:
+    @staticmethod
+    def _usable(vector: Optional[np.ndarray]) -> bool:
+        # Vectors stored before EMBEDDING_DIM was raised are too short and get re-embedded
+        return vector is not None and (not quantization.EMBEDDING_DIM or len(vector) >= quantization.EMBEDDING_DIM)
+
+    def load_index(self):
+        """
+        Builds the resident index from the stored (dequantized) fragment embeddings.
+        """
+        with self._index_lock:
+            rows = database.get_fragment_embeddings(verified_only=True)
+            items = []
+            self._missing_ids = set()
+            for fid, cat, content, vector in rows:
+                if self._usable(vector):
+                    items.append((fid, quantization.truncate(vector)))
+                else:
+                    self._missing_ids.add(fid)
+            self.index.build(items)
+            self._index_loaded = True
+            logging.info(f"Loaded {len(self.index)} fragment embeddings into the RAG index")
+
+    def _on_fragments_changed(self, changes: List[database.FragmentChange]):
+        if not self._index_loaded:
+            return
+        for change in changes:
+            indexed = change.is_verified and not change.deleted
+            if indexed and self._usable(change.embedding):
+                self._missing_ids.discard(change.fragment_id)
+                self.index.upsert(change.fragment_id, quantization.truncate(change.embedding))
+            else:
+                self.index.remove(change.fragment_id)
+                if indexed:
+                    self._missing_ids.add(change.fragment_id)
+                else:
+                    self._missing_ids.discard(change.fragment_id)
+
+    def _backfill_missing(self):
+        """
+        Embeds up to RAG_BACKFILL_BATCH verified fragments that were stored without an
+        embedding and persists the result. Skipped while another turn is backfilling or
+        while backing off after the embedding API failed.
+        """
+        if time.time() < self._backfill_retry_at or not self._backfill_lock.acquire(blocking=False):
+            return
+        try:
+            missing = list(self._missing_ids)[:RAG_BACKFILL_BATCH]
+            if not missing:
+                return
+            rows = database.get_fragments_by_ids(missing)
+            embeddings = self.get_embeddings([f"{cat}: {content}" for _, cat, content, _ in rows])
+            if len(embeddings) != len(rows):
+                self._backfill_retry_at = time.time() + RAG_BACKFILL_RETRY
+                logging.warning(f"Embedding backfill failed; retrying in {RAG_BACKFILL_RETRY:.0f}s")
+                return
+            for (fid, *_), emb in zip(rows, embeddings):
+                database.update_fragment_embedding(fid, self.serialize_embedding(emb))
+            self._missing_ids.difference_update(missing)
+        finally:
+            self._backfill_lock.release()
+
+    def _rank(self, query_embedding: np.ndarray, matrix: np.ndarray, top_k: int) -> np.ndarray:
+        """
+        Returns row indices of the top_k rows of matrix by cosine similarity, best first.
+        """
+        norms = np.linalg.norm(matrix, axis=1)
+        norms[norms == 0] = 1.0
+        scores = (matrix @ EmbeddingIndex.normalize(query_embedding)) / norms
+        return top_k_indices(scores, top_k)
+
+    def retrieve_relevant(self, query: str, stored_fragments: Optional[List[Tuple]] = None, top_k: int = 5) -> List[Tuple[str, str, str]]:
         """
         Retrieve top_k relevant fragments based on query.
-        stored_fragments: List of (category, content, context, embedding_blob)
+        stored_fragments: List of (category, content, context, embedding_blob, ...).
+        When omitted, the resident index of verified fragments is searched instead.
         """
+        if stored_fragments is None:
+            return self.retrieve_from_index(query, top_k)
         if not stored_fragments:
             return []
-            
+
         # 1. Get embedding for the query
-        query_embedding = np.array(self.get_embeddings([query])[0])
-        
-        # 2. Calculate similarities
-        similarities = []
+        query_embeddings = self.get_embeddings([query])
+        if not query_embeddings:
+            return []
+        query_embedding = quantization.truncate(query_embeddings[0])
+
+        # 2. Stack fragment embeddings, embedding any missing ones in a single request
+        missing = [i for i, frag in enumerate(stored_fragments) if not frag[3]]
+        fallback = {}
+        if missing:
+            texts = [f"{stored_fragments[i][0]}: {stored_fragments[i][1]}" for i in missing]
+            fallback = dict(zip(missing, self.get_embeddings(texts)))
+        rows, vectors = [], []
         for i, frag in enumerate(stored_fragments):
-            cat, content, context, blob = frag
-            if blob:
-                frag_emb = self.deserialize_embedding(blob)
-            else:
-                # Fallback if no embedding stored (shouldn't happen with new ones)
-                frag_emb = np.array(self.get_embeddings([f"{cat}: {content}"])[0])
-            
-            sim = self.cosine_similarity(query_embedding, frag_emb)
-            similarities.append((sim, (cat, content, context)))
-            
-        # 3. Sort and return top_k
-        similarities.sort(key=lambda x: x[0], reverse=True)
-        return [item[1] for item in similarities[:top_k]]
+            vec = self.deserialize_embedding(frag[3]) if frag[3] else fallback.get(i)
+            vec = quantization.truncate(vec) if vec is not None else None
+            if vec is not None and len(vec) == len(query_embedding):
+                rows.append(i)
+                vectors.append(vec)
+        if not vectors:
+            return []
+
+        # 3. Score with one matrix-vector product and take top_k
+        top = self._rank(query_embedding, np.asarray(vectors, dtype=np.float32), top_k)
+        return [tuple(stored_fragments[rows[i]][:3]) for i in top]
+
+    def _prepare_index(self):
+        if not self._index_loaded:
+            self.load_index()
+        if self._missing_ids:
+            self._backfill_missing()
+
+    def _lexical(self, query: str) -> List[int]:
+        return database.search_fragments_text(query, HYBRID_CANDIDATES) if RAG_HYBRID else []
+
+    def _lookup(self, query_embedding, top_k: int, lexical: Optional[List[int]] = None) -> List[Tuple[str, str, str]]:
+        rankings = []
+        if query_embedding is not None and len(self.index):
+            depth = max(top_k, HYBRID_CANDIDATES) if lexical else top_k
+            rankings.append([fid for fid, _ in self.index.search(quantization.truncate(query_embedding), depth)])
+        if lexical:
+            rankings.append(lexical)
+        ids = rankings[0][:top_k] if len(rankings) == 1 else reciprocal_rank_fusion(rankings)[:top_k]
+        rows = database.get_fragments_by_ids(ids)
+        return [(cat, content, ctx) for _, cat, content, ctx in rows]
+
+    def retrieve_from_index(self, query: str, top_k: int = 5) -> List[Tuple[str, str, str]]:
+        """
+        Retrieve top_k verified fragments from the resident index, fused with full-text matches.
+        """
+        self._prepare_index()
+        lexical = self._lexical(query)
+        if len(self.index) == 0 and not lexical:
+            return []
+        query_embeddings = self.get_embeddings([query])
+        return self._lookup(query_embeddings[0] if query_embeddings else None, top_k, lexical)
+
+    async def _embed_query(self, query: str) -> Optional[List[float]]:
+        try:
+            query_embeddings = await asyncio.wait_for(self.get_embeddings_async([query]), RAG_EMBEDDING_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"Query embedding timed out after {RAG_EMBEDDING_TIMEOUT}s; using lexical retrieval only")
+            return None
+        return query_embeddings[0] if query_embeddings else None
+
+    async def retrieve_relevant_async(self, query: str, top_k: int = 5) -> List[Tuple[str, str, str]]:
+        """
+        Async variant of retrieve_from_index: the query embedding uses the async SDK call and
+        the index/database work runs on the blocking thread pool. If the embedding API is slow
+        or failing, the full-text ranking is used on its own.
+        """
+        await run_blocking(self._prepare_index)
+        lexical, query_embedding = await asyncio.gather(
+            run_blocking(self._lexical, query),
+            self._embed_query(query) if len(self.index) else asyncio.sleep(0),
+        )
+        if query_embedding is None and not lexical:
+            return []
+        return await run_blocking(self._lookup, query_embedding, top_k, lexical)
 
 # Singleton instance
 _rag_instance = None
@@ -76,8 +298,8 @@ _rag_instance = None
 def get_rag_service() -> RAGService:
     global _rag_instance
     if _rag_instance is None:
-        project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
-        location = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
+        project_id = config.PROJECT_ID
+        location = config.LOCATION
         if project_id:
             _rag_instance = RAGService(project_id, location)
         else:
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+from typing import Optional, Tuple
+
+import config
+import database
+import model_registry
+from async_utils import run_blocking
+
+# Turns classified with less confidence than this count as unsure
+SENTIMENT_MIN_CONFIDENCE = float(os.environ.get("SENTIMENT_MIN_CONFIDENCE", 0.6))
+# Ask the FAST_MODEL about unsure turns. Off until bench_sentiment.py shows its round trip
+# fits SENTIMENT_FALLBACK_TIMEOUT and it labels the unsure turns better than the lexicon
+SENTIMENT_LLM_FALLBACK = os.environ.get("SENTIMENT_LLM_FALLBACK", "false").lower() == "true"
+# The fallback gives up after this long and keeps the local label; below the turn's
+# SENTIMENT_TIMEOUT so a slow fallback doesn't lose the sentiment altogether
+SENTIMENT_FALLBACK_TIMEOUT = float(os.environ.get("SENTIMENT_FALLBACK_TIMEOUT", 0.25))
+# Keep the text of unsure turns in sentiment_samples for labelling. These are the user's
+# own words, so it is opt-in and samples are deleted after SENTIMENT_SAMPLE_RETENTION
+SENTIMENT_RECORD_SAMPLES = os.environ.get("SENTIMENT_RECORD_SAMPLES", "false").lower() == "true"
+SENTIMENT_SAMPLE_RETENTION = float(os.environ.get("SENTIMENT_SAMPLE_RETENTION", 14 * 24 * 3600))
+# Absolute score at which a one-sided turn counts as fully confident
+SENTIMENT_STRONG_SCORE = 2.0
+# Confidence for turns with no lexicon words at all; these are almost always plain narration
+SENTIMENT_NEUTRAL_CONFIDENCE = 0.75
+
+LABELS = ("positive", "neutral", "sad")
+LLM_PROMPT = "Analyze the sentiment of this text: '{text}'. Return only one word: 'positive', 'neutral', or 'sad/emotional'."
+
+# Valences, tuned to what people say when recalling their lives: loss, illness and
+# loneliness weigh most, since those are the turns that need a gentler tone
+LEXICON = {
+    # sad / emotional
+    "died": -3, "dead": -3, "death": -3, "funeral": -3, "grave": -2, "grief": -3, "grieve": -3, "grieving": -3,
+    "mourn": -3, "mourning": -3, "widow": -2, "widower": -2, "cancer": -3, "illness": -2, "sick": -2, "hospital": -1,
+    "miss": -2, "missed": -1, "missing": -2, "lost": -2, "lose": -2, "losing": -2, "loss": -3, "alone": -2, "lonely": -3,
+    "loneliness": -3, "sad": -3, "sadness": -3, "sorrow": -3, "cry": -2, "cried": -2, "crying": -2, "tears": -2,
+    "hurt": -2, "hurts": -2, "pain": -2, "painful": -3, "hard": -1, "difficult": -1, "afraid": -2, "scared": -2,
+    "fear": -2, "war": -2, "regret": -2, "regrets": -2, "sorry": -1, "terrible": -3, "awful": -3, "worst": -3,
+    "heartbroken": -3, "broke": -1, "divorce": -2, "divorced": -2, "poor": -1, "hungry": -1, "angry": -2,
+    "unhappy": -3, "depressed": -3, "upset": -2, "guilt": -2, "ashamed": -2, "bad": -2, "worried": -2, "tired": -1,
+    # positive
+    "happy": 2, "happiest": 3, "happiness": 3, "joy": 3, "love": 2, "loved": 2, "lovely": 2, "wonderful": 3,
+    "beautiful": 2, "best": 2, "great": 2, "greatest": 2, "good": 1, "fun": 2, "laugh": 2, "laughed": 2, "laughing": 2,
+    "proud": 2, "grateful": 2, "thankful": 2, "lucky": 2, "blessed": 2, "blessing": 2, "enjoyed": 2, "enjoy": 2, "delighted": 3,
+    "exciting": 2, "excited": 2, "favourite": 2, "favorite": 2, "amazing": 3, "fantastic": 3, "glad": 2,
+    "celebrate": 2, "celebrated": 2, "wedding": 1, "adventure": 1, "fond": 2, "cherish": 2, "smile": 2, "nice": 1,
+}
+PHRASES = {
+    "passed away": -3, "passed on": -3, "no longer with us": -3, "not with us": -3, "lost my": -3, "lost our": -3,
+    "broke my heart": -3, "miss him": -3, "miss her": -3, "miss them": -3, "fell ill": -2, "good old days": 1,
+    "fell in love": 3, "best day": 3, "best years": 3, "so proud": 3,
+}
+NEGATIONS = {"not", "no", "never", "without", "hardly", "nothing", "nobody", "nor", "cannot"}
+INTENSIFIERS = {"very": 1.5, "so": 1.5, "really": 1.5, "deeply": 1.8, "terribly": 1.8, "truly": 1.5, "extremely": 1.8, "too": 1.3}
+
+_TOKENS = re.compile(r"[a-z]+(?:'[a-z]+)?")
+_PHRASE_PATTERN = re.compile(r"\b(" + "|".join(re.escape(p) for p in sorted(PHRASES, key=len, reverse=True)) + r")\b")
+
+def score(text: str) -> Tuple[float, float, float]:
+    """
+    Returns (score, positive weight, negative weight). A lexicon word right after an
+    intensifier is amplified; within three words after a negation it is flipped and
+    damped ("not happy" is mildly negative, "never sad" mildly positive).
+    """
+    text = (text or "").lower().replace("’", "'")
+    positive = negative = 0.0
+
+    def add(valence: float):
+        nonlocal positive, negative
+        if valence > 0:
+            positive += valence
+        else:
+            negative -= valence
+
+    for match in _PHRASE_PATTERN.finditer(text):
+        add(PHRASES[match.group(1)])
+    text = _PHRASE_PATTERN.sub(" ", text)
+
+    tokens = _TOKENS.findall(text)
+    for i, token in enumerate(tokens):
+        valence = LEXICON.get(token)
+        if valence is None:
+            continue
+        if i and tokens[i - 1] in INTENSIFIERS:
+            valence *= INTENSIFIERS[tokens[i - 1]]
+        if any(t in NEGATIONS or t.endswith("n't") for t in tokens[max(0, i - 3):i]):
+            valence *= -0.5
+        add(valence)
+    return positive - negative, positive, negative
+
+def classify(text: str) -> Tuple[str, float]:
+    """
+    Local lexicon classification. Returns (label, confidence in 0..1), label one of LABELS.
+    Confidence is low when the turn mixes positive and negative words or its score is weak.
+    """
+    total, positive, negative = score(text)
+    if positive == negative == 0:
+        return "neutral", SENTIMENT_NEUTRAL_CONFIDENCE
+    balance = abs(positive - negative) / (positive + negative)
+    confidence = balance * min(1.0, abs(total) / SENTIMENT_STRONG_SCORE)
+    if total <= -1:
+        return "sad", confidence
+    if total >= 1:
+        return "positive", confidence
+    return "neutral", confidence
+
+def parse_label(response_text: str) -> str:
+    """
+    Maps the LLM's one-word answer onto LABELS.
+    """
+    answer = response_text.strip().lower()
+    if "sad" in answer or "emotional" in answer:
+        return "sad"
+    if "positive" in answer:
+        return "positive"
+    return "neutral"
+
+class SentimentService:
+    """
+    Sentiment of a user turn, classified locally in well under a millisecond. Turns the
+    lexicon isn't confident about can be sent to the FAST_MODEL under a deadline
+    (use_llm), and recorded in sentiment_samples for labelling (record_samples); both
+    are off by default.
+    """
+    def __init__(self, min_confidence: float = SENTIMENT_MIN_CONFIDENCE, use_llm: bool = SENTIMENT_LLM_FALLBACK,
+                 fallback_timeout: float = SENTIMENT_FALLBACK_TIMEOUT, record_samples: bool = SENTIMENT_RECORD_SAMPLES,
+                 model_name: str = config.FAST_MODEL):
+        self.min_confidence = min_confidence
+        self.use_llm = use_llm
+        self.fallback_timeout = fallback_timeout
+        self.record_samples = record_samples
+        self.model_name = model_name
+        self.confident = 0
+        self.unsure = 0
+        self.fallbacks = 0
+        self.fallback_errors = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    async def llm_label(self, text: str) -> str:
+        model = model_registry.get_model_registry().get(self.model_name)
+        response = await model.generate_content_async(LLM_PROMPT.format(text=text))
+        return parse_label(response.text)
+
+    async def _record(self, text: str, label: str, confidence: float):
+        try:
+            await run_blocking(database.save_sentiment_sample, text, label, confidence)
+        except Exception as e:
+            logging.error(f"Failed to record sentiment sample: {e}")
+
+    async def detect(self, text: str) -> Tuple[str, float]:
+        """
+        Returns (label, confidence). For an unsure turn the LLM's label, if it answers within
+        fallback_timeout, replaces the local one. Recording happens in the background.
+        """
+        label, confidence = classify(text)
+        with self._lock:
+            if confidence >= self.min_confidence:
+                self.confident += 1
+                return label, confidence
+            self.unsure += 1
+        if self.record_samples:
+            task = asyncio.create_task(self._record(text, label, confidence))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+        if self.use_llm:
+            with self._lock:
+                self.fallbacks += 1
+            try:
+                label = await asyncio.wait_for(self.llm_label(text), self.fallback_timeout)
+            except Exception as e:
+                with self._lock:
+                    self.fallback_errors += 1
+                logging.error(f"Sentiment fallback failed, using local label '{label}': {e!r}")
+        return label, confidence
+
+    def stats(self) -> dict:
+        turns = self.confident + self.unsure
+        return {
+            "confident": self.confident,
+            "unsure": self.unsure,
+            "unsure_rate": round(self.unsure / turns, 4) if turns else 0.0,
+            "fallbacks": self.fallbacks,
+            "fallback_errors": self.fallback_errors,
+        }
+
+_sentiment_instance: Optional[SentimentService] = None
+
+def get_sentiment_service() -> SentimentService:
+    global _sentiment_instance
+    if _sentiment_instance is None:
+        # Without Vertex AI the local label is final
+        _sentiment_instance = SentimentService(use_llm=SENTIMENT_LLM_FALLBACK and bool(config.PROJECT_ID))
+    return _sentiment_instance
@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import database
+from embedding_cache import normalize_text
+
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 256))
+SESSION_CACHE_IDLE_TTL = float(os.environ.get("SESSION_CACHE_IDLE_TTL", 2 * 3600))
+SESSION_TURN_CACHE_SIZE = 8
+SESSION_HEADERS = ("x-conversation-id", "x-session-id")
+SESSION_BODY_KEYS = ("conversation_id", "session_id")
+
+def resolve_session_id(headers, messages: List, extra_body: Optional[dict] = None) -> Tuple[Optional[str], bool]:
+    """
+    Returns (session_id, explicit) for a chat request. The id comes from a header (the
+    ElevenLabs agent sends {{system__conversation_id}} as X-Conversation-Id) or from
+    elevenlabs_extra_body; explicit is then True. Older clients send neither, so the id
+    falls back to a fingerprint of the first system and user messages, which stay the same
+    on every turn of one conversation but can coincide across conversations that open
+    identically. None if the request has no user message to fingerprint.
+    """
+    for header in SESSION_HEADERS:
+        value = headers.get(header)
+        if value and value.strip():
+            return value.strip()[:128], True
+    for key in SESSION_BODY_KEYS:
+        value = (extra_body or {}).get(key)
+        if isinstance(value, str) and value.strip():
+            return value.strip()[:128], True
+    opening = [m for m in messages if m.role == "system"][:1] + [m for m in messages if m.role == "user"][:1]
+    if not any(m.role == "user" for m in opening):
+        return None, False
+    fingerprint = "\n".join(f"{m.role}:{m.content}" for m in opening)
+    return "conv-" + hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:24], False
+
+class SessionContext:
+    """
+    Per-session cache of the context that goes into the system instruction.
+    """
+    def __init__(self, session_id: str, version: int):
+        self.session_id = session_id
+        self.version = version
+        self.last_used = time.time()
+        self.seeds: Optional[list] = None  # active (id, content) seed rows; packed per turn
+        self.system_instruction: Optional[str] = None
+        # Registered prompt prefix (context_cache.CachedPrefix); independent of the data
+        # version, so reset() keeps it
+        self.context_cache = None
+        self.context_cache_task = None
+        self.evicted = False
+        self._turns = OrderedDict()  # normalized query -> (memory_context, sentiment_instruction)
+
+    def reset(self, version: int):
+        self.version = version
+        self.seeds = None
+        self.system_instruction = None
+        self._turns.clear()
+
+    def get_turn(self, query: str):
+        key = normalize_text(query)
+        turn = self._turns.get(key)
+        if turn is not None:
+            self._turns.move_to_end(key)
+        return turn
+
+    def put_turn(self, query: str, memory_context: str, sentiment_instruction: str):
+        key = normalize_text(query)
+        self._turns[key] = (memory_context, sentiment_instruction)
+        self._turns.move_to_end(key)
+        while len(self._turns) > SESSION_TURN_CACHE_SIZE:
+            self._turns.popitem(last=False)
+
+class SessionContextCache:
+    """
+    In-process LRU of SessionContext entries. Entries are invalidated when verified
+    fragments or memory seeds change, tracked through a global data version.
+    """
+    def __init__(self, max_sessions: int = SESSION_CACHE_SIZE, idle_ttl: float = SESSION_CACHE_IDLE_TTL):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._eviction_listeners = []
+        database.add_fragment_listener(self._on_fragments_changed)
+        database.add_seed_listener(self.invalidate)
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+
+    def _on_fragments_changed(self, changes: List[database.FragmentChange]):
+        # Only verified fragments feed the prompt; fresh unverified extractions don't matter
+        if any(change.is_verified for change in changes):
+            self.invalidate()
+
+    def add_eviction_listener(self, callback):
+        """
+        callback(context) is called for each session context dropped from the cache, so
+        resources tied to it (a registered context cache prefix) can be released.
+        """
+        self._eviction_listeners.append(callback)
+
+    def remove_eviction_listener(self, callback):
+        if callback in self._eviction_listeners:
+            self._eviction_listeners.remove(callback)
+
+    def get(self, session_id: str):
+        """
+        Returns (context, is_new_session). Stale entries are reset before being returned.
+        """
+        now = time.time()
+        evicted = []
+        with self._lock:
+            context = self._sessions.get(session_id)
+            is_new = context is None or now - context.last_used > self.idle_ttl
+            if is_new:
+                if context is not None:
+                    evicted.append(context)
+                context = SessionContext(session_id, self.version)
+                self._sessions[session_id] = context
+                while len(self._sessions) > self.max_sessions:
+                    evicted.append(self._sessions.popitem(last=False)[1])
+            elif context.version != self.version:
+                context.reset(self.version)
+            self._sessions.move_to_end(session_id)
+            context.last_used = now
+        for old in evicted:
+            old.evicted = True
+            for callback in list(self._eviction_listeners):
+                try:
+                    callback(old)
+                except Exception as e:
+                    logging.error(f"Session eviction listener failed: {e}")
+        return context, is_new
+
+    def record_lookup(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+_cache_instance = None
+
+def get_session_cache() -> SessionContextCache:
+    global _cache_instance
+    if _cache_instance is None:
+        _cache_instance = SessionContextCache()
+    return _cache_instance
@@ -0,0 +1,290 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import zlib
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import config
+import database
+import model_registry
+from async_utils import run_blocking
+
+# Chapters written at the same time; each is one model call
+SYNTHESIS_CONCURRENCY = int(os.environ.get("SYNTHESIS_CONCURRENCY", 4))
+# Chapters with more fragments are written in parts first, then merged, so no single
+# prompt grows with the size of the archive
+CHAPTER_MAX_FRAGMENTS = int(os.environ.get("CHAPTER_MAX_FRAGMENTS", 60))
+# How much new text a streaming chapter accumulates between checkpoints
+SYNTHESIS_CHECKPOINT_CHARS = int(os.environ.get("SYNTHESIS_CHECKPOINT_CHARS", 500))
+
+CHAPTER_PROMPT = """
+You are a professional biographer writing one chapter, "{title}", of an elderly user's life story.
+The other chapters are: {others}.
+Weave the following memory fragments into a cohesive, flowing chapter.
+
+Guidelines:
+- Use a warm, respectful, and slightly literary tone.
+- Keep to the theme of this chapter; the other chapters cover their own themes.
+- Focus on the emotional weight of the stories.
+- Do not add a chapter heading.
+
+Memory Fragments:
+{fragments}
+
+Chapter:
+"""
+
+MERGE_PROMPT = """
+You are a professional biographer. The following passages were each written from part of the
+memories for the chapter "{title}" of an elderly user's life story. Merge them into one cohesive
+chapter in a warm, respectful, and slightly literary tone, keeping every story and removing
+repetition. Do not add a chapter heading.
+
+Passages:
+{passages}
+
+Chapter:
+"""
+
+RESUME_PROMPT = """
+
+The chapter so far (it was interrupted):
+{draft}
+
+Continue the chapter from exactly where it stops. Do not repeat any of it.
+"""
+
+# Part of every chapter hash, so a prompt change rewrites the chapters
+PROMPT_VERSION = hashlib.sha256((CHAPTER_PROMPT + MERGE_PROMPT).encode("utf-8")).hexdigest()[:12]
+
+Fragment = Tuple[int, str, str]  # (id, content, context)
+
+def group_chapters() -> List[Tuple[str, List[Fragment]]]:
+    """
+    Verified fragments by category, in the order the categories first appeared.
+    """
+    chapters: Dict[str, List[Fragment]] = {}
+    for cat, content, ctx, _, fid, _, _ in database.iter_fragments(verified_only=True):
+        chapters.setdefault(cat or "General", []).append((fid, content, ctx))
+    return list(chapters.items())
+
+def chapter_hash(model_name: str, title: str, fragments: List[Fragment], others: List[str]) -> str:
+    """
+    Cache key of a chapter: everything its prompt is rendered from, including the other
+    chapters' titles, so a renamed or new chapter rewrites the ones written against the
+    old outline.
+    """
+    material = json.dumps([PROMPT_VERSION, model_name, title, sorted(fragments), others])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def format_fragments(fragments: List[Fragment]) -> str:
+    return "\n".join(f"- {content}" + (f" ({ctx})" if ctx else "") for _, content, ctx in fragments)
+
+def stitch(chapters: List[Tuple[str, str]]) -> str:
+    """
+    The biography as plain text, each chapter under its title. The (title, text) pairs are
+    stored with it, so the PDF lays titles out as headings rather than parsing them back.
+    """
+    return "\n\n".join(f"{title}\n\n{text.strip()}" for title, text in chapters)
+
+def stream_checksum(text: str, previous: int = 0) -> int:
+    """
+    Running CRC32 of the chapter text a client has received; continue it with previous.
+    """
+    return zlib.crc32(text.encode("utf-8"), previous)
+
+def resume_point(draft: "ChapterDraft", offset: int, checksum: Optional[int]) -> int:
+    """
+    Where a client that received offset characters of the chapter, with this checksum, can
+    continue: at offset if what it has is a prefix of the draft, else from the start. After
+    a restart the draft resumes from its last checkpoint, which can be shorter than what
+    was already sent, and whatever is written past it differs from what the client has.
+    """
+    if checksum is not None and offset <= len(draft.text) and stream_checksum(draft.text[:offset]) == checksum:
+        return offset
+    return 0
+
+class ChapterDraft:
+    """
+    One chapter being written. Text is appended as the model streams it, and any number of
+    readers can follow along from any offset, including ones that arrive late.
+    """
+    def __init__(self, title: str, digest: str, text: str = "", version: Optional[int] = None, cached: bool = False):
+        self.title = title
+        self.digest = digest
+        self.text = text
+        self.version = version
+        self.cached = cached
+        self.done = cached
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def append(self, text: str):
+        self.text += text
+        self._notify()
+
+    def finish(self, version: Optional[int] = None, error: Optional[BaseException] = None):
+        self.version = version
+        self.error = error
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def follow(self, offset: int = 0) -> AsyncIterator[str]:
+        """
+        Yields the text from offset onwards as it arrives, until the chapter is finished.
+        """
+        while True:
+            changed = self._changed
+            if len(self.text) > offset:
+                chunk, offset = self.text[offset:], len(self.text)
+                yield chunk
+            elif self.done:
+                if self.error:
+                    raise self.error
+                return
+            else:
+                await changed.wait()
+
+class NarrativeSynthesizer:
+    """
+    Map-reduce synthesis: each chapter is written from its own fragments, concurrently, and
+    cached under a hash of that fragment set; only chapters whose fragments changed are
+    rewritten before the biography is stitched together. Chapters stream as they are
+    written and are checkpointed, so an interrupted synthesis picks up where it stopped.
+    """
+    def __init__(self, model_name: str = config.FAST_MODEL):
+        self.model_name = model_name
+        self.model = model_registry.get_model_registry().get(model_name)
+        self._semaphore = None
+        self._semaphore_loop = None
+        self._drafts: Dict[str, ChapterDraft] = {}
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(SYNTHESIS_CONCURRENCY)
+            self._semaphore_loop = loop
+            self._drafts = {}
+        return self._semaphore
+
+    async def _generate(self, prompt: str) -> str:
+        async with self._get_semaphore():
+            response = await self.model.generate_content_async(prompt)
+        return response.text
+
+    async def chapter_prompt(self, title: str, fragments: List[Fragment], others: List[str]) -> str:
+        """
+        The prompt that produces the chapter. Chapters too large for one prompt have their
+        parts written first, and the prompt merges them.
+        """
+        others_text = ", ".join(others) or "none yet"
+        if len(fragments) <= CHAPTER_MAX_FRAGMENTS:
+            return CHAPTER_PROMPT.format(title=title, others=others_text, fragments=format_fragments(fragments))
+        parts = [fragments[i:i + CHAPTER_MAX_FRAGMENTS] for i in range(0, len(fragments), CHAPTER_MAX_FRAGMENTS)]
+        passages = await asyncio.gather(*(self.write_chapter(title, part, others) for part in parts))
+        return MERGE_PROMPT.format(title=title, passages="\n\n---\n\n".join(passages))
+
+    async def write_chapter(self, title: str, fragments: List[Fragment], others: List[str]) -> str:
+        return await self._generate(await self.chapter_prompt(title, fragments, others))
+
+    async def _write_draft(self, draft: ChapterDraft, fragments: List[Fragment], others: List[str]):
+        checkpointed = len(draft.text)
+        try:
+            prompt = await self.chapter_prompt(draft.title, fragments, others)
+            if draft.text:
+                prompt += RESUME_PROMPT.format(draft=draft.text)
+            async with self._get_semaphore():
+                responses = await self.model.generate_content_async(prompt, stream=True)
+                async for response in responses:
+                    draft.append(response.text)
+                    if len(draft.text) - checkpointed >= SYNTHESIS_CHECKPOINT_CHARS:
+                        checkpointed = len(draft.text)
+                        await run_blocking(database.save_narrative_draft, draft.title, draft.digest, draft.text)
+            version = await run_blocking(database.save_synthesized_narrative, draft.text, draft.title, draft.digest)
+            await run_blocking(database.delete_narrative_drafts, draft.title)
+            draft.finish(version)
+        except BaseException as e:
+            if len(draft.text) > checkpointed:
+                await run_blocking(database.save_narrative_draft, draft.title, draft.digest, draft.text)
+            logging.error(f"Writing chapter '{draft.title}' failed after {len(draft.text)} characters: {e!r}")
+            draft.finish(error=e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            self._drafts.pop(draft.digest, None)
+
+    async def _draft(self, title: str, fragments: List[Fragment], titles: List[str]) -> ChapterDraft:
+        """
+        Returns the chapter's draft: finished if it is cached, else the one being written
+        (started now, from its last checkpoint if there is one).
+        """
+        self._get_semaphore()
+        others = [t for t in titles if t != title]
+        digest = chapter_hash(self.model_name, title, fragments, others)
+        draft = self._drafts.get(digest)
+        if draft is not None:
+            return draft
+        cached = await run_blocking(database.get_chapter_narrative, title, digest)
+        if cached:
+            return ChapterDraft(title, digest, cached[0], cached[1], cached=True)
+        draft = self._drafts.get(digest)  # another request may have started it meanwhile
+        if draft is not None:
+            return draft
+        checkpoint = await run_blocking(database.get_narrative_draft, title, digest)
+        draft = ChapterDraft(title, digest, checkpoint or "")
+        self._drafts[digest] = draft
+        # Runs independently of the request, so a client that disconnects doesn't lose the work
+        draft.task = asyncio.create_task(self._write_draft(draft, fragments, others))
+        return draft
+
+    async def drafts(self) -> List[ChapterDraft]:
+        """
+        Starts writing every chapter that isn't cached. Returns the drafts in chapter order.
+        """
+        chapters = await run_blocking(group_chapters)
+        titles = [title for title, _ in chapters]
+        return [await self._draft(title, fragments, titles) for title, fragments in chapters]
+
+    async def finish(self, drafts: List[ChapterDraft]) -> dict:
+        """
+        Waits for the drafts, then stitches and stores the biography.
+        """
+        for draft in drafts:
+            async for _ in draft.follow(len(draft.text)):
+                pass
+        chapters = [(draft.title, draft.text.strip()) for draft in drafts]
+        narrative = stitch(chapters)
+        regenerated = sum(1 for draft in drafts if not draft.cached)
+        if (narrative, chapters) != await run_blocking(database.get_latest_synthesized_chapters):
+            await run_blocking(database.save_synthesized_narrative, narrative, chapters=chapters)
+        logging.info(f"Synthesized {len(drafts)} chapters, {regenerated} rewritten")
+        return {
+            "narrative": narrative,
+            "chapters": [{"title": draft.title, "version": draft.version, "cached": draft.cached} for draft in drafts],
+            "regenerated": regenerated,
+        }
+
+    async def synthesize(self) -> Optional[dict]:
+        """
+        Brings the biography up to date with the verified fragments. Returns None if there are
+        none, else {"narrative", "chapters": [{"title", "version", "cached"}], "regenerated"}.
+        """
+        drafts = await self.drafts()
+        if not drafts:
+            return None
+        return await self.finish(drafts)
+
+_synthesizer_instance = None
+
+def get_synthesizer() -> NarrativeSynthesizer:
+    global _synthesizer_instance
+    if _synthesizer_instance is None:
+        _synthesizer_instance = NarrativeSynthesizer()
+    return _synthesizer_instance
@@ -0,0 +1,116 @@
+import asyncio
+import pytest
+from vertexai.generative_models import Content, Part
+
+import context_cache
+import database
+import session_cache
+import model_registry
+from session_cache import SessionContext
+
+class FakeModel:
+    def __init__(self, name, **config):
+        self.name = name
+
+def turn(role, text):
+    return Content(role=role, parts=[Part.from_text(text)])
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(model_registry, "GenerativeModel", FakeModel)
+    monkeypatch.setattr(model_registry, "_registry_instance", None)
+    return context_cache.ContextCache(context_cache.LocalContextBackend(), min_tokens=20, rebuild_tokens=15)
+
+def instruction_of(model):
+    return model._system_instruction[0]
+
+def test_long_sessions_reuse_the_prefix_and_carry_turn_context_with_the_message(cache):
+    context = SessionContext("s1", 0)
+    history = [turn("user", "I grew up on a farm near Ribe with my four brothers."), turn("model", "What was a typical day on the farm?")]
+
+    async def scenario():
+        # First turn: nothing registered yet, the full instruction is used and a prefix is built
+        first = await cache.prepare(context, "chat", "Be kind.", " Memories: farm", history, "We milked cows at five.")
+        await context.context_cache_task
+        # Next turn: the prefix covers the earlier turns, and the turn context moves to the message
+        longer = history + [turn("user", "We milked cows at five."), turn("model", "Who did the milking?")]
+        second = await cache.prepare(context, "chat", "Be kind.", " Memories: cows", longer, "My father.")
+        return first, second
+
+    (model, sent_history, message), (cached_model, cached_history, cached_message) = asyncio.run(scenario())
+    assert instruction_of(model) == "Be kind. Memories: farm" and sent_history == history and message == "We milked cows at five."
+    assert instruction_of(cached_model) == "Be kind."
+    assert [c.parts[0].text for c in cached_history] == [c.parts[0].text for c in history] + ["We milked cows at five.", "Who did the milking?"]
+    assert cached_message.startswith("[Context for this turn") and " Memories: cows" in cached_message and cached_message.endswith("My father.")
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1 and cache.stats()["created"] == 1
+
+def test_prefix_is_not_reused_when_instruction_or_history_differ(cache):
+    context = SessionContext("s1", 0)
+    history = [turn("user", "I grew up on a farm near Ribe with my four brothers."), turn("model", "Tell me more.")]
+
+    async def scenario():
+        await cache.prepare(context, "chat", "Be kind.", "", history, "Hi")
+        await context.context_cache_task
+        edited = [turn("user", "I grew up in Aarhus."), history[1]]
+        return (context.context_cache.covers("chat", "other-digest", history),
+                (await cache.prepare(context, "chat", "Be kind.", "", edited, "Hi"))[1] == edited)
+
+    assert asyncio.run(scenario()) == (False, True)
+    assert cache.stats()["hits"] == 0
+
+def test_short_sessions_are_not_cached(cache):
+    context = SessionContext("s1", 0)
+    asyncio.run(cache.prepare(context, "chat", "Be kind.", "", [turn("user", "Hi")], "Hello"))
+    assert context.context_cache is None and context.context_cache_task is None
+
+class FailingBackend(context_cache.LocalContextBackend):
+    def __init__(self):
+        self.creates = 0
+
+    def create(self, model_name, system_instruction, contents):
+        self.creates += 1
+        raise RuntimeError("context caching is not supported for this model")
+
+def test_failed_creates_back_off_per_model_and_instruction(monkeypatch):
+    monkeypatch.setattr(model_registry, "GenerativeModel", FakeModel)
+    monkeypatch.setattr(model_registry, "_registry_instance", None)
+    backend = FailingBackend()
+    cache = context_cache.ContextCache(backend, min_tokens=5)
+    history = [turn("user", "I grew up on a farm near Ribe with my four brothers.")]
+
+    async def scenario():
+        for session_id in ("s1", "s2", "s3"):
+            context = SessionContext(session_id, 0)
+            await cache.prepare(context, "chat", "Be kind.", "", history, "Hi")
+            if context.context_cache_task:
+                await context.context_cache_task
+        # Another instruction is still attempted
+        context = SessionContext("s4", 0)
+        await cache.prepare(context, "chat", "Be patient.", "", history, "Hi")
+        await context.context_cache_task
+
+    asyncio.run(scenario())
+    assert backend.creates == 2 and cache.stats()["failed"] == 2
+
+def test_evicted_sessions_delete_their_prefix(cache, monkeypatch):
+    deleted = []
+    monkeypatch.setattr(cache.backend, "delete", deleted.append)
+    sessions = session_cache.SessionContextCache(max_sessions=1)
+    sessions.add_eviction_listener(cache.release)
+    history = [turn("user", "I grew up on a farm near Ribe with my four brothers."), turn("model", "Tell me more.")]
+
+    async def scenario():
+        context, _ = sessions.get("s1")
+        await cache.prepare(context, "chat", "Be kind.", "", history, "Hi")
+        await context.context_cache_task
+        handle = context.context_cache.handle
+        sessions.get("s2")  # evicts s1
+        await asyncio.gather(*cache._pending)
+        return context, handle
+
+    context, handle = asyncio.run(scenario())
+    assert deleted == [handle] and context.context_cache is None
+    assert cache.stats()["deleted"] == 1
+    sessions.remove_eviction_listener(cache.release)
+    database.remove_fragment_listener(sessions._on_fragments_changed)
+    database.remove_seed_listener(sessions.invalidate)
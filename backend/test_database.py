@@ -0,0 +1,139 @@
+import threading
+import pytest
+import database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    yield database
+    database.close_connections()
+
+def test_connection_is_reused_and_tuned(db):
+    conn = db.get_connection()
+    assert db.get_connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+
+def test_connections_are_per_thread(db):
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(db.get_connection()))
+    thread.start()
+    thread.join()
+    assert seen[0] is not db.get_connection()
+
+def test_failed_write_rolls_back(db):
+    with pytest.raises(Exception):
+        with db._cursor() as cursor:
+            cursor.execute("INSERT INTO memory_seeds (content) VALUES (?)", ("Ask about Odense",))
+            raise RuntimeError("boom")
+    assert db.get_active_seeds() == []
+
+def test_fragment_round_trip(db):
+    fragment_id = db.save_fragment("s1", "Childhood", "Bakery in Odense", "ctx")
+    assert db.get_all_fragments() == []
+    db.verify_fragment(fragment_id)
+    rows = db.get_all_fragments()
+    assert [(r[0], r[1], r[4]) for r in rows] == [("Childhood", "Bakery in Odense", fragment_id)]
+
+def test_save_fragments_inserts_batch_in_one_transaction(db):
+    db.save_fragment("s0", "Career", "Deckhand in the North Sea", "ctx")
+    changed = []
+    db.add_fragment_listener(changed.append)
+    try:
+        ids = db.save_fragments("s1", [
+            ("Family", "Met Maria in 1968", "ctx", None),
+            ("Places", "Grandmother's bakery", "ctx", b"\x00" * 8),
+        ])
+    finally:
+        db.remove_fragment_listener(changed.append)
+    assert ids == [2, 3]
+    # One notification for the batch, carrying what the listeners need
+    assert len(changed) == 1
+    assert [(c.fragment_id, c.is_verified, c.embedding is None) for c in changed[0]] == [(2, 0, True), (3, 0, False)]
+    rows = db.get_fragments_by_ids(ids)
+    assert [r[2] for r in rows] == ["Met Maria in 1968", "Grandmother's bakery"]
+
+def test_extraction_result_dedupes_and_advances_watermark(db):
+    db.save_fragment("s0", "Family", "Met Maria in 1968", "ctx")
+    assert db.get_extraction_state("s1") == (0, "")
+
+    ids = db.save_extraction_result("s1", [
+        ("Family", "met  Maria in 1968", "ctx", None),  # already stored under another session
+        ("Places", "Grandmother's bakery", "ctx", None),
+        ("Places", "Grandmother's bakery ", "ctx", None),  # repeated within the batch
+    ], "Talked about Odense.", 4)
+
+    assert len(ids) == 1
+    assert db.get_extraction_state("s1") == (4, "Talked about Odense.")
+    assert db.get_existing_content_hashes({db.content_hash("GRANDMOTHER'S BAKERY")}) == {db.content_hash("grandmother's bakery")}
+
+    # A job that finishes after a newer one stores nothing and can't move the watermark back
+    db.save_extraction_result("s1", [("Career", "Shipyard", "ctx", None)], "Talked about Odense and the shipyard.", 6)
+    assert db.save_extraction_result("s1", [("Career", "The shipyard job", "ctx", None)], "Stale summary.", 5) == []
+    assert db.get_extraction_state("s1") == (6, "Talked about Odense and the shipyard.")
+    assert [r[1] for r in db.get_all_fragments(verified_only=False) if r[0] == "Career"] == ["Shipyard"]
+
+    # A conversation that started over resets it
+    db.save_extraction_result("s1", [], "Started over.", 2, restarted=True)
+    assert db.get_extraction_state("s1") == (2, "Started over.")
+
+def test_connection_reopens_after_close_from_another_thread(db):
+    db.get_connection()
+    thread = threading.Thread(target=db.close_connections)
+    thread.start()
+    thread.join()
+    assert db.get_active_seeds() == []
+
+def test_fragment_pages_use_keyset_and_index(db):
+    ids = [db.save_fragment("s1", "Career", f"Job {n}", "ctx", embedding=b"\x00" * 8) for n in range(5)]
+    for fragment_id in ids[:4]:
+        db.verify_fragment(fragment_id)
+    first = db.list_fragments(verified=True, limit=3)
+    second = db.list_fragments(verified=True, limit=3, after=first[-1][0])
+    assert [r[0] for r in first + second] == ids[:4]
+    assert [r[0] for r in db.get_pending_fragments(limit=3)] == [ids[4]]
+    assert db.get_all_fragments()[0][3] is None
+    assert db.get_all_fragments(include_embedding=True)[0][3] == b"\x00" * 8
+    plan = db.get_connection().execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM fragments WHERE is_verified = 1 AND id > 2 ORDER BY id LIMIT 3"
+    ).fetchall()
+    assert "idx_fragments_verified_id" in str(plan)
+
+def test_extraction_persists_latest_era(db):
+    assert db.get_latest_era() is None
+    db.save_extraction_result("s1", [], "", 2, "sepia")
+    db.save_extraction_result("s1", [], "", 4)  # no era detected this time
+    assert db.get_latest_era() == "sepia"
+
+def test_inline_embeddings_migrate_to_quantized_table(db):
+    fragment_id = db.save_fragment("s1", "Places", "Summers in Skagen", "ctx")
+    with db._cursor() as cursor:
+        cursor.execute("UPDATE fragments SET embedding = ? WHERE id = ?", (b"\x00\x00\x80\x3f" * 4, fragment_id))
+    db.init_db()
+    is_verified, vector = db.get_fragment_embedding(fragment_id)
+    assert list(vector) == [1.0] * 4
+    with db._cursor() as cursor:
+        cursor.execute("SELECT f.embedding, e.model, e.dim FROM fragments f JOIN fragment_embeddings e ON e.fragment_id = f.id")
+        assert cursor.fetchone() == (None, "text-embedding-004", 4)
+    db.delete_fragment(fragment_id)
+    assert db.get_fragment_embeddings(verified_only=False) == []
+
+def test_full_text_search_follows_fragment_changes(db):
+    first = db.save_fragment("s1", "Family", "Aunt Martha's farm", "Summers near Odense")
+    second = db.save_fragment("s1", "Career", "Worked at the shipyard", "ctx")
+    db.verify_fragment(first)
+    db.verify_fragment(second)
+    assert db.search_fragments_text("Tell me about Odense") == [first]
+    assert db.search_fragments_text('aunt* OR "') == [first]  # FTS syntax is quoted away
+    db.update_fragment(second, "Shipyard years with Aunt Martha")
+    assert set(db.search_fragments_text("Martha")) == {first, second}
+    db.delete_fragment(first)
+    assert db.search_fragments_text("Odense") == []
+    assert db.search_fragments_text("the of") == []
+
+def test_iter_fragments_groups_by_first_appearance(db):
+    for category, content in [("Family", "Maria"), ("Career", "Shipyard"), ("Family", "Wedding"), ("Places", "Odense")]:
+        db.verify_fragment(db.save_fragment("s1", category, content, "ctx"))
+    rows = list(db.iter_fragments(batch_size=2))
+    assert [(r[0], r[1]) for r in rows] == [("Family", "Maria"), ("Family", "Wedding"), ("Career", "Shipyard"), ("Places", "Odense")]
@@ -0,0 +1,53 @@
+import pytest
+import database
+from embedding_cache import EmbeddingCache, normalize_text
+
+def test_normalize_text_collapses_retries():
+    assert normalize_text("  Tell me about   Odense! ") == normalize_text("tell me about odense")
+    assert EmbeddingCache.make_key("Hello.", "m1") == EmbeddingCache.make_key("hello", "m1")
+    assert EmbeddingCache.make_key("hello", "m1") != EmbeddingCache.make_key("hello", "m2")
+
+def test_lru_eviction_and_counters():
+    cache = EmbeddingCache(max_entries=2, ttl_seconds=60, persist=False)
+    cache.put_many("m", [("a", [1.0]), ("b", [2.0])])
+    assert cache.get("a") == [1.0]  # "a" becomes most recently used
+    cache.put_many("m", [("c", [3.0])])
+    assert cache.get("b") is None
+    assert cache.get("c") == [3.0]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (2, 1, 2)
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("embedding_cache.time.time", lambda: now[0])
+    cache = EmbeddingCache(max_entries=10, ttl_seconds=5, persist=False)
+    cache.put_many("m", [("a", [1.0])])
+    now[0] += 6
+    assert cache.get("a") is None
+
+def test_persistent_cache_survives_restart(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    EmbeddingCache(persist=True).put_many("m", [("a", [0.5, 0.25])])
+
+    restarted = EmbeddingCache(persist=True)
+    assert restarted.get("a") == pytest.approx([0.5, 0.25])
+    assert restarted.stats()["disk_hits"] == 1
+    database.close_connections()
+
+def test_counters_are_exact_under_concurrent_lookups():
+    import sys
+    import threading
+    cache = EmbeddingCache(max_entries=10, persist=False)
+    cache.put_many("m", [("hit", [1.0])])
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads as often as possible to expose lost updates
+    try:
+        threads = [threading.Thread(target=lambda: [cache.get(key) for _ in range(2000) for key in ("hit", "miss")]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (16000, 16000)
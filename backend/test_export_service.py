@@ -0,0 +1,87 @@
+import asyncio
+import os
+import pytest
+import database
+import export_service
+import imagen_service
+import memoir_generator
+import synthesis_service
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(export_service, "EXPORT_DIR", str(tmp_path / "exports"))
+    monkeypatch.setattr(imagen_service, "get_imagen_service", lambda: None)
+    database.init_db()
+    yield database
+    database.close_connections()
+
+def test_unchanged_data_reuses_cached_pdf(db):
+    fragment_id = db.save_fragment("s1", "Family", "Met Maria in 1968", "ctx")
+    db.verify_fragment(fragment_id)
+    stages = []
+
+    async def report(stage):
+        stages.append(stage)
+
+    first = asyncio.run(export_service.build_export("Lasse", report))
+    assert stages == list(export_service.EXPORT_STAGES)
+    assert not first["cached"] and os.path.exists(first["path"])
+    assert export_service.cached_export("Lasse")["path"] == first["path"]
+
+    second = asyncio.run(export_service.build_export("Lasse"))
+    assert second["cached"] and second["path"] == first["path"]
+
+    # Any change to the verified fragments produces a new fingerprint
+    db.update_fragment(fragment_id, "Met Maria at the town dance in 1968")
+    assert export_service.cached_export("Lasse") is None
+    assert asyncio.run(export_service.build_export("Lasse"))["fingerprint"] != first["fingerprint"]
+
+def test_nothing_to_export(db):
+    with pytest.raises(export_service.NothingToExport):
+        asyncio.run(export_service.build_export("Lasse"))
+
+def test_eviction_by_age_and_size(db):
+    os.makedirs(export_service.EXPORT_DIR)
+    paths = []
+    for n in range(4):
+        path = os.path.join(export_service.EXPORT_DIR, f"memoir-{n}.pdf")
+        with open(path, "wb") as f:
+            f.write(b"\x00" * 100)
+        os.utime(path, (1000 + n, 1000 + n))
+        paths.append(path)
+    os.utime(paths[3])  # recently used
+    assert export_service.evict_exports(keep=paths[3], max_bytes=1000, max_age=3600) == 3
+    assert os.listdir(export_service.EXPORT_DIR) == ["memoir-3.pdf"]
+
+def test_eviction_keeps_images_of_running_exports(db, monkeypatch):
+    images = os.path.join(export_service.EXPORT_DIR, ".images")
+    os.makedirs(images)
+    for name, mtime in (("old.jpg", 1000), ("in-use.jpg", 2000)):
+        with open(os.path.join(images, name), "wb") as f:
+            f.write(b"\x00" * 100)
+        os.utime(os.path.join(images, name), (mtime, mtime))
+    # An export that started before in-use.jpg was last touched is still laying out
+    monkeypatch.setitem(export_service._running_exports, "job", 1500)
+    assert export_service.evict_exports(max_bytes=0, max_age=3600) == 1
+    assert os.listdir(images) == ["in-use.jpg"]
+
+def test_synthesized_chapter_titles_are_laid_out_as_headings(db, monkeypatch):
+    fragment_id = db.save_fragment("s1", "Family", "Met Maria in 1968", "ctx")
+    db.verify_fragment(fragment_id)
+    text = synthesis_service.stitch([("Family", "Lasse met Maria at a dance."), ("Career", "He went to sea.")])
+    db.save_synthesized_narrative(text, chapters=[("Family", "Lasse met Maria at a dance."), ("Career", "He went to sea.")])
+
+    cells = []
+    original = memoir_generator.MemoirPDF.multi_cell
+
+    def multi_cell(pdf, w, h, text, *args, **kwargs):
+        cells.append((pdf.font_style, text))
+        return original(pdf, w, h, text, *args, **kwargs)
+
+    monkeypatch.setattr(memoir_generator.MemoirPDF, "multi_cell", multi_cell)
+    result = asyncio.run(export_service.build_export("Lasse"))
+    assert os.path.exists(result["path"])
+    assert ("B", "Family") in cells and ("B", "Career") in cells
+    assert ("", "Lasse met Maria at a dance.") in cells
+    assert not any("#" in text for _, text in cells)
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import imagen_service
+from imagen_service import IllustrationCache, ImagenService
+
+class FakeImage:
+    def save(self, location, include_generation_parameters=False):
+        with open(location, "wb") as f:
+            f.write(b"\x89PNG" + b"\x00" * 96)
+
+def make_service(tmp_path, delay=0.0):
+    with patch("imagen_service.ImageGenerationModel.from_pretrained"):
+        service = ImagenService(project_id="test-project")
+    service.cache = IllustrationCache(str(tmp_path), max_bytes=10_000)
+    state = {"calls": [], "active": 0, "peak": 0}
+    lock = threading.Lock()
+
+    def generate_images(prompt, **params):
+        with lock:
+            state["calls"].append(prompt)
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+        time.sleep(delay)
+        with lock:
+            state["active"] -= 1
+        return MagicMock(images=[FakeImage()])
+
+    service.model = MagicMock(generate_images=MagicMock(side_effect=generate_images))
+    return service, state
+
+def test_illustrations_run_concurrently_and_are_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(imagen_service, "IMAGEN_CONCURRENCY", 2)
+    service, state = make_service(tmp_path, delay=0.05)
+    prompts = {f"Theme {n}": f"The theme of chapter {n}" for n in range(5)}
+
+    images, stats = asyncio.run(service.illustrate(prompts))
+    assert set(images) == set(prompts) and all(os.path.exists(p) for p in images.values())
+    assert stats == {"requested": 5, "cached": 0, "generated": 5, "failed": 0}
+    assert state["peak"] == 2
+
+    again, stats = asyncio.run(service.illustrate(prompts))
+    assert again == images
+    assert stats["cached"] == 5 and len(state["calls"]) == 5
+    assert service.cache.stats()["hits"] == 5
+
+def test_cache_key_covers_prompt_and_model(tmp_path):
+    service, _ = make_service(tmp_path)
+    key = service.cache_key("Childhood")
+    assert key != service.cache_key("Career")
+    service.model_name = "imagen-4"
+    assert key != service.cache_key("Childhood")
+
+def test_eviction_removes_least_recently_used(tmp_path):
+    cache = IllustrationCache(str(tmp_path), max_bytes=250)
+    for n, key in enumerate(["old", "mid", "new"]):
+        with open(cache.path_for(key), "wb") as f:
+            f.write(b"\x00" * 100)
+        os.utime(cache.path_for(key), (1000 + n, 1000 + n))
+    assert cache.get("old")  # touching it makes "mid" the oldest
+    assert cache.evict() == 1
+    assert cache.get("mid") is None and cache.get("new") and cache.get("old")
@@ -0,0 +1,192 @@
+import asyncio
+import threading
+import pytest
+import database
+from job_queue import JobQueue, current_job_id, report_stage
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    yield database
+    database.close_connections()
+
+def test_jobs_run_and_report_metrics(db):
+    seen = []
+
+    async def handler(payload):
+        seen.append(payload["n"])
+
+    async def scenario():
+        queue = JobQueue(concurrency=2, max_depth=10)
+        queue.register("count", handler)
+        await queue.start()
+        ids = [await queue.submit("count", {"n": n}) for n in range(3)]
+        await queue.drain(timeout=5)
+        return queue, ids
+
+    queue, ids = asyncio.run(scenario())
+    assert sorted(seen) == [0, 1, 2]
+    assert [db.get_job(job_id)[2] for job_id in ids] == ["done"] * 3
+    metrics = queue.metrics()
+    assert (metrics["completed"], metrics["depth"], metrics["in_flight"]) == (3, 0, 0)
+
+def test_pending_jobs_coalesce_and_overflow_is_shed(db):
+    async def scenario():
+        queue = JobQueue(concurrency=1, max_depth=2)
+        queue.register("extract", lambda payload: asyncio.sleep(0))
+        await queue.start()
+        # Stop the workers so submissions stay queued
+        for worker in queue._workers:
+            worker.cancel()
+        first = await queue.submit("extract", {"turns": 1}, dedupe_key="s1")
+        second = await queue.submit("extract", {"turns": 2}, dedupe_key="s1")
+        await queue.submit("extract", {"turns": 1}, dedupe_key="s2")
+        dropped = await queue.submit("extract", {"turns": 1}, dedupe_key="s3")
+        return queue, first, second, dropped
+
+    queue, first, second, dropped = asyncio.run(scenario())
+    assert first == second
+    assert dropped is None
+    assert (queue.coalesced, queue.dropped, queue.depth) == (1, 1, 2)
+
+def test_interrupted_jobs_resume_after_restart(db):
+    job_id, _ = db.enqueue_job("extract", '{"session_id": "s1"}')
+    db.start_job(job_id)  # simulate a crash while running
+    seen = []
+
+    async def handler(payload):
+        seen.append(payload["session_id"])
+
+    async def scenario():
+        queue = JobQueue(concurrency=1)
+        queue.register("extract", handler)
+        await queue.start()
+        await queue.drain(timeout=5)
+
+    asyncio.run(scenario())
+    assert seen == ["s1"]
+    assert db.get_job(job_id)[2:4] == ("done", 2)
+
+def test_failed_jobs_are_retried_then_recorded(db):
+    attempts = []
+
+    async def handler(payload):
+        attempts.append(1)
+        raise RuntimeError("Vertex unavailable")
+
+    async def scenario():
+        queue = JobQueue(concurrency=1)
+        queue.register("extract", handler, max_attempts=2)
+        await queue.start()
+        job_id = await queue.submit("extract", {})
+        await queue.drain(timeout=5)
+        return queue, job_id
+
+    queue, job_id = asyncio.run(scenario())
+    assert len(attempts) == 2
+    assert db.get_job(job_id)[2:5] == ("failed", 2, "Vertex unavailable")
+    assert queue.failed == 1
+
+def test_handlers_report_stage_and_result(db):
+    stages = []
+
+    async def handler(payload):
+        await report_stage("layout")
+        stages.append(db.get_job(current_job_id.get())[8])
+        return {"path": "exports/memoir.pdf"}
+
+    async def scenario():
+        queue = JobQueue(concurrency=1)
+        queue.register("export", handler)
+        await queue.start()
+        job_id = await queue.submit("export", {})
+        await queue.drain(timeout=5)
+        return job_id
+
+    job_id = asyncio.run(scenario())
+    assert stages == ["layout"]
+    assert db.get_job(job_id)[2] == "done"
+    assert db.get_job(job_id)[9] == '{"path": "exports/memoir.pdf"}'
+
+def test_job_started_while_enqueueing_keeps_its_payload(db):
+    job_id, _ = db.enqueue_job("extract", "v1", dedupe_key="extract:s1")
+    started = []
+
+    def start_from_worker(statement):
+        # A worker claims the job just as the coalescing write begins
+        if "UPDATE jobs SET payload" in statement and not started:
+            worker = threading.Thread(target=lambda: started.append(db.start_job(job_id)))
+            worker.start()
+            worker.join()
+
+    conn = db.get_connection()
+    conn.set_trace_callback(start_from_worker)
+    try:
+        new_id, created = db.enqueue_job("extract", "v2", dedupe_key="extract:s1")
+    finally:
+        conn.set_trace_callback(None)
+
+    assert started[0][1] == "v1"
+    assert created and new_id != job_id
+    assert db.get_job(job_id)[2] == "running" and db.start_job(new_id)[1] == "v2"
+
+def test_kinds_with_their_own_concurrency_do_not_block_the_shared_workers(db):
+    release = None
+    order = []
+
+    async def export(payload):
+        order.append("export started")
+        await release.wait()
+
+    async def extract(payload):
+        order.append("extract")
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        queue = JobQueue(concurrency=1)
+        queue.register("export", export, concurrency=1)
+        queue.register("extract", extract)
+        await queue.start()
+        await queue.submit("export", {})
+        await queue.submit("export", {})
+        await queue.submit("extract", {})
+        for _ in range(20):
+            await asyncio.sleep(0.01)
+        # One export runs, the second waits in its lane, and extraction went ahead on the shared worker
+        metrics = queue.metrics()
+        release.set()
+        await queue.drain(timeout=5)
+        return metrics
+
+    metrics = asyncio.run(scenario())
+    assert order[:2] == ["export started", "extract"]
+    assert metrics["lanes"] == {"export": {"depth": 1, "concurrency": 1}}
+    assert metrics["in_flight"] == 1
+
+def test_exclusive_jobs_for_the_same_key_run_one_at_a_time(db):
+    running, overlaps, done = set(), [], []
+
+    async def extract(payload):
+        if payload["session_id"] in running:
+            overlaps.append(payload["session_id"])
+        running.add(payload["session_id"])
+        await asyncio.sleep(0.05)
+        running.discard(payload["session_id"])
+        done.append(payload["session_id"])
+
+    async def scenario():
+        queue = JobQueue(concurrency=3)
+        queue.register("extract", extract, exclusive_by="session_id")
+        await queue.start()
+        for session_id in ("s1", "s1", "s2"):
+            await queue.submit("extract", {"session_id": session_id})
+        await asyncio.sleep(0.03)
+        # s2 runs alongside the first s1 job; the second s1 job waits for it
+        concurrent = set(running)
+        await queue.drain(timeout=5)
+        return concurrent
+
+    assert asyncio.run(scenario()) == {"s1", "s2"}
+    assert overlaps == [] and sorted(done) == ["s1", "s1", "s2"]
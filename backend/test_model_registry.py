@@ -0,0 +1,36 @@
+import pytest
+import vertexai
+from google.auth.credentials import AnonymousCredentials
+import model_registry
+
+@pytest.fixture
+def registry():
+    vertexai.init(project="test-project", location="us-central1", credentials=AnonymousCredentials())
+    return model_registry.ModelRegistry()
+
+def test_models_are_pooled_per_name_and_config(registry):
+    flash = registry.get("gemini-1.5-flash")
+    assert registry.get("gemini-1.5-flash") is flash
+    assert registry.get("gemini-1.5-flash", generation_config={"temperature": 0.2}) is not flash
+    assert registry.get("gemini-1.5-flash", generation_config={"temperature": 0.2}) is registry.get("gemini-1.5-flash", generation_config={"temperature": 0.2})
+    assert registry.stats() == {"models": 2, "created": 2, "reused": 3}
+
+def test_bound_models_share_the_pooled_client(registry):
+    base = registry.get("gemini-1.5-flash")
+    first = registry.bind("gemini-1.5-flash", ["Memories: a"])
+    second = registry.bind("gemini-1.5-flash", ["Memories: b"])
+    assert first._prediction_client is base._prediction_client is second._prediction_client
+    assert first._prepare_request(contents="Hello").system_instruction.parts[0].text == "Memories: a"
+    assert base._prepare_request(contents="Hello").system_instruction.parts == []
+    assert registry.bind("gemini-1.5-flash", None) is base
+
+def test_sdk_still_has_the_internals_bound_model_relies_on(registry):
+    # BoundModel reaches into private GenerativeModel attributes; if this fails after an
+    # SDK upgrade, fix BoundModel before moving the google-cloud-aiplatform pin
+    base = registry.get("gemini-1.5-flash")
+    assert all(hasattr(model_registry.GenerativeModel, name) for name in model_registry._CLIENT_ATTRIBUTES)
+    assert {"_system_instruction", "_cached_content", "_prediction_resource_name"} <= set(vars(base))
+    assert callable(getattr(base, "_prepare_request", None))
+    bound = model_registry.BoundModel(base, "Memories: a")
+    assert bound._prediction_client is base._prediction_client
+    assert not model_registry._CLIENT_ATTRIBUTES & set(vars(bound))
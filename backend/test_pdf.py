@@ -35,3 +35,40 @@ def test_pdf_grouping():
     # Cleanup
     os.remove(path)
     os.rmdir("test_outputs_grouping")
+
+def test_streamed_chapters_and_downscaled_images(tmp_path):
+    from PIL import Image
+    source = tmp_path / "childhood.png"
+    Image.new("RGB", (2048, 2048), (200, 120, 40)).save(source)
+    gen = MemoirGenerator(str(tmp_path / "out"))
+
+    prepared = gen.prepare_image(str(source))
+    assert gen.prepare_image(str(source)) == prepared
+    with Image.open(prepared) as img:
+        assert max(img.size) == 708  # 120mm at 150 DPI
+    assert os.path.getsize(prepared) < os.path.getsize(source)
+
+    # Grouped input is consumed lazily, one chapter at a time
+    rows = iter([("Childhood", "Oak tree", "ctx"), ("Childhood", "Bakery", ""), ("Career", "Shipyard", "ctx")])
+    chapters = list(MemoirGenerator._chapters(rows, grouped=True))
+    assert chapters == [("Childhood", [("Oak tree", "ctx", None), ("Bakery", "", None)]), ("Career", [("Shipyard", "ctx", None)])]
+
+    fragments = (row for row in [("Childhood", "Oak tree", "ctx"), ("Career", "Shipyard", "ctx")])
+    path = gen.generate("Test User", fragments, images={"Childhood": str(source)}, grouped=True)
+    assert os.path.getsize(path) < os.path.getsize(source)
+
+def test_unverified_rows_do_not_render_audio_as_photo(tmp_path, monkeypatch):
+    import database
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    try:
+        database.save_fragment("s1", "Career", "Shipyard", "ctx", audio_url="/uploads/shipyard.webm")
+        rows = database.get_all_fragments(verified_only=False)
+    finally:
+        database.close_connections()
+
+    assert list(MemoirGenerator._chapters(rows, grouped=False)) == [("Career", [("Shipyard", "ctx", None)])]
+    resolved = []
+    gen = MemoirGenerator(str(tmp_path / "out"))
+    gen.layout("Test User", rows, photo_resolver=lambda url, min_px: resolved.append(url))
+    assert resolved == []
@@ -0,0 +1,45 @@
+import hashlib
+import io
+import os
+import pytest
+from PIL import Image
+import photo_service
+
+@pytest.fixture
+def photos(tmp_path, monkeypatch):
+    monkeypatch.setattr(photo_service, "PHOTO_DIR", str(tmp_path / "images"))
+    monkeypatch.setattr(photo_service, "VARIANT_DIR", str(tmp_path / "images" / "variants"))
+    return photo_service
+
+def jpeg(size):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (90, 140, 200)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+def store(photos, tmp_path, data, filename):
+    # What upload_service hands over: the streamed file and its sha256
+    upload = tmp_path / f"upload-{len(os.listdir(tmp_path))}.part"
+    upload.write_bytes(data)
+    return photos.adopt_original(str(upload), hashlib.sha256(data).hexdigest(), filename)
+
+def test_uploads_are_deduplicated_by_content(photos, tmp_path):
+    data = jpeg((400, 300))
+    pid, path, created = store(photos, tmp_path, data, "IMG_0001.JPG")
+    assert created and path.endswith(f"{pid}.jpg")
+    assert store(photos, tmp_path, data, "copy.jpeg") == (pid, path, False)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+    assert photos.photo_id_from_url(f"http://localhost:8000/uploads/images/{pid}.jpg") == pid
+    assert photos.photo_id_from_url("http://localhost:8000/uploads/images/fragment_1_x.jpg") is None
+
+def test_variants_never_upscale_and_pick_smallest_adequate(photos, tmp_path):
+    pid, original, _ = store(photos, tmp_path, jpeg((2000, 1500)), "wedding.jpg")
+    assert photos.pick_variant(pid, 200) == original  # nothing prepared yet
+
+    written = photos.generate_variants(pid)
+    assert set(written) == {"thumb", "screen"}  # 2000px original is smaller than print
+    with Image.open(written["thumb"]) as img:
+        assert img.size == (320, 240)
+    assert photos.pick_variant(pid, 200) == written["thumb"]
+    assert photos.pick_variant(pid, 472) == written["screen"]
+    assert photos.pick_variant(pid, 2400) == original
+    assert photos.pick_variant("../../etc/passwd", 0) is None
@@ -0,0 +1,44 @@
+import prompt_budget
+
+HEADER = "\n\nFamily members suggested these topics to cover:\n"
+
+def test_estimate_tokens_counts_words_punctuation_and_long_words():
+    assert prompt_budget.estimate_tokens("") == 0
+    assert prompt_budget.estimate_tokens("We moved to Odense.") == 5
+    assert prompt_budget.estimate_tokens("apprenticeship") == 3
+    assert prompt_budget.estimate_tokens(prompt_budget.truncate("word " * 500, 20)) <= 20
+
+def test_pack_respects_budget_and_ranks_by_relevance_then_recency():
+    seeds = [(1, "Ask about the summer house in Skagen"), (2, "Ask about grandpa's time in the navy"), (3, "Ask about the first car")]
+    recency = prompt_budget.recency([sid for sid, _ in seeds])
+    candidates = [(text, prompt_budget.lexical_relevance("Were you ever in the navy?", text), recency[sid]) for sid, text in seeds]
+
+    section, used, dropped = prompt_budget.pack(HEADER, candidates, 1000)
+    lines = section[len(HEADER):].splitlines()
+    assert lines == ["- Ask about grandpa's time in the navy", "- Ask about the first car", "- Ask about the summer house in Skagen"]
+    assert used == prompt_budget.estimate_tokens(section) and dropped == 0
+
+    section, used, dropped = prompt_budget.pack(HEADER, candidates, prompt_budget.estimate_tokens(HEADER) + 12)
+    assert section == HEADER + "- Ask about grandpa's time in the navy\n"
+    assert used <= prompt_budget.estimate_tokens(HEADER) + 12 and dropped == 2
+
+def test_pack_drops_near_duplicates_and_truncates_long_items():
+    candidates = [
+        ("[Family]: Married Anna in 1962 in Aarhus ()", 1.0, 0.0),
+        ("[Family]: married Anna in Aarhus in 1962 ()", 0.9, 0.0),
+        ("[Career]: " + "Worked at the shipyard for decades. " * 40, 0.5, 0.0),
+    ]
+    section, _, dropped = prompt_budget.pack("Memories:\n", candidates, 1000, item_max_tokens=30)
+    lines = section.splitlines()[1:]
+    assert dropped == 1 and len(lines) == 2
+    assert lines[1].endswith("…") and prompt_budget.estimate_tokens(lines[1]) <= 32
+    assert prompt_budget.pack("Memories:\n", [], 1000) == ("", 0, 0)
+
+def test_usage_records_tokens_per_section():
+    usage = prompt_budget.PromptUsage()
+    usage.record({"memories": 100, "seeds": 20})
+    usage.record({"memories": 300, "seeds": 0})
+    assert usage.stats() == {
+        "memories": {"turns": 2, "avg_tokens": 200.0, "max_tokens": 300},
+        "seeds": {"turns": 2, "avg_tokens": 10.0, "max_tokens": 20},
+    }
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+import quantization
+
+def test_int8_round_trip_is_close_and_four_times_smaller():
+    vector = np.random.default_rng(0).standard_normal(768).astype(np.float32)
+    dtype, dim, scale, blob = quantization.quantize(vector, "int8", 0)
+    assert (dtype, dim, len(blob)) == ("int8", 768, 768)
+    restored = quantization.dequantize(dtype, dim, scale, blob)
+    assert np.max(np.abs(restored - vector)) <= scale / 2 + 1e-6
+
+def test_float16_and_truncation():
+    vector = np.arange(10, dtype=np.float32)
+    dtype, dim, scale, blob = quantization.quantize(vector.tobytes(), "float16", 4)
+    assert (dim, len(blob)) == (4, 8)
+    assert np.array_equal(quantization.dequantize(dtype, dim, scale, blob), vector[:4])
+
+def test_zero_vector_and_unknown_dtype():
+    assert not quantization.dequantize(*quantization.quantize([0.0, 0.0], "int8", 0)).any()
+    with pytest.raises(ValueError):
+        quantization.quantize([1.0], "int4", 0)
@@ -1,7 +1,9 @@
 import pytest
 import numpy as np
-from unittest.mock import MagicMock, patch
-from rag_service import RAGService
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+import database
+from rag_service import RAGService, EmbeddingIndex
 
 @pytest.fixture
 def rag():
@@ -45,3 +47,146 @@ def test_retrieve_relevant(rag):
     assert len(relevant) == 1
     assert relevant[0][0] == "Cat1"
     assert relevant[0][1] == "Content 1"
+
+def test_retrieve_relevant_embeds_missing_blobs_in_one_call(rag):
+    rag.get_embeddings = MagicMock(side_effect=[
+        [[0.0, 1.0]], # Query embedding
+        [[0.0, 1.0]], # Fallback for the fragment without a blob
+    ])
+
+    fragments = [
+        ("Cat1", "Content 1", "Ctx 1", rag.serialize_embedding([1.0, 0.0])),
+        ("Cat2", "Content 2", "Ctx 2", None),
+    ]
+
+    relevant = rag.retrieve_relevant("query", fragments, top_k=1)
+    assert relevant == [("Cat2", "Content 2", "Ctx 2")]
+    assert rag.get_embeddings.call_count == 2
+
+def test_embedding_index_search_and_updates():
+    index = EmbeddingIndex(initial_capacity=1)
+    index.build([(1, [1.0, 0.0]), (2, [0.0, 3.0])])
+    assert [fid for fid, _ in index.search([0.0, 1.0], top_k=1)] == [2]
+
+    # Inserts grow the buffer, deletes compact it
+    index.upsert(3, [1.0, 1.0])
+    index.remove(1)
+    assert len(index) == 2
+    assert 1 not in index
+    hits = index.search([1.0, 0.0], top_k=5)
+    assert [fid for fid, _ in hits] == [3, 2]
+    assert hits[0][1] == pytest.approx(np.sqrt(0.5))
+
+    # Updating an existing id replaces its vector in place
+    index.upsert(2, [1.0, 0.0])
+    assert index.search([1.0, 0.0], top_k=1)[0][0] == 2
+
+def test_retrieve_from_index_tracks_database_changes(rag, tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    first = database.save_fragment("s1", "Family", "Met Maria", "ctx", rag.serialize_embedding([1.0, 0.0]))
+    second = database.save_fragment("s1", "Career", "Fishing boat", "ctx", rag.serialize_embedding([0.0, 1.0]))
+    database.verify_fragment(first)
+
+    rag.get_embeddings = MagicMock(return_value=[[0.0, 1.0]])
+    assert rag.retrieve_relevant("boat", top_k=1) == [("Family", "Met Maria", "ctx")]
+
+    # Verifying and deleting rows updates the resident index incrementally
+    database.verify_fragment(second)
+    assert second in rag.index
+    assert rag.retrieve_relevant("boat", top_k=1) == [("Career", "Fishing boat", "ctx")]
+    database.delete_fragment(second)
+    assert second not in rag.index
+
+    # A batch insert notifies once and the index reads nothing back
+    statements = []
+    database.get_connection().set_trace_callback(statements.append)
+    database.save_fragments("s1", [("Places", f"Harbour {i}", "ctx", rag.serialize_embedding([1.0, 0.0])) for i in range(5)])
+    database.get_connection().set_trace_callback(None)
+    assert not any("fragment_embeddings e" in sql for sql in statements)
+    database.remove_fragment_listener(rag._on_fragments_changed)
+
+def test_edited_fragment_is_reembedded(rag, tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    fragment_id = database.save_fragment("s1", "Career", "Fishing boat", "ctx", rag.serialize_embedding([1.0, 0.0]))
+    database.verify_fragment(fragment_id)
+    rag.get_embeddings = MagicMock(return_value=[[1.0, 0.0]])
+    rag.retrieve_relevant("boat", top_k=1)
+
+    # Editing the text drops the old vector; the next retrieval embeds the new content
+    database.update_fragment(fragment_id, "Worked at the bakery")
+    assert database.get_fragment_embedding(fragment_id) == (1, None)
+    assert fragment_id not in rag.index and fragment_id in rag._missing_ids
+    rag.get_embeddings = MagicMock(side_effect=[[[0.0, 1.0]], [[0.0, 1.0]]])
+    assert rag.retrieve_relevant("bread", top_k=1) == [("Career", "Worked at the bakery", "ctx")]
+    assert ["Career: Worked at the bakery"] in [call.args[0] for call in rag.get_embeddings.call_args_list]
+    assert np.array_equal(database.get_fragment_embedding(fragment_id)[1], [0.0, 1.0])
+    database.remove_fragment_listener(rag._on_fragments_changed)
+
+def test_retrieve_relevant_async_uses_async_embeddings(rag, tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    fragment_id = database.save_fragment("s1", "Places", "Summers in Skagen", "ctx", rag.serialize_embedding([1.0, 0.0]))
+    database.verify_fragment(fragment_id)
+
+    rag.get_embeddings = MagicMock(side_effect=AssertionError("sync embedding call on the event loop"))
+    rag.get_embeddings_async = AsyncMock(return_value=[[1.0, 0.0]])
+    relevant = asyncio.run(rag.retrieve_relevant_async("summer", top_k=3))
+    assert relevant == [("Places", "Summers in Skagen", "ctx")]
+    rag.get_embeddings_async.assert_awaited_once()
+    database.remove_fragment_listener(rag._on_fragments_changed)
+
+def test_get_embeddings_serves_repeats_from_cache(rag):
+    rag.embedding_model.get_embeddings.return_value = [MagicMock(values=[0.1, 0.2])]
+    assert rag.get_embeddings(["Tell me about Odense"]) == [[0.1, 0.2]]
+    assert rag.get_embeddings(["tell me about odense."]) == [pytest.approx([0.1, 0.2])]
+    assert rag.embedding_model.get_embeddings.call_count == 1
+    assert rag.cache.stats()["hits"] == 1
+
+def test_get_embeddings_splits_requests_at_batch_limit(rag):
+    rag.EMBEDDING_BATCH_SIZE = 2
+    rag.embedding_model.get_embeddings.side_effect = lambda batch: [MagicMock(values=[float(len(batch))]) for _ in batch]
+    vectors = rag.get_embeddings(["one", "two", "three"])
+    assert vectors == [[2.0], [2.0], [1.0]]
+    assert rag.embedding_model.get_embeddings.call_count == 2
+
+def test_hybrid_retrieval_fuses_names_and_falls_back_to_lexical(rag, tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    name = database.save_fragment("s1", "Family", "Aunt Martha baked on Sundays", "ctx", rag.serialize_embedding([0.6, 0.8]))
+    close = database.save_fragment("s1", "Family", "Mother's cooking", "ctx", rag.serialize_embedding([1.0, 0.0]))
+    for fragment_id in (name, close):
+        database.verify_fragment(fragment_id)
+
+    # The vector ranking alone prefers the other fragment; the name match lifts Aunt Martha
+    rag.get_embeddings_async = AsyncMock(return_value=[[1.0, 0.0]])
+    relevant = asyncio.run(rag.retrieve_relevant_async("What did Aunt Martha bake?", top_k=1))
+    assert relevant == [("Family", "Aunt Martha baked on Sundays", "ctx")]
+
+    # Embedding API down: the full-text ranking answers on its own
+    rag.get_embeddings_async = AsyncMock(return_value=[])
+    assert asyncio.run(rag.retrieve_relevant_async("Martha", top_k=3)) == [("Family", "Aunt Martha baked on Sundays", "ctx")]
+    database.remove_fragment_listener(rag._on_fragments_changed)
+
+def test_backfill_is_capped_and_backs_off_after_a_failure(rag, tmp_path, monkeypatch):
+    import rag_service
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(rag_service, "RAG_BACKFILL_BATCH", 2)
+    database.init_db()
+    for fid in database.save_fragments("s1", [("Places", f"Harbour {i}", "ctx", None) for i in range(3)]):
+        database.verify_fragment(fid)
+    rag.load_index()
+    assert len(rag._missing_ids) == 3
+
+    # Embedding API down: one attempt, then no further calls until the retry time
+    rag.get_embeddings = MagicMock(return_value=[])
+    rag._prepare_index()
+    rag._prepare_index()
+    assert rag.get_embeddings.call_count == 1 and len(rag._missing_ids) == 3
+
+    rag._backfill_retry_at = 0.0
+    rag.get_embeddings = MagicMock(side_effect=lambda texts: [[1.0, 0.0]] * len(texts))
+    rag._prepare_index()
+    assert len(rag.get_embeddings.call_args.args[0]) == 2 and len(rag._missing_ids) == 1
+    database.remove_fragment_listener(rag._on_fragments_changed)
@@ -0,0 +1,62 @@
+import asyncio
+import time
+import pytest
+import database
+import model_registry
+import sentiment_service
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    yield sentiment_service.SentimentService(use_llm=False, record_samples=True)
+    database.close_connections()
+
+def test_classify_reads_loss_joy_negation_and_mixed_turns():
+    assert sentiment_service.classify("My wife passed away in 1998 and I still miss her terribly.") == ("sad", 1.0)
+    assert sentiment_service.classify("We had the best summers at the lake, I was so happy.")[0] == "positive"
+    assert sentiment_service.classify("I worked at the shipyard from 1955 to 1990.") == ("neutral", sentiment_service.SENTIMENT_NEUTRAL_CONFIDENCE)
+    assert sentiment_service.classify("I wasn't happy there.")[0] == "sad"
+    _, confidence = sentiment_service.classify("It was a beautiful funeral.")
+    assert confidence < sentiment_service.SENTIMENT_MIN_CONFIDENCE
+
+def test_unsure_turns_are_recorded_for_labelling(service):
+    async def scenario():
+        results = [await service.detect(text) for text in (
+            "During the war we were always hungry and afraid.",
+            "It was a beautiful funeral.",
+            "It was a beautiful funeral.",
+        )]
+        await asyncio.gather(*service._pending)
+        return results
+
+    results = asyncio.run(scenario())
+    assert results[0] == ("sad", 1.0) and results[1][0] == "sad"
+    assert [(text, label) for text, label, _ in database.list_sentiment_samples()] == [("It was a beautiful funeral.", "sad")]
+    assert service.stats() == {"confident": 1, "unsure": 2, "unsure_rate": 0.6667, "fallbacks": 0, "fallback_errors": 0}
+
+    # Samples are opt-in and pruned by age
+    assert not sentiment_service.SentimentService().record_samples
+    database.prune_sentiment_samples(time.time() + 1)
+    assert database.list_sentiment_samples() == []
+
+def test_llm_fallback_relabels_unsure_turns_within_its_deadline(service, monkeypatch):
+    class FakeModel:
+        delay = 0.0
+
+        def __init__(self, name, **config):
+            pass
+
+        async def generate_content_async(self, prompt):
+            await asyncio.sleep(FakeModel.delay)
+            return type("Response", (), {"text": "Positive"})()
+
+    monkeypatch.setattr(model_registry, "GenerativeModel", FakeModel)
+    monkeypatch.setattr(model_registry, "_registry_instance", None)
+    service.use_llm, service.record_samples, service.fallback_timeout = True, False, 0.05
+
+    assert asyncio.run(service.detect("It was a beautiful funeral."))[0] == "positive"
+    assert asyncio.run(service.detect("During the war we were always hungry and afraid.")) == ("sad", 1.0)
+    FakeModel.delay = 0.2
+    assert asyncio.run(service.detect("It was a beautiful funeral."))[0] == "sad"
+    assert (service.fallbacks, service.fallback_errors) == (2, 1)
@@ -0,0 +1,55 @@
+import pytest
+from collections import namedtuple
+import database
+from session_cache import SessionContextCache, resolve_session_id
+
+Message = namedtuple("Message", "role content")
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    cache = SessionContextCache(max_sessions=2)
+    yield cache
+    database.remove_fragment_listener(cache._on_fragments_changed)
+    database.remove_seed_listener(cache.invalidate)
+    database.close_connections()
+
+def test_session_id_prefers_the_client_and_falls_back_to_a_fingerprint():
+    opening = [Message("system", "You are Memoria"), Message("user", "I grew up in Odense")]
+    assert resolve_session_id({"x-conversation-id": "conv_1"}, opening, {"session_id": "s1"}) == ("conv_1", True)
+    assert resolve_session_id({}, opening, {"session_id": " s1 "}) == ("s1", True)
+    assert resolve_session_id({"x-session-id": "abc"}, []) == ("abc", True)
+
+    # Without an id every turn of a conversation fingerprints the same; with no user message there is nothing to fingerprint
+    fingerprint, explicit = resolve_session_id({}, opening)
+    assert fingerprint.startswith("conv-") and not explicit
+    assert resolve_session_id({}, opening + [Message("assistant", "Tell me more"), Message("user", "We had a bakery")]) == (fingerprint, False)
+    assert resolve_session_id({}, [Message("system", "You are Memoria")]) == (None, False)
+
+def test_turns_are_cached_until_data_changes(cache):
+    context, is_new = cache.get("s1")
+    assert is_new
+    context.seeds = [(1, "seeds")]
+    context.put_turn("Tell me about Odense", "memories", "")
+    context, is_new = cache.get("s1")
+    assert not is_new
+    assert context.get_turn("tell me about odense.") == ("memories", "")
+
+    # Unverified extractions don't invalidate; new seeds and verified fragments do
+    fragment_id = database.save_fragment("s1", "Places", "Odense", "ctx")
+    assert cache.get("s1")[0].seeds == [(1, "seeds")]
+    database.verify_fragment(fragment_id)
+    context, _ = cache.get("s1")
+    assert context.seeds is None and context.get_turn("Tell me about Odense") is None
+    context.seeds = [(1, "seeds")]
+    database.save_seed("Ask about the war years")
+    assert cache.get("s1")[0].seeds is None
+
+def test_least_recently_used_sessions_are_evicted(cache):
+    cache.get("s1")
+    cache.get("s2")
+    cache.get("s1")
+    cache.get("s3")
+    assert cache.get("s2")[1] is True
+    assert cache.stats()["sessions"] == 2
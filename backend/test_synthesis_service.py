@@ -0,0 +1,122 @@
+import asyncio
+import pytest
+import database
+import model_registry
+import synthesis_service
+
+class FakeModel:
+    def __init__(self, name, **config):
+        self.prompts = []
+        self.fail_after = None  # fail a stream after this many chunks
+
+    async def generate_content_async(self, prompt, stream=False):
+        self.prompts.append(prompt)
+        title = prompt.split('"')[1]
+        text = f"Chapter about {title} #{len(self.prompts)}"
+        if not stream:
+            return Response(text)
+        return self._stream(text.split(" "))
+
+    async def _stream(self, words):
+        for i, word in enumerate(words):
+            if self.fail_after is not None and i == self.fail_after:
+                raise ConnectionError("stream dropped")
+            yield Response(word + " ")
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+
+@pytest.fixture
+def synthesizer(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(model_registry, "GenerativeModel", FakeModel)
+    monkeypatch.setattr(model_registry, "_registry_instance", None)
+    database.init_db()
+    yield synthesis_service.NarrativeSynthesizer("fake-model")
+    database.close_connections()
+
+def add_verified(rows):
+    ids = database.save_fragments("s1", rows)
+    for fid in ids:
+        database.verify_fragment(fid)
+    return ids
+
+def test_only_changed_chapters_are_rewritten(synthesizer):
+    assert asyncio.run(synthesizer.synthesize()) is None
+    add_verified([("Childhood", "Grew up by the sea", "", None), ("Career", "Became a teacher", "", None)])
+
+    first = asyncio.run(synthesizer.synthesize())
+    assert first["regenerated"] == 2
+    assert first["narrative"].startswith("Childhood\n\nChapter about Childhood #1")
+    assert database.get_latest_synthesized_narrative() == first["narrative"]
+    assert database.get_latest_synthesized_chapters()[1] == [("Childhood", "Chapter about Childhood #1"), ("Career", "Chapter about Career #2")]
+
+    again = asyncio.run(synthesizer.synthesize())
+    assert again["regenerated"] == 0 and again["narrative"] == first["narrative"]
+    assert len(synthesizer.model.prompts) == 2
+
+    add_verified([("Career", "Retired in 2001", "", None)])
+    third = asyncio.run(synthesizer.synthesize())
+    assert third["chapters"] == [
+        {"title": "Childhood", "version": 1, "cached": True},
+        {"title": "Career", "version": 2, "cached": False},
+    ]
+    assert "Retired in 2001" in synthesizer.model.prompts[-1]
+
+    # A new chapter changes every chapter's outline, so all are rewritten against it
+    add_verified([("Travel", "Drove to Rome in 1970", "", None)])
+    fourth = asyncio.run(synthesizer.synthesize())
+    assert fourth["regenerated"] == 3
+    assert "The other chapters are: Career, Travel." in synthesizer.model.prompts[-3]
+
+def test_large_chapters_are_written_in_parts_and_merged(synthesizer, monkeypatch):
+    monkeypatch.setattr(synthesis_service, "CHAPTER_MAX_FRAGMENTS", 2)
+    add_verified([("Travel", f"Trip {i}", "", None) for i in range(5)])
+    result = asyncio.run(synthesizer.synthesize())
+    prompts = synthesizer.model.prompts
+    assert len(prompts) == 4  # three parts, then one merge
+    assert prompts[-1].lstrip().startswith("You are a professional biographer. The following passages")
+    assert result["chapters"] == [{"title": "Travel", "version": 1, "cached": False}]
+
+def test_interrupted_chapter_resumes_from_its_checkpoint(synthesizer, monkeypatch):
+    monkeypatch.setattr(synthesis_service, "SYNTHESIS_CHECKPOINT_CHARS", 1)
+    add_verified([("Family", "Married Anna in 1962", "", None)])
+    synthesizer.model.fail_after = 2
+    with pytest.raises(ConnectionError):
+        asyncio.run(synthesizer.synthesize())
+    digest = synthesis_service.chapter_hash("fake-model", "Family", [(1, "Married Anna in 1962", "")], [])
+    assert database.get_narrative_draft("Family", digest) == "Chapter about "
+
+    synthesizer.model.fail_after = None
+    result = asyncio.run(synthesizer.synthesize())
+    assert "The chapter so far (it was interrupted):\nChapter about " in synthesizer.model.prompts[-1]
+    assert result["narrative"].startswith("Family\n\nChapter about Chapter about Family #2")
+    assert database.get_narrative_draft("Family", digest) is None
+
+def test_readers_can_follow_a_draft_from_any_offset():
+    async def scenario():
+        draft = synthesis_service.ChapterDraft("Travel", "abc")
+
+        async def read(offset):
+            return "".join([text async for text in draft.follow(offset)])
+
+        early = asyncio.create_task(read(0))
+        draft.append("Rome, ")
+        await asyncio.sleep(0)
+        late = asyncio.create_task(read(2))
+        draft.append("then Paris.")
+        draft.finish(version=1)
+        return await early, await late
+
+    assert asyncio.run(scenario()) == ("Rome, then Paris.", "me, then Paris.")
+
+def test_resume_continues_only_from_text_the_client_already_has():
+    draft = synthesis_service.ChapterDraft("Travel", "abc", "Rome, then Paris.")
+    sent = synthesis_service.stream_checksum("Rome, ")
+    assert synthesis_service.resume_point(draft, 6, sent) == 6
+
+    # Restarted from an earlier checkpoint: shorter than what was sent, or rewritten past it
+    assert synthesis_service.resume_point(synthesis_service.ChapterDraft("Travel", "abc", "Rom"), 6, sent) == 0
+    assert synthesis_service.resume_point(synthesis_service.ChapterDraft("Travel", "abc", "Rome; Milan."), 6, sent) == 0
+    assert synthesis_service.resume_point(draft, 6, None) == 0
@@ -0,0 +1,82 @@
+import asyncio
+import hashlib
+import io
+import os
+import pytest
+import database
+import upload_service
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(upload_service, "PARTIAL_DIR", str(tmp_path / "partial"))
+    monkeypatch.setattr(upload_service, "MAX_UPLOAD_BYTES", {"audio": 64, "photo": 64})
+    database.init_db()
+    yield upload_service
+    database.close_connections()
+
+class FakeUpload:
+    def __init__(self, data: bytes):
+        self._buffer = io.BytesIO(data)
+
+    async def read(self, size: int = -1) -> bytes:
+        return self._buffer.read(size)
+
+async def stream(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+async def dropped(*chunks):
+    for chunk in chunks:
+        yield chunk
+    raise ConnectionResetError("client went away")
+
+def test_receive_file_dedupes_and_enforces_limit(uploads, tmp_path):
+    directory = str(tmp_path / "audio")
+    path, digest, created = asyncio.run(uploads.receive_file(FakeUpload(b"a" * 40), "audio", directory, "webm"))
+    assert created and digest == hashlib.sha256(b"a" * 40).hexdigest()
+    assert os.path.basename(path) == f"{digest[:32]}.webm"
+    assert asyncio.run(uploads.receive_file(FakeUpload(b"a" * 40), "audio", directory, "webm")) == (path, digest, False)
+
+    with pytest.raises(uploads.UploadTooLarge):
+        asyncio.run(uploads.receive_file(FakeUpload(b"b" * 65), "audio", directory, "webm"))
+    assert os.listdir(uploads.PARTIAL_DIR) == []
+
+def test_resumable_upload_survives_a_dropped_connection(uploads):
+    data = bytes(range(50))
+
+    async def scenario():
+        resumable = uploads.ResumableUploads()
+        upload_id = await resumable.create("photo", "x.jpg", len(data), {"fragment_id": 1})
+        with pytest.raises(ConnectionResetError):
+            await resumable.append(upload_id, 0, dropped(data[:10], data[10:20]))
+        assert database.get_upload_session(upload_id)[4] == 20
+
+        with pytest.raises(uploads.OffsetMismatch) as mismatch:
+            await resumable.append(upload_id, 10, stream(data[10:]))
+        assert mismatch.value.offset == 20
+
+        # A restarted server has no running hash and rebuilds it from the partial file
+        restarted = uploads.ResumableUploads()
+        session, digest = await restarted.append(upload_id, 20, stream(data[20:30]))
+        assert session[4] == 30 and digest is None
+        session, digest = await restarted.append(upload_id, 30, stream(data[30:]))
+        return upload_id, digest
+
+    upload_id, digest = asyncio.run(scenario())
+    assert digest == hashlib.sha256(data).hexdigest()
+    with open(uploads.partial_path(upload_id), "rb") as f:
+        assert f.read() == data
+
+def test_resumable_upload_rejects_bytes_past_declared_size(uploads):
+    async def scenario():
+        resumable = uploads.ResumableUploads()
+        with pytest.raises(uploads.UploadTooLarge):
+            await resumable.create("audio", "big.webm", 65, {})
+        upload_id = await resumable.create("audio", "a.webm", 8, {})
+        with pytest.raises(uploads.UploadTooLarge):
+            await resumable.append(upload_id, 0, stream(b"12345", b"6789"))
+        return upload_id
+
+    upload_id = asyncio.run(scenario())
+    assert database.get_upload_session(upload_id)[4] == 0
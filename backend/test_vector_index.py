@@ -0,0 +1,72 @@
+import numpy as np
+from vector_index import EmbeddingIndex, IVFIndex, create_index
+
+def clustered(n, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((8, dim))
+    return centres[rng.integers(0, 8, n)] + 0.05 * rng.standard_normal((n, dim))
+
+def test_ivf_recall_on_clustered_data():
+    vectors = clustered(400)
+    items = list(enumerate(vectors))
+    exact, ivf = EmbeddingIndex(), IVFIndex(nprobe=3, min_train_size=100)
+    exact.build(items)
+    ivf.build(items)
+    assert ivf.nlist == 20
+    recall = []
+    for query in vectors[:20]:
+        found = [fid for fid, _ in ivf.search(query, 3)]
+        truth = [fid for fid, _ in exact.search(query, 3)]
+        assert found[0] == truth[0]
+        recall.append(len(set(found) & set(truth)) / 3)
+    assert np.mean(recall) >= 0.9
+
+def test_ivf_incremental_inserts_and_deletes():
+    ivf = IVFIndex(min_train_size=50)
+    for fid, vec in enumerate(clustered(60)):
+        ivf.upsert(fid, vec)
+    # Trained once it crossed min_train_size, in the background rather than inside upsert
+    ivf.wait_for_training(5)
+    assert ivf.centroids is not None
+    assert len(ivf) == 60
+
+    ivf.remove(5)
+    assert 5 not in ivf
+    assert all(fid != 5 for fid, _ in ivf.search(clustered(60)[5], 10))
+    ivf.upsert(7, -clustered(60)[7])  # moving a vector re-assigns its list
+    assert ivf.search(-clustered(60)[7], 1)[0][0] == 7
+
+def test_ivf_retraining_stays_off_the_write_path(monkeypatch):
+    import threading
+    import vector_index
+    ivf = IVFIndex(min_train_size=50)
+    release, trained_on = threading.Event(), []
+    train = vector_index.train_centroids
+
+    def slow_train(vectors, nlist):
+        release.wait(5)
+        trained_on.append(threading.current_thread().name)
+        return train(vectors, nlist)
+
+    monkeypatch.setattr(vector_index, "train_centroids", slow_train)
+    for fid, vec in enumerate(clustered(60)):
+        ivf.upsert(fid, vec)  # would block here if training ran inline
+    assert ivf.centroids is None and ivf.search(clustered(60)[3], 1)[0][0] == 3
+    release.set()
+    ivf.wait_for_training(5)
+    assert trained_on == ["ivf-retrain"] and ivf.nlist > 1 and len(ivf) == 60
+
+def test_ivf_centroids_persist_across_restarts(tmp_path):
+    path = str(tmp_path / "memoria.ivf.npz")
+    items = list(enumerate(clustered(200)))
+    first = IVFIndex(min_train_size=100, path=path)
+    first.build(items)
+
+    restarted = IVFIndex(min_train_size=100, path=path)
+    restarted.build(items)
+    assert np.array_equal(restarted.centroids, first.centroids)
+
+def test_create_index_selects_implementation():
+    assert isinstance(create_index("exact"), EmbeddingIndex)
+    assert isinstance(create_index("ivf"), IVFIndex)
+    assert isinstance(create_index("bogus"), EmbeddingIndex)
@@ -0,0 +1,71 @@
+import asyncio
+import io
+import numpy as np
+import pytest
+from PIL import Image
+import database
+import model_registry
+import vision_service
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    yield
+    database.close_connections()
+
+def photo(size, seed=0, fmt="JPEG", quality=90):
+    rng = np.random.default_rng(seed)
+    small = Image.fromarray(rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)).resize(size, Image.BILINEAR)
+    buffer = io.BytesIO()
+    if fmt == "JPEG":
+        small.save(buffer, fmt, quality=quality)
+    else:
+        small.save(buffer, fmt)
+    buffer.seek(0)
+    return buffer
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+def test_prepare_image_downscales_and_hash_survives_reencoding():
+    jpeg, original = vision_service.prepare_image(photo((4000, 3000)))
+    with Image.open(io.BytesIO(jpeg)) as img:
+        assert max(img.size) == vision_service.VISION_MAX_EDGE
+    _, resaved = vision_service.prepare_image(photo((1200, 900), fmt="PNG"))
+    _, other = vision_service.prepare_image(photo((4000, 3000), seed=1))
+    assert distance(original, resaved) <= vision_service.VISION_HASH_DISTANCE
+    assert distance(original, other) > vision_service.VISION_HASH_DISTANCE
+
+def test_vision_descriptions_match_within_hamming_distance(db):
+    database.save_vision_description("m", 0xFFFF_0000_FFFF_0000, "Wedding, 1970s")
+    assert database.find_vision_description("m", 0xFFFF_0000_FFFF_0000) == "Wedding, 1970s"
+    assert database.find_vision_description("m", 0xFFFF_0000_FFFF_0007, 4) == "Wedding, 1970s"
+    assert database.find_vision_description("m", 0xFFFF_0000_FFFF_001F, 4) is None
+    assert database.find_vision_description("other", 0xFFFF_0000_FFFF_0000, 4) is None
+
+def test_describe_calls_the_model_once_per_photo(db, monkeypatch):
+    calls = []
+
+    class FakeModel:
+        def __init__(self, name, **config):
+            pass
+
+        async def generate_content_async(self, parts):
+            calls.append(parts)
+            return type("Response", (), {"text": "A family picnic by a lake."})()
+
+    monkeypatch.setattr(model_registry, "GenerativeModel", FakeModel)
+    monkeypatch.setattr(model_registry, "_registry_instance", None)
+    vision = vision_service.VisionService()
+
+    async def scenario():
+        first = await vision.describe(photo((3000, 2000)))
+        again = await vision.describe(photo((1500, 1000), quality=70))
+        return first, again
+
+    first, again = asyncio.run(scenario())
+    assert first == ("A family picnic by a lake.", False)
+    assert again == ("A family picnic by a lake.", True)
+    assert len(calls) == 1
+    assert vision.stats()["hits"] == 1
@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import database
+from async_utils import run_blocking
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = {
+    "audio": int(os.environ.get("MAX_AUDIO_UPLOAD_BYTES", 512 * 1024 * 1024)),
+    "photo": int(os.environ.get("MAX_PHOTO_UPLOAD_BYTES", 32 * 1024 * 1024)),
+}
+PARTIAL_DIR = os.path.join("uploads", "partial")
+UPLOAD_SESSION_TTL = float(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes: int):
+        super().__init__(f"Upload exceeds the limit of {max_bytes} bytes.")
+        self.max_bytes = max_bytes
+
+class OffsetMismatch(Exception):
+    def __init__(self, offset: int):
+        super().__init__(f"Upload is at offset {offset}.")
+        self.offset = offset
+
+async def iter_upload_file(file, chunk_size: int = UPLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Reads a multipart UploadFile in chunks instead of all at once.
+    """
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+async def write_chunks(chunks: AsyncIterator[bytes], path: str, max_bytes: int, offset: int = 0, hasher=None) -> int:
+    """
+    Appends chunks to path starting at offset, off the event loop, hashing them on the way.
+    Returns the number of bytes in the file afterwards. Raises UploadTooLarge past max_bytes;
+    the bytes written up to then stay on disk.
+    """
+    f = await run_blocking(open, path, "r+b" if offset else "wb")
+    written = offset
+    try:
+        if offset:
+            await run_blocking(f.seek, offset)
+            await run_blocking(f.truncate)
+        async for chunk in chunks:
+            if written + len(chunk) > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            if hasher is not None:
+                hasher.update(chunk)
+            await run_blocking(f.write, chunk)
+            written += len(chunk)
+    finally:
+        await run_blocking(f.close)
+    return written
+
+def adopt(tmp_path: str, digest: str, directory: str, ext: str) -> Tuple[str, bool]:
+    """
+    Moves a finished upload to its content-addressed name in directory. Returns (path, created);
+    if the same content is already stored the temporary file is discarded.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{digest[:32]}.{ext}")
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        return path, False
+    os.replace(tmp_path, path)
+    return path, True
+
+async def receive_partial(file, kind: str) -> Tuple[str, str]:
+    """
+    Streams a multipart upload to a temporary file under PARTIAL_DIR with a size limit,
+    hashing it on the way. Returns (tmp_path, sha256 hex) for the caller to adopt.
+    """
+    return await receive_stream(iter_upload_file(file), kind)
+
+async def receive_stream(chunks: AsyncIterator[bytes], kind: str) -> Tuple[str, str]:
+    """
+    receive_partial for a raw chunk stream, such as Request.stream().
+    """
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    tmp_path = os.path.join(PARTIAL_DIR, f"{uuid.uuid4().hex}.part")
+    hasher = hashlib.sha256()
+    try:
+        await write_chunks(chunks, tmp_path, MAX_UPLOAD_BYTES[kind], hasher=hasher)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return tmp_path, hasher.hexdigest()
+
+async def receive_file(file, kind: str, directory: str, ext: str) -> Tuple[str, str, bool]:
+    """
+    Streams a multipart upload to disk with a size limit and content-addressed dedup.
+    Returns (path, sha256 hex, created).
+    """
+    tmp_path, digest = await receive_partial(file, kind)
+    path, created = await run_blocking(adopt, tmp_path, digest, directory, ext)
+    return path, digest, created
+
+def _hash_prefix(path: str, length: int):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        remaining = length
+        while remaining:
+            chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    return hasher
+
+def partial_path(upload_id: str) -> str:
+    return os.path.join(PARTIAL_DIR, f"{upload_id}.part")
+
+def _create_empty(path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+
+class ResumableUploads:
+    """
+    Offset-based uploads that survive dropped connections and restarts. Session state lives
+    in the upload_sessions table and the bytes in uploads/partial/<id>.part; a client that
+    loses its connection asks for the current offset and continues from there.
+    """
+    def __init__(self):
+        self._hashers: Dict[str, tuple] = {}  # upload id -> (offset hashed to, running sha256)
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def create(self, kind: str, filename: str, size: int, meta: dict) -> str:
+        if kind not in MAX_UPLOAD_BYTES:
+            raise ValueError(f"Unknown upload kind '{kind}'")
+        if size > MAX_UPLOAD_BYTES[kind]:
+            raise UploadTooLarge(MAX_UPLOAD_BYTES[kind])
+        await self.expire()
+        upload_id = uuid.uuid4().hex
+        await run_blocking(_create_empty, partial_path(upload_id))
+        await run_blocking(database.create_upload_session, upload_id, kind, filename, size, json.dumps(meta))
+        return upload_id
+
+    async def append(self, upload_id: str, offset: int, chunks: AsyncIterator[bytes]) -> Tuple[tuple, Optional[str]]:
+        """
+        Appends a chunk stream at offset. Returns (session_row, digest), where digest is set
+        once the upload is complete and its file is ready to adopt.
+        """
+        lock = self._locks.setdefault(upload_id, asyncio.Lock())
+        async with lock:
+            session = await run_blocking(database.get_upload_session, upload_id)
+            if session is None:
+                raise KeyError(upload_id)
+            _, kind, filename, size, received, meta = session
+            if offset != received:
+                raise OffsetMismatch(received)
+
+            hashed_to, hasher = self._hashers.pop(upload_id, (None, None))
+            if hashed_to != received:
+                # Restarted or out of step: rebuild the running hash from the bytes on disk
+                hasher = await run_blocking(_hash_prefix, partial_path(upload_id), received)
+            try:
+                written = await write_chunks(chunks, partial_path(upload_id), min(size, MAX_UPLOAD_BYTES[kind]), offset, hasher)
+            except UploadTooLarge:
+                # More than the declared size: the offset stays put and the excess is truncated next time
+                raise
+            except Exception as e:
+                # A dropped connection still keeps the bytes that arrived
+                written = await run_blocking(os.path.getsize, partial_path(upload_id))
+                await run_blocking(database.set_upload_received, upload_id, written)
+                logging.warning(f"Upload {upload_id} interrupted at offset {written}: {e}")
+                raise
+            await run_blocking(database.set_upload_received, upload_id, written)
+
+            session = (upload_id, kind, filename, size, written, meta)
+            if written < size:
+                self._hashers[upload_id] = (written, hasher)
+                return session, None
+            self._locks.pop(upload_id, None)
+            return session, hasher.hexdigest()
+
+    async def finish(self, upload_id: str):
+        await run_blocking(database.delete_upload_session, upload_id)
+
+    async def expire(self):
+        expired = await run_blocking(database.expire_upload_sessions, time.time() - UPLOAD_SESSION_TTL)
+        for upload_id in expired:
+            self._hashers.pop(upload_id, None)
+            self._locks.pop(upload_id, None)
+            try:
+                os.remove(partial_path(upload_id))
+            except FileNotFoundError:
+                pass
+        if expired:
+            logging.info(f"Expired {len(expired)} abandoned uploads")
+
+_uploads_instance = None
+
+def get_resumable_uploads() -> ResumableUploads:
+    global _uploads_instance
+    if _uploads_instance is None:
+        _uploads_instance = ResumableUploads()
+    return _uploads_instance
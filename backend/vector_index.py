@@ -0,0 +1,343 @@
+import logging
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# Which index RAGService uses: "exact" (brute force) or "ivf" (approximate)
+RAG_INDEX = os.environ.get("RAG_INDEX", "exact")
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", 10))
+IVF_MIN_TRAIN_SIZE = int(os.environ.get("IVF_MIN_TRAIN_SIZE", 2000))
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    Returns indices of the top_k highest scores, best first, without sorting the full array.
+    """
+    k = min(top_k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return top[np.argsort(-scores[top])]
+
+class EmbeddingIndex:
+    """
+    Resident matrix of L2-normalized float32 embeddings with a parallel array of fragment ids.
+    Rows are kept in a preallocated buffer so single-row inserts and deletes don't copy the matrix.
+    """
+    def __init__(self, dim: Optional[int] = None, initial_capacity: int = 256):
+        self.dim = dim
+        self._capacity = initial_capacity
+        self._size = 0
+        self._matrix = None
+        self._ids = np.zeros(initial_capacity, dtype=np.int64)
+        self._rows = {}  # fragment id -> row in the matrix
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, fragment_id: int) -> bool:
+        return fragment_id in self._rows
+
+    @staticmethod
+    def normalize(vector) -> np.ndarray:
+        vec = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return vec
+        return vec / norm
+
+    def _ensure_capacity(self, size: int):
+        if self._matrix is None:
+            self._capacity = max(self._capacity, size)
+            self._matrix = np.zeros((self._capacity, self.dim), dtype=np.float32)
+            self._ids = np.zeros(self._capacity, dtype=np.int64)
+            return
+        if size <= self._capacity:
+            return
+        new_capacity = max(size, self._capacity * 2)
+        matrix = np.zeros((new_capacity, self.dim), dtype=np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        ids = np.zeros(new_capacity, dtype=np.int64)
+        ids[:self._size] = self._ids[:self._size]
+        self._matrix, self._ids, self._capacity = matrix, ids, new_capacity
+
+    def build(self, items: List[Tuple[int, np.ndarray]]):
+        """
+        Replaces the index contents with (fragment_id, vector) pairs.
+        """
+        with self._lock:
+            self._size = 0
+            self._rows = {}
+            self._matrix = None
+            if not items:
+                return
+            if self.dim is None:
+                self.dim = len(items[0][1])
+            items = [(fid, vec) for fid, vec in items if len(vec) == self.dim]
+            if not items:
+                return
+            self._ensure_capacity(len(items))
+            vectors = np.asarray([vec for _, vec in items], dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self._matrix[:len(items)] = vectors / norms
+            self._ids[:len(items)] = [fid for fid, _ in items]
+            self._rows = {fid: row for row, (fid, _) in enumerate(items)}
+            self._size = len(items)
+
+    def upsert(self, fragment_id: int, vector):
+        vec = self.normalize(vector)
+        with self._lock:
+            if self.dim is None:
+                self.dim = len(vec)
+            if len(vec) != self.dim:
+                logging.warning(f"Skipping embedding for fragment {fragment_id}: dimension {len(vec)} != {self.dim}")
+                return
+            row = self._rows.get(fragment_id)
+            if row is None:
+                self._ensure_capacity(self._size + 1)
+                row = self._size
+                self._size += 1
+                self._rows[fragment_id] = row
+                self._ids[row] = fragment_id
+            self._matrix[row] = vec
+
+    def remove(self, fragment_id: int):
+        with self._lock:
+            row = self._rows.pop(fragment_id, None)
+            if row is None:
+                return
+            last = self._size - 1
+            if row != last:
+                # Move the last row into the freed slot to keep the matrix dense
+                moved_id = int(self._ids[last])
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = moved_id
+                self._rows[moved_id] = row
+            self._size = last
+
+    def items(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns copies of the (ids, normalized vectors) currently in the index.
+        """
+        with self._lock:
+            if self._size == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros((0, self.dim or 0), dtype=np.float32)
+            return self._ids[:self._size].copy(), self._matrix[:self._size].copy()
+
+    def search(self, query_vector, top_k: int = 5) -> List[Tuple[int, float]]:
+        """
+        Returns up to top_k (fragment_id, cosine similarity) pairs, best first.
+        """
+        query = self.normalize(query_vector)
+        with self._lock:
+            if self._size == 0 or len(query) != self.dim:
+                return []
+            scores = self._matrix[:self._size] @ query
+            ids = self._ids[:self._size].copy()
+        return [(int(ids[i]), float(scores[i])) for i in top_k_indices(scores, top_k)]
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means over L2-normalized vectors. Returns normalized (nlist, dim) centroids.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), max(nlist * 64, 10000))
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        # Re-seed empty clusters from random points so every list stays useful
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+class IVFIndex:
+    """
+    Inverted-file approximate index: vectors are partitioned by their nearest k-means
+    centroid into inverted lists (each an EmbeddingIndex), and a search scores only the
+    nprobe lists whose centroids are closest to the query.
+
+    Below min_train_size vectors the index keeps a single list and is exact. The
+    centroids are persisted to `path` so restarts only re-assign vectors instead of
+    re-training; they are re-trained once the index grows 4x past its training size.
+    upsert runs on the thread saving the fragment, so that re-training happens on a
+    background thread while searches keep using the current lists.
+    """
+    def __init__(self, dim: Optional[int] = None, nprobe: int = IVF_NPROBE, min_train_size: int = IVF_MIN_TRAIN_SIZE, path: Optional[str] = None):
+        self.dim = dim
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.path = path
+        self.centroids = None
+        self.trained_size = 0
+        self._lists = [EmbeddingIndex(dim)]
+        self._where = {}  # fragment id -> inverted list number
+        self._lock = threading.RLock()
+        self._retrain_thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, fragment_id: int) -> bool:
+        return fragment_id in self._where
+
+    @property
+    def nlist(self) -> int:
+        return len(self._lists)
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        if self.centroids is None:
+            return np.zeros(len(vectors), dtype=np.int64)
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def _load_centroids(self, size: int) -> bool:
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            data = np.load(self.path)
+            centroids, trained_size = data["centroids"], int(data["trained_size"])
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable IVF centroids at {self.path}: {e}")
+            return False
+        if centroids.shape[1] != self.dim or not trained_size <= size < trained_size * 4:
+            return False
+        self.centroids, self.trained_size = centroids.astype(np.float32), trained_size
+        return True
+
+    def _save_centroids(self):
+        if not self.path or self.centroids is None:
+            return
+        try:
+            tmp_path = self.path + ".tmp.npz"
+            np.savez(tmp_path, centroids=self.centroids, trained_size=self.trained_size)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Failed to persist IVF centroids to {self.path}: {e}")
+
+    def _partition(self, ids: np.ndarray, vectors: np.ndarray):
+        assign = self._assign(vectors)
+        lists = [EmbeddingIndex(self.dim) for _ in range(len(self.centroids) if self.centroids is not None else 1)]
+        for list_no in np.unique(assign):
+            rows = np.nonzero(assign == list_no)[0]
+            lists[list_no].build(list(zip(ids[rows].tolist(), vectors[rows])))
+        self._lists = lists
+        self._where = dict(zip(ids.tolist(), assign.tolist()))
+
+    def _train(self, vectors: np.ndarray):
+        self.centroids = train_centroids(vectors, max(1, int(np.sqrt(len(vectors)))))
+        self.trained_size = len(vectors)
+        self._save_centroids()
+        logging.info(f"Trained IVF index with {len(self.centroids)} lists over {len(vectors)} vectors")
+
+    def build(self, items: List[Tuple[int, np.ndarray]]):
+        with self._lock:
+            self.centroids, self.trained_size = None, 0
+            if self.dim is None and items:
+                self.dim = len(items[0][1])
+            items = [(fid, vec) for fid, vec in items if len(vec) == self.dim]
+            ids = np.array([fid for fid, _ in items], dtype=np.int64)
+            vectors = np.asarray([vec for _, vec in items], dtype=np.float32).reshape(len(items), self.dim or 0)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            vectors = vectors / norms
+            if len(items) >= self.min_train_size and not self._load_centroids(len(items)):
+                self._train(vectors)
+            self._partition(ids, vectors)
+
+    def _snapshot(self) -> Tuple[np.ndarray, np.ndarray]:
+        ids, vectors = [], []
+        for inverted in self._lists:
+            list_ids, list_vectors = inverted.items()
+            ids.append(list_ids)
+            vectors.append(list_vectors)
+        return np.concatenate(ids), np.concatenate(vectors)
+
+    def _needs_training(self) -> bool:
+        size = len(self._where)
+        if self.centroids is None:
+            return size >= self.min_train_size
+        return size >= self.trained_size * 4
+
+    def _retrain(self):
+        """
+        Trains new centroids from a snapshot without holding the lock, then re-partitions
+        whatever the index holds by then.
+        """
+        try:
+            with self._lock:
+                _, vectors = self._snapshot()
+            centroids = train_centroids(vectors, max(1, int(np.sqrt(len(vectors)))))
+            with self._lock:
+                self.centroids, self.trained_size = centroids, len(vectors)
+                self._partition(*self._snapshot())
+            self._save_centroids()
+            logging.info(f"Re-trained IVF index with {len(centroids)} lists over {len(vectors)} vectors")
+        except Exception as e:
+            logging.error(f"IVF re-training failed: {e}")
+
+    def wait_for_training(self, timeout: Optional[float] = None):
+        thread = self._retrain_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def upsert(self, fragment_id: int, vector):
+        vec = EmbeddingIndex.normalize(vector)
+        with self._lock:
+            if self.dim is None:
+                self.dim = len(vec)
+                self._lists = [EmbeddingIndex(self.dim)]
+            if len(vec) != self.dim:
+                logging.warning(f"Skipping embedding for fragment {fragment_id}: dimension {len(vec)} != {self.dim}")
+                return
+            list_no = int(self._assign(vec[None, :])[0])
+            previous = self._where.get(fragment_id)
+            if previous is not None and previous != list_no:
+                self._lists[previous].remove(fragment_id)
+            self._lists[list_no].upsert(fragment_id, vec)
+            self._where[fragment_id] = list_no
+            retraining = self._retrain_thread is not None and self._retrain_thread.is_alive()
+            if self._needs_training() and not retraining:
+                self._retrain_thread = threading.Thread(target=self._retrain, name="ivf-retrain", daemon=True)
+                self._retrain_thread.start()
+
+    def remove(self, fragment_id: int):
+        with self._lock:
+            list_no = self._where.pop(fragment_id, None)
+            if list_no is not None:
+                self._lists[list_no].remove(fragment_id)
+
+    def search(self, query_vector, top_k: int = 5) -> List[Tuple[int, float]]:
+        query = EmbeddingIndex.normalize(query_vector)
+        with self._lock:
+            if not self._where or len(query) != self.dim:
+                return []
+            if self.centroids is None:
+                probe = [0]
+            else:
+                probe = top_k_indices(self.centroids @ query, self.nprobe).tolist()
+            lists = [self._lists[i] for i in probe]
+        hits = []
+        for inverted in lists:
+            hits.extend(inverted.search(query, top_k))
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits[:top_k]
+
+def create_index(kind: str = RAG_INDEX, path: Optional[str] = None):
+    """
+    Returns the vector index implementation selected by RAG_INDEX.
+    """
+    if kind == "ivf":
+        return IVFIndex(path=path)
+    if kind != "exact":
+        logging.warning(f"Unknown RAG_INDEX '{kind}', falling back to exact search")
+    return EmbeddingIndex()
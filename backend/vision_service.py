@@ -0,0 +1,93 @@
+from vertexai.generative_models import Part
+import hashlib
+import io
+import logging
+import os
+import threading
+from typing import Tuple
+
+from PIL import Image, ImageOps
+
+import config
+import database
+import model_registry
+from async_utils import run_blocking
+
+# Long edge sent to Gemini; bigger photos cost more tokens and latency without better descriptions
+VISION_MAX_EDGE = int(os.environ.get("VISION_MAX_EDGE", 1024))
+VISION_JPEG_QUALITY = 85
+# Bits two dHashes may differ by and still count as the same photo (re-encodes, resizes, light edits)
+VISION_HASH_DISTANCE = int(os.environ.get("VISION_HASH_DISTANCE", 4))
+
+VISION_PROMPT = "You are an AI biographer assistant. Analyze this photo and describe what you see in a way that helps an interviewer ask meaningful questions. Focus on people, fashion (to guess the era), and activities."
+
+def dhash(img: Image.Image) -> int:
+    """
+    64-bit difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter
+    than its right-hand neighbour. Survives re-compression and resizing.
+    """
+    pixels = img.convert("L").resize((9, 8), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+def prepare_image(source) -> Tuple[bytes, int]:
+    """
+    Decodes a photo (path or file object), downscales it to VISION_MAX_EDGE and re-encodes
+    it as JPEG. Returns (jpeg bytes, dhash).
+    """
+    with Image.open(source) as img:
+        # Lets the JPEG decoder skip straight to a reduced scale for large photos
+        img.draft("RGB", (VISION_MAX_EDGE, VISION_MAX_EDGE))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE), Image.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=VISION_JPEG_QUALITY)
+    return buffer.getvalue(), dhash(img)
+
+class VisionService:
+    def __init__(self, model_name: str = config.VISION_MODEL):
+        self.model_name = model_name
+        self.model = model_registry.get_model_registry().get(model_name)
+        # Descriptions are only reused for the same model and prompt
+        self.cache_namespace = f"{model_name}:{hashlib.sha256(VISION_PROMPT.encode('utf-8')).hexdigest()[:12]}"
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    async def describe(self, source) -> Tuple[str, bool]:
+        """
+        Describes a photo for the interviewer. Returns (description, cached); photos that are
+        perceptually the same as one described before reuse its description.
+        """
+        jpeg, phash = await run_blocking(prepare_image, source)
+        description = await run_blocking(database.find_vision_description, self.cache_namespace, phash, VISION_HASH_DISTANCE)
+        with self._lock:
+            if description:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if description:
+            return description, True
+
+        response = await self.model.generate_content_async([VISION_PROMPT, Part.from_data(data=jpeg, mime_type="image/jpeg")])
+        description = response.text
+        await run_blocking(database.save_vision_description, self.cache_namespace, phash, description)
+        return description, False
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0}
+
+_vision_instance = None
+
+def get_vision_service() -> VisionService:
+    global _vision_instance
+    if _vision_instance is None:
+        if config.PROJECT_ID:
+            _vision_instance = VisionService()
+        else:
+            logging.warning("GOOGLE_CLOUD_PROJECT not set. Vision service will not be available.")
+    return _vision_instance
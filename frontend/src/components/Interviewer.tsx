@@ -16,6 +16,8 @@ export const Interviewer: React.FC = () => {
     const [showSummary, setShowSummary] = useState(false);
     const [era, setEra] = useState<'modern' | 'vintage' | 'sepia'>('modern');
     const [seed, setSeed] = useState('');
+    // Sent with every turn so the backend can tell conversations apart; new for each session
+    const sessionIdRef = React.useRef<string>(crypto.randomUUID());
 
     const eraThemes = {
         modern: '',
@@ -140,10 +142,12 @@ export const Interviewer: React.FC = () => {
             alert('Please provide an Agent ID');
             return;
         }
+        sessionIdRef.current = crypto.randomUUID();
         try {
             await conversation.startSession({
                 agentId: agentId as string,
                 connectionType: 'webrtc',
+                customLlmExtraBody: { session_id: sessionIdRef.current },
             });
         } catch (err: unknown) {
             console.error(err);
@@ -290,21 +294,20 @@ export const Interviewer: React.FC = () => {
                                 onChange={async (e) => {
                                     const file = e.target.files?.[0];
                                     if (file) {
-                                        const reader = new FileReader();
-                                        reader.onloadend = async () => {
-                                            const base64 = (reader.result as string).split(',')[1];
-                                            try {
-                                                await fetch(`${import.meta.env.VITE_BACKEND_URL || 'http://localhost:8000'}/vision-context`, {
-                                                    method: 'POST',
-                                                    headers: { 'Content-Type': 'application/json' },
-                                                    body: JSON.stringify({ image: base64 })
-                                                });
-                                                fetchMemories();
-                                            } catch (err) {
-                                                console.error("Vision upload failed", err);
-                                            }
-                                        };
-                                        reader.readAsDataURL(file);
+                                        // Sent as-is; the backend downscales it
+                                        const formData = new FormData();
+                                        formData.append('file', file);
+                                        formData.append('session_id', sessionIdRef.current);
+                                        try {
+                                            await fetch(`${import.meta.env.VITE_BACKEND_URL || 'http://localhost:8000'}/vision-context`, {
+                                                method: 'POST',
+                                                body: formData
+                                            });
+                                            fetchMemories();
+                                        } catch (err) {
+                                            console.error("Vision upload failed", err);
+                                        }
+                                        e.target.value = '';
                                     }
                                 }}
                             />